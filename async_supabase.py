@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Async Supabase Access
+=====================
+同期版supabase-pyクライアントの .execute() を有界スレッドプールで実行し、
+async def のFastAPIハンドラからイベントループをブロックせずに呼び出すためのレイヤー
+
+使い方:
+    supabase = get_supabase_client()
+    result = await supabase.execute(
+        lambda client: client.table('devices').select('subject_id').eq('device_id', device_id)
+    )
+
+クエリは「クライアントを受け取ってクエリビルダーを返す関数」として渡す。
+.execute() はワーカースレッド内で実行される。クライアントは全ワーカースレッドで1つを共有し、
+HTTP接続はコネクションプール（supabase_pool）から再利用する。
+
+リクエストに deadline（deadlines）が設定されている場合は残り時間をタイムアウトとして使い、
+間に合わない呼び出しは DeadlineExceeded で打ち切る。冪等な読み取りは hedge=True を指定すると、
+応答が遅い場合に同じクエリをもう1本送り、先に返った方の結果を使う（SUPABASE_HEDGE_DELAY_SECONDS）。
+"""
+
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+import deadlines
+import metrics
+import query_accounting
+import supabase_pool
+
+if TYPE_CHECKING:
+    # supabase-py（httpx等を含む）のインポートは重いため、クライアント生成時まで遅らせる
+    from supabase import Client
+
+
+DEFAULT_MAX_WORKERS = 8
+# PostgRESTのデフォルト最大取得件数（max-rows）に合わせたページサイズ
+DEFAULT_PAGE_SIZE = 1000
+# hedgeするまでの待ち時間（0の場合はhedgeしない）
+DEFAULT_HEDGE_DELAY_SECONDS = 0.0
+
+
+class AsyncSupabaseClient:
+    """有界スレッドプール + 共有Supabaseクライアント（コネクションプール付き）による非同期アクセス"""
+
+    def __init__(self, url: str, key: str, max_workers: int = DEFAULT_MAX_WORKERS,
+                 pool_config: Optional[supabase_pool.PoolConfig] = None, hedge_delay: float = DEFAULT_HEDGE_DELAY_SECONDS):
+        if not url or not key:
+            raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in environment variables")
+
+        self.url = url
+        self.key = key
+        self.max_workers = max_workers
+        self.pool_config = pool_config or supabase_pool.PoolConfig()
+        self.pool_stats = supabase_pool.PoolStats()
+        self.hedge_delay = hedge_delay
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="supabase")
+        self._client = None
+        self._session = None
+        # クライアント生成中にPostgRESTクライアント（セッション）を生成するため再入可能なロックにする
+        self._client_lock = threading.RLock()
+
+    @classmethod
+    def from_env(cls) -> "AsyncSupabaseClient":
+        """
+        環境変数から生成（SUPABASE_MAX_WORKERSでスレッド数、SUPABASE_POOL_* 等でコネクションプール、
+        SUPABASE_HEDGE_DELAY_SECONDSでhedgeまでの待ち時間を調整可能）
+        """
+        return cls(
+            os.getenv("SUPABASE_URL"),
+            os.getenv("SUPABASE_KEY"),
+            max_workers=int(os.getenv("SUPABASE_MAX_WORKERS", str(DEFAULT_MAX_WORKERS))),
+            pool_config=supabase_pool.PoolConfig.from_env(),
+            hedge_delay=float(os.getenv("SUPABASE_HEDGE_DELAY_SECONDS", str(DEFAULT_HEDGE_DELAY_SECONDS)))
+        )
+
+    def _get_client(self) -> "Client":
+        """
+        共有クライアントを取得（初回のみ生成、複数スレッドから同時に呼ばれても1つだけ生成）
+        PostgRESTのクエリビルダーはセッションを読み取るだけなので、スレッド間で共有できる
+
+        supabase-pyは認証状態が変わるとPostgRESTクライアントを作り直すため、生成後に session を差し替えるのではなく、
+        PostgRESTクライアントのセッション生成（create_session）でプール設定済みのセッションを渡す
+        """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from postgrest import SyncPostgrestClient
+                    from supabase import Client
+
+                    pooled_session = self._pooled_session
+
+                    class PooledPostgrestClient(SyncPostgrestClient):
+                        def create_session(self, base_url, headers, timeout):
+                            # タイムアウトはプールの設定（と呼び出しごとの call_timeout）を使う
+                            return pooled_session(base_url, headers)
+
+                    class PooledClient(Client):
+                        @staticmethod
+                        def _init_postgrest_client(rest_url, headers, schema, timeout=None):
+                            return PooledPostgrestClient(rest_url, headers=headers, schema=schema)
+
+                    client = PooledClient(self.url, self.key)
+                    # PostgRESTクライアント（セッション）を事前に生成する
+                    client.postgrest
+                    self._client = client
+        return self._client
+
+    def _pooled_session(self, base_url: str, headers: Dict[str, str]):
+        """
+        プール設定済みの共有セッションを返す（初回のみ生成）
+        PostgRESTクライアントが作り直された場合は同じセッションを使い、新しい認証ヘッダーだけを引き継ぐ
+        """
+        with self._client_lock:
+            if self._session is None:
+                session = supabase_pool.create_session(base_url, headers, self.pool_config, self.pool_stats)
+                metrics.instrument_http_client(session)
+                query_accounting.instrument_http_client(session)
+                metrics.register_pool_gauges(lambda: supabase_pool.pool_snapshot(session))
+                self._session = session
+            else:
+                self._session.headers.update(headers)
+            return self._session
+
+    async def warmup(self, validate: Callable[["Client"], Any]) -> Any:
+        """
+        クライアントを事前に生成し、validate のクエリを同時に実行してkeep-alive接続を事前に確立する
+        （初回リクエストでクライアント生成・TLS接続のコストを払わないようにする）
+        """
+        connections = max(1, min(self.max_workers, self.pool_config.max_keepalive_connections))
+        results = await asyncio.gather(*(self.execute(validate) for _ in range(connections)))
+        return results[0]
+
+    def pool_stats_snapshot(self) -> Dict[str, Any]:
+        """コネクションプールの設定・新規接続数・現在の接続数"""
+        return {
+            "max_workers": self.max_workers,
+            **supabase_pool.describe(self.pool_config, self.pool_stats, self._session)
+        }
+
+    async def execute(self, build: Callable[["Client"], Any], timeout: Optional[float] = None, hedge: bool = False) -> Any:
+        """
+        クエリをスレッドプールで実行して結果（APIResponse）を返す
+
+        Args:
+            build: Supabaseクライアントを受け取り、.execute() 前のクエリビルダーを返す関数
+            timeout: この呼び出しのHTTPタイムアウト（秒、省略時はプールの設定値。deadlineの残り時間を超えない）
+            hedge: 冪等な読み取りの場合のみTrue。hedge_delay 秒以内に応答がなければ同じクエリをもう1本送る
+
+        Raises:
+            deadlines.DeadlineExceeded: リクエストの deadline までに完了しなかった
+        """
+        left = deadlines.remaining()
+        if left is not None:
+            if left <= 0:
+                raise deadlines.DeadlineExceeded("Supabase呼び出し前")
+            timeout = left if timeout is None else min(timeout, left)
+
+        if hedge and 0 < self.hedge_delay and (left is None or self.hedge_delay < left):
+            attempt = self._execute_hedged(build, timeout)
+        else:
+            attempt = self._execute_once(build, timeout, {})
+        if left is None:
+            return await attempt
+
+        try:
+            return await asyncio.wait_for(attempt, left)
+        except deadlines.DeadlineExceeded:
+            raise
+        except asyncio.TimeoutError:
+            raise deadlines.DeadlineExceeded("Supabase呼び出し中")
+        except Exception as e:
+            # HTTPタイムアウト（残り時間）で失敗した場合も deadline 超過として扱う
+            if deadlines.expired():
+                raise deadlines.DeadlineExceeded("Supabase呼び出し中") from e
+            raise
+
+    async def _execute_once(self, build: Callable[["Client"], Any], timeout: Optional[float], query_info: Dict[str, str],
+                            record: bool = True) -> Any:
+        """
+        クエリを1回実行する（query_info に table / method を書き込む）
+        record=False の場合はリクエストごとのクエリ数（query_accounting）に数えない（hedgeで追加した試行）
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        query_info.setdefault('table', '<unknown>')
+        query_info.setdefault('method', '<unknown>')
+        failed = False
+
+        def run() -> Any:
+            if timeout is not None:
+                supabase_pool.call_timeout.set(timeout)
+            query = build(self._get_client())
+            # PostgRESTのクエリビルダーは path（/テーブル名）と http_method を持つ
+            query_info['table'] = query.path.lstrip('/')
+            query_info['method'] = query.http_method
+            if record:
+                query_accounting.record_query(query_info['table'], query_info['method'])
+            return query.execute()
+
+        try:
+            # コンテキスト（リクエストごとのクエリ集計など）をワーカースレッドに引き継いで実行
+            return await loop.run_in_executor(self._executor, contextvars.copy_context().run, run)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            metrics.observe_supabase_request(query_info['table'], query_info['method'], time.perf_counter() - start, failed)
+
+    async def _execute_hedged(self, build: Callable[["Client"], Any], timeout: Optional[float]) -> Any:
+        """
+        hedge_delay 秒以内に応答がなければ同じクエリをもう1本送り、先に成功した方の結果を返す
+        （両方失敗した場合は最初の例外を送出。ワーカースレッド内のHTTP呼び出しは timeout で打ち切られる）
+        クエリ数は1件の論理的なクエリとして最初の試行だけで数え、追加した試行は SUPABASE_HEDGED_REQUESTS で数える
+        """
+        query_info: Dict[str, str] = {}
+        primary = asyncio.ensure_future(self._execute_once(build, timeout, query_info))
+        attempts = {primary}
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=self.hedge_delay)
+            if done:
+                return primary.result()
+
+            hedged = asyncio.ensure_future(self._execute_once(build, timeout, {}, record=False))
+            attempts.add(hedged)
+            table = query_info.get('table', '<unknown>')
+            metrics.SUPABASE_HEDGED_REQUESTS.labels(table=table, outcome='launched').inc()
+
+            errors: List[BaseException] = []
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # 同時に完了した場合は最初に送った方を優先する
+                for attempt in sorted(done, key=lambda t: t is hedged):
+                    if attempt.exception() is None:
+                        if attempt is hedged:
+                            metrics.SUPABASE_HEDGED_REQUESTS.labels(table=table, outcome='won').inc()
+                        return attempt.result()
+                    errors.append(attempt.exception())
+            raise errors[0]
+        finally:
+            for attempt in attempts:
+                if not attempt.done():
+                    attempt.cancel()
+                # 使わなかった方の結果・例外は読み捨てる（完了済みの試行も含む）
+                attempt.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def execute_paged(self, build: Callable[["Client"], Any], page_size: int = DEFAULT_PAGE_SIZE,
+                            hedge: bool = False) -> List[Dict[str, Any]]:
+        """
+        PostgRESTの最大取得件数を超える可能性のある一括取得用
+        limit / offset でページングしながら全行を取得して返す（build側で順序を固定すること）
+        （postgrest-py 0.13系の .range() は終端を含まないため使わない）
+        """
+        rows: List[Dict[str, Any]] = []
+        offset = 0
+        while True:
+            start = offset
+            response = await self.execute(lambda c: build(c).limit(page_size).offset(start), hedge=hedge)
+            page = response.data or []
+            rows.extend(page)
+            if len(page) < page_size:
+                return rows
+            offset += page_size
+
+    def shutdown(self):
+        """スレッドプールを停止し、コネクションプールの接続を閉じる"""
+        self._executor.shutdown(wait=False)
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        self._client = None
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+Fake PostgREST Server
+=====================
+ベンチマーク用に、プロセス内のスレッドで動くPostgREST互換の簡易HTTPサーバー
+
+- /rest/v1/<table> への GET（select / eq・neq・gt・gte・lt・lte・in・is / or / order / limit・offset・Range）、
+  POST（upsert: on_conflict + Prefer: resolution=merge-duplicates）、PATCH（update）に対応
+- select のJSONBサブパス（alias:column->key）にも対応
+- 1リクエストごとに latency_ms だけ待ってから応答する（DBまでの往復を模擬）
+- リクエスト数（ラウンドトリップ）と送受信バイト数をテーブル・メソッドごとに数える
+
+本物のsupabase-py / postgrest-pyクライアントからHTTPで呼び出されるため、
+アプリケーションのクエリ組み立て・JSONデコードまで含めて計測できる。
+"""
+
+import copy
+import json
+import random
+import threading
+import time
+from collections import Counter
+from datetime import date as date_cls, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+
+REST_PREFIX = "/rest/v1/"
+
+# PostgRESTのキーワード（フィルタとして扱わないパラメータ）
+_RESERVED_PARAMS = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+
+
+def _split_top_level(value: str) -> List[str]:
+    """カンマ区切りを分割（ダブルクォート・括弧の中のカンマは区切りとみなさない）"""
+    parts, current, depth, quoted = [], [], 0, False
+    for char in value:
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char == '(':
+            depth += 1
+        elif not quoted and char == ')':
+            depth -= 1
+        if char == ',' and not quoted and depth == 0:
+            parts.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    parts.append(''.join(current))
+    return parts
+
+
+def _unquote(value: str) -> str:
+    return value[1:-1] if len(value) >= 2 and value[0] == value[-1] == '"' else value
+
+
+def _compare(operator: str, actual: Any, expected: str) -> bool:
+    if operator == "is":
+        return actual is None if expected == "null" else str(actual).lower() == expected
+    if actual is None:
+        return False
+    if operator == "in":
+        return str(actual) in {_unquote(item) for item in _split_top_level(expected[1:-1])}
+
+    expected = _unquote(expected)
+    if isinstance(actual, (int, float)) and not isinstance(actual, bool):
+        try:
+            expected_value: Any = float(expected)
+            actual_value: Any = float(actual)
+        except ValueError:
+            expected_value, actual_value = expected, str(actual)
+    else:
+        expected_value, actual_value = expected, str(actual)
+
+    return {
+        "eq": actual_value == expected_value,
+        "neq": actual_value != expected_value,
+        "gt": actual_value > expected_value,
+        "gte": actual_value >= expected_value,
+        "lt": actual_value < expected_value,
+        "lte": actual_value <= expected_value,
+    }[operator]
+
+
+def _parse_condition(column: str, expression: str) -> Callable[[Dict[str, Any]], bool]:
+    negate = expression.startswith("not.")
+    if negate:
+        expression = expression[4:]
+    operator, expected = expression.split(".", 1)
+    return lambda row: _compare(operator, row.get(column), expected) != negate
+
+
+def _parse_or(expression: str) -> Callable[[Dict[str, Any]], bool]:
+    conditions = []
+    for part in _split_top_level(expression[1:-1]):
+        column, rest = part.split(".", 1)
+        conditions.append(_parse_condition(column, rest))
+    return lambda row: any(condition(row) for condition in conditions)
+
+
+def _project(row: Dict[str, Any], select: Optional[str]) -> Dict[str, Any]:
+    """select=a,b,alias:column->key のカラム指定で行を射影"""
+    if not select or select == "*":
+        return copy.deepcopy(row)
+
+    projected = {}
+    for spec in _split_top_level(select):
+        spec = spec.strip()
+        alias = None
+        if ":" in spec:
+            alias, spec = spec.split(":", 1)
+        path = spec.split("->")
+        value = row.get(path[0])
+        for key in path[1:]:
+            value = value.get(key) if isinstance(value, dict) else None
+        projected[alias or path[-1]] = copy.deepcopy(value)
+    return projected
+
+
+class FakePostgrestStore:
+    """テーブルごとの行データとアクセス統計"""
+
+    def __init__(self, tables: Dict[str, List[Dict[str, Any]]], latency_ms: float = 0.0):
+        self.tables = tables
+        self.latency_ms = latency_ms
+        self.lock = threading.Lock()
+        self.round_trips: Counter = Counter()
+        self.bytes_sent: Counter = Counter()
+        self.bytes_received: Counter = Counter()
+
+    def reset_stats(self):
+        with self.lock:
+            self.round_trips.clear()
+            self.bytes_sent.clear()
+            self.bytes_received.clear()
+
+    def total_round_trips(self) -> int:
+        with self.lock:
+            return sum(self.round_trips.values())
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "round_trips": {f"{method} {table}": count for (method, table), count in sorted(self.round_trips.items())},
+                "bytes_sent": sum(self.bytes_sent.values()),
+                "bytes_received": sum(self.bytes_received.values())
+            }
+
+    def select(self, table: str, params: List[Tuple[str, str]], range_header: Optional[str]) -> List[Dict[str, Any]]:
+        filters = []
+        order: List[Tuple[str, bool]] = []
+        select = limit = offset = None
+        for key, value in params:
+            if key == "select":
+                select = value
+            elif key == "order":
+                for item in value.split(","):
+                    column, *modifiers = item.split(".")
+                    order.append((column, "desc" in modifiers))
+            elif key == "limit":
+                limit = int(value)
+            elif key == "offset":
+                offset = int(value)
+            elif key == "or":
+                filters.append(_parse_or(value))
+            elif key not in _RESERVED_PARAMS:
+                filters.append(_parse_condition(key, value))
+
+        with self.lock:
+            rows = [row for row in self.tables.get(table, []) if all(condition(row) for condition in filters)]
+
+        for column, desc in reversed(order):
+            rows.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+
+        if range_header:
+            start, end = range_header.split("-")
+            rows = rows[int(start):int(end) + 1]
+        if offset:
+            rows = rows[offset:]
+        if limit is not None:
+            rows = rows[:limit]
+        return [_project(row, select) for row in rows]
+
+    def upsert(self, table: str, params: List[Tuple[str, str]], body: Any) -> List[Dict[str, Any]]:
+        items = body if isinstance(body, list) else [body]
+        conflict_columns = dict(params).get("on_conflict", "").split(",")
+        with self.lock:
+            rows = self.tables.setdefault(table, [])
+            for item in items:
+                for row in rows:
+                    if conflict_columns[0] and all(row.get(column) == item.get(column) for column in conflict_columns):
+                        row.update(copy.deepcopy(item))
+                        break
+                else:
+                    rows.append(copy.deepcopy(item))
+        return items
+
+    def update(self, table: str, params: List[Tuple[str, str]], body: Dict[str, Any]) -> List[Dict[str, Any]]:
+        filters = [_parse_condition(key, value) for key, value in params if key not in _RESERVED_PARAMS]
+        with self.lock:
+            updated = []
+            for row in self.tables.get(table, []):
+                if all(condition(row) for condition in filters):
+                    row.update(copy.deepcopy(body))
+                    updated.append(copy.deepcopy(row))
+        return updated
+
+
+def _make_handler(store: FakePostgrestStore):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _handle(self, method: str):
+            url = urlsplit(self.path)
+            if not url.path.startswith(REST_PREFIX):
+                self._respond(404, {"message": "not found"})
+                return
+            table = url.path[len(REST_PREFIX):]
+            params = parse_qsl(url.query, keep_blank_values=True)
+
+            length = int(self.headers.get("Content-Length") or 0)
+            raw_body = self.rfile.read(length) if length else b""
+            body = json.loads(raw_body) if raw_body else None
+
+            if store.latency_ms > 0:
+                time.sleep(store.latency_ms / 1000)
+
+            try:
+                if method == "GET":
+                    data = store.select(table, params, self.headers.get("Range"))
+                elif method == "POST":
+                    data = store.upsert(table, params, body)
+                elif method == "PATCH":
+                    data = store.update(table, params, body)
+                else:
+                    self._respond(405, {"message": "method not allowed"})
+                    return
+            except Exception as e:
+                self._respond(400, {"message": str(e)})
+                return
+
+            payload = self._respond(200 if method != "POST" else 201, data)
+            with store.lock:
+                store.round_trips[(method, table)] += 1
+                store.bytes_received[table] += len(raw_body)
+                store.bytes_sent[table] += payload
+
+        def _respond(self, status: int, data: Any) -> int:
+            encoded = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(encoded)))
+            if isinstance(data, list):
+                self.send_header("Content-Range", f"0-{max(len(data) - 1, 0)}/*")
+            self.end_headers()
+            self.wfile.write(encoded)
+            return len(encoded)
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_POST(self):
+            self._handle("POST")
+
+        def do_PATCH(self):
+            self._handle("PATCH")
+
+    return Handler
+
+
+class FakePostgrestServer:
+    """バックグラウンドスレッドで動くFake PostgRESTサーバー（with文で起動・停止）"""
+
+    def __init__(self, store: FakePostgrestStore, host: str = "127.0.0.1", port: int = 0):
+        self.store = store
+        self._server = ThreadingHTTPServer((host, port), _make_handler(store))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-postgrest", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakePostgrestServer":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakePostgrestServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+# ===============================
+# 合成データ
+# ===============================
+
+SED_LABELS = [
+    "Speech", "Child speech, kid speaking", "Baby cry, infant cry", "Music", "Television",
+    "Vehicle", "Dishes, pots, and pans", "Door", "Footsteps", "Laughter", "Silence",
+    "Inside, small room", "Noise", "Typing", "Water tap, faucet", "Bird", "Dog", "Clock",
+    "Writing", "Whispering", "Cough", "Conversation", "Narration, monologue", "Piano"
+]
+
+
+def time_blocks() -> List[str]:
+    return [f"{hour:02d}-{minute}" for hour in range(24) for minute in ("00", "30")]
+
+
+def build_dataset(devices: int = 4, days: int = 2, start_date: str = "2025-09-01",
+                  sed_events: int = 20, opensmile_seconds: int = 60, seed: int = 0) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    audio_features / dashboard / vibe_whisper / devices / subjects の合成データ
+    各デバイス・各日について48ブロック分の行を作る
+    """
+    rng = random.Random(seed)
+    first_day = date_cls.fromisoformat(start_date)
+    dates = [(first_day + timedelta(days=offset)).isoformat() for offset in range(days)]
+
+    tables: Dict[str, List[Dict[str, Any]]] = {
+        "devices": [], "subjects": [], "audio_features": [], "dashboard": [], "vibe_whisper": [],
+        "audio_aggregator": [], "dashboard_summary": [], "vibe_whisper_prompt": []
+    }
+
+    for index in range(devices):
+        device_id = f"bench-device-{index:03d}"
+        subject_id = f"bench-subject-{index:03d}"
+        tables["devices"].append({"device_id": device_id, "subject_id": subject_id})
+        tables["subjects"].append({
+            "subject_id": subject_id,
+            "name": f"Subject {index}",
+            "age": rng.choice([3, 5, 8, 12, 35]),
+            "gender": rng.choice(["男性", "女性"]),
+            "notes": "ベンチマーク用の合成データ"
+        })
+
+        for day in dates:
+            for block_index, time_block in enumerate(time_blocks()):
+                transcription = "" if block_index < 12 else "今日は公園で遊んだよ。" * rng.randint(1, 20)
+                tables["audio_features"].append({
+                    "device_id": device_id,
+                    "date": day,
+                    "time_block": time_block,
+                    "vibe_transcriber_result": transcription,
+                    "behavior_extractor_result": {
+                        "events": [
+                            {"label": rng.choice(SED_LABELS), "prob": round(rng.random(), 3)}
+                            for _ in range(sed_events)
+                        ],
+                        "model": "yamnet"
+                    },
+                    "emotion_extractor_result": {
+                        "selected_features_timeline": [
+                            {
+                                "timestamp": f"00:{second // 60:02d}:{second % 60:02d}",
+                                "features": {
+                                    "Loudness_sma3": round(rng.random(), 4),
+                                    "jitterLocal_sma3nz": 0.0 if rng.random() < 0.4 else round(rng.random() * 0.05, 4)
+                                }
+                            }
+                            for second in range(opensmile_seconds)
+                        ],
+                        "model": "opensmile"
+                    }
+                })
+                tables["vibe_whisper"].append({
+                    "device_id": device_id,
+                    "date": day,
+                    "time_block": time_block,
+                    "transcription": transcription
+                })
+                tables["dashboard"].append({
+                    "device_id": device_id,
+                    "date": day,
+                    "time_block": time_block,
+                    "summary": f"{time_block}の様子の要約（合成データ）",
+                    "vibe_score": rng.randint(-100, 100),
+                    "status": "completed",
+                    "behavior": "遊び",
+                    # 日次サマリーでは使わない大きいカラム
+                    "prompt": "プロンプト本文" * 300,
+                    "analysis_result": {"raw": "分析結果" * 200},
+                    "updated_at": f"{day}T{time_block.replace('-', ':')}:00+00:00"
+                })
+
+    return tables
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-End Benchmarks
+=====================
+Fake PostgREST（benchmarks/fake_postgrest.py）に向けてFastAPIアプリを起動し、
+主要エンドポイントのレイテンシ・スループット・DBラウンドトリップ数を計測する
+
+- アプリはプロセス内で起動し（lifespan込み）、httpx.AsyncClient(app=app) から並行にリクエストする
+- Supabaseクライアントは本物（supabase-py / postgrest-py）を使い、HTTPでFake PostgRESTに接続する
+- シナリオごとにキャッシュ（プロンプト・観測対象者）と計測値をリセットする
+- 結果はJSONレポートに出力する（前回のレポートと比較して回帰を検出する用途）
+- QUERY_STATS_HEADERS を有効にしてリクエストごとのクエリ数をレスポンスヘッダーから取得し、
+  シナリオごとのクエリ数の上限（QUERY_BUDGETS）を超えたリクエストがあれば終了コード1で終了する
+
+使い方:
+    python benchmarks/run_benchmarks.py --requests 200 --concurrency 16 --latency-ms 5
+    python benchmarks/run_benchmarks.py --scenario timeblock_prompt --output /tmp/report.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from itertools import cycle, product
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCHMARK_DIR.parent))
+sys.path.insert(0, str(BENCHMARK_DIR))
+
+import query_accounting
+from fake_postgrest import FakePostgrestServer, FakePostgrestStore, build_dataset, time_blocks
+
+DEFAULT_OUTPUT = BENCHMARK_DIR / "results" / "latest.json"
+
+# supabase-pyはキーがJWT形式であることを検証するため、ダミーのJWTを使う
+FAKE_SUPABASE_KEY = "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.benchmark"
+
+# シナリオごとの1リクエストあたりのクエリ数の上限（キャッシュが効いていない場合を含む）
+QUERY_BUDGETS = {
+    # audio_features + devices + subjects + audio_aggregator
+    "timeblock_prompt": 4,
+    # dashboard + devices + subjects + dashboard_summary
+    "dashboard_summary": 4,
+    # dashboard_summary（集計値）+ dashboard（差分）+ devices + subjects + dashboard_summary
+    "dashboard_summary_incremental": 5,
+    # vibe_whisper + vibe_whisper_prompt
+    "mood_prompt": 2,
+}
+
+
+def percentile(values: List[float], p: float) -> float:
+    """最近傍法のパーセンタイル（values はソート済み）"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def build_scenarios(devices: List[str], dates: List[str]) -> Dict[str, Callable[[], Tuple[str, str, Dict[str, str]]]]:
+    """シナリオ名 → (method, path, params) を順に返す関数"""
+    blocks = time_blocks()[12:]
+
+    def rotating(path: str, combos):
+        iterator = cycle(list(combos))
+        return lambda: ("GET", path, next(iterator))
+
+    return {
+        "timeblock_prompt": rotating("/generate-timeblock-prompt", (
+            {"device_id": device, "date": date, "time_block": block}
+            for device, date, block in product(devices, dates, blocks)
+        )),
+        "dashboard_summary": rotating("/generate-dashboard-summary", (
+            {"device_id": device, "date": date}
+            for device, date in product(devices, dates)
+        )),
+        "dashboard_summary_incremental": rotating("/generate-dashboard-summary", (
+            {"device_id": device, "date": date, "incremental": "true"}
+            for device, date in product(devices, dates)
+        )),
+        "mood_prompt": rotating("/generate-mood-prompt-supabase", (
+            {"device_id": device, "date": date}
+            for device, date in product(devices, dates)
+        )),
+    }
+
+
+def reset_app_caches():
+    """シナリオ間で結果が混ざらないようにアプリ内のキャッシュをクリア"""
+    import prompt_cache
+    import timeblock_endpoint
+
+    prompt_cache.prompt_cache.invalidate()
+    prompt_cache.written_prompts.invalidate()
+    timeblock_endpoint.subject_cache.invalidate()
+
+
+async def wait_until_ready(client, timeout: float = 60.0) -> Dict[str, Any]:
+    """/ready が200を返す（ウォームアップが完了する）まで待ち、ウォームアップの結果を返す"""
+    deadline = time.perf_counter() + timeout
+    while True:
+        response = await client.get("/ready")
+        if response.status_code == 200:
+            return response.json()
+        if time.perf_counter() > deadline:
+            raise RuntimeError(f"App did not become ready: {response.text}")
+        await asyncio.sleep(0.05)
+
+
+async def run_scenario(client, store: FakePostgrestStore, next_request, requests: int,
+                       concurrency: int, warmup: int, query_budget: int) -> Dict[str, Any]:
+    """1シナリオを実行して集計結果を返す"""
+    for _ in range(warmup):
+        method, path, params = next_request()
+        await client.request(method, path, params=params)
+
+    store.reset_stats()
+    latencies: List[float] = []
+    status_counts: Dict[str, int] = {}
+    queries_per_request: List[int] = []
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            method, path, params = next_request()
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, params=params)
+                status = str(response.status_code)
+                queries_per_request.append(int(response.headers.get(query_accounting.HEADER_QUERIES, 0)))
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            status_counts[status] = status_counts.get(status, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    db_stats = store.stats()
+    round_trips = sum(db_stats["round_trips"].values())
+    errors = sum(count for status, count in status_counts.items() if not status.startswith("2"))
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "duration_seconds": round(elapsed, 4),
+        "throughput_rps": round(requests / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "mean": round(statistics.fmean(latencies) * 1000, 3),
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p90": round(percentile(latencies, 90) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3),
+        },
+        "db": {
+            "round_trips_per_request": round(round_trips / requests, 3),
+            "bytes_sent_per_request": round(db_stats["bytes_sent"] / requests, 1),
+            "bytes_received_per_request": round(db_stats["bytes_received"] / requests, 1),
+            "round_trips": db_stats["round_trips"],
+            "max_queries_per_request": max(queries_per_request, default=0),
+            "query_budget": query_budget,
+            "over_budget_requests": sum(1 for queries in queries_per_request if queries > query_budget),
+        },
+        "status_counts": status_counts,
+        "errors": errors,
+    }
+
+
+async def run(args) -> Dict[str, Any]:
+    tables = build_dataset(devices=args.devices, days=args.days, seed=args.seed)
+    store = FakePostgrestStore(tables, latency_ms=args.latency_ms)
+    devices = [row["device_id"] for row in tables["devices"]]
+    dates = sorted({row["date"] for row in tables["audio_features"]})
+
+    with FakePostgrestServer(store) as server:
+        os.environ["SUPABASE_URL"] = server.url
+        os.environ["SUPABASE_KEY"] = FAKE_SUPABASE_KEY
+        os.environ["QUERY_STATS_HEADERS"] = "true"
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+        import httpx
+        from main import app
+
+        scenarios = build_scenarios(devices, dates)
+        selected = args.scenario or list(scenarios)
+        results = {}
+
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(app=app, base_url="http://benchmark", timeout=60.0) as client:
+                warmup_report = await wait_until_ready(client)
+                for name in selected:
+                    reset_app_caches()
+                    results[name] = await run_scenario(
+                        client, store, scenarios[name], args.requests, args.concurrency, args.warmup,
+                        QUERY_BUDGETS[name]
+                    )
+                    summary = results[name]
+                    print(
+                        f"{name:32s} p50={summary['latency_ms']['p50']:8.2f}ms "
+                        f"p99={summary['latency_ms']['p99']:8.2f}ms "
+                        f"rps={summary['throughput_rps']:8.1f} "
+                        f"db_rt/req={summary['db']['round_trips_per_request']:6.2f} "
+                        f"max_q={summary['db']['max_queries_per_request']}/{summary['db']['query_budget']} "
+                        f"errors={summary['errors']}"
+                    )
+
+    return {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "warmup": args.warmup,
+            "latency_ms": args.latency_ms,
+            "devices": args.devices,
+            "days": args.days,
+            "seed": args.seed,
+        },
+        "warmup": warmup_report,
+        "scenarios": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Vibe Aggregator API end-to-end benchmarks")
+    parser.add_argument("--requests", type=int, default=200, help="シナリオごとのリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時リクエスト数")
+    parser.add_argument("--warmup", type=int, default=5, help="計測前のウォームアップリクエスト数")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="Fake PostgRESTの1リクエストあたりの遅延（ミリ秒）")
+    parser.add_argument("--devices", type=int, default=4, help="合成データのデバイス数")
+    parser.add_argument("--days", type=int, default=2, help="合成データの日数")
+    parser.add_argument("--seed", type=int, default=0, help="合成データの乱数シード")
+    parser.add_argument("--scenario", action="append", help="実行するシナリオ（複数指定可、省略時は全て）")
+    parser.add_argument("--output", type=Path, default=DEFAULT_OUTPUT, help="JSONレポートの出力先")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"📄 Report written to {args.output}")
+
+    over_budget = [
+        name for name, summary in report["scenarios"].items() if summary["db"]["over_budget_requests"] > 0
+    ]
+    if over_budget:
+        print(f"❌ Query budget exceeded: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
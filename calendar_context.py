@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Calendar Context
+================
+日付ごとの曜日・祝日・連休・季節情報を提供するモジュール
+
+起動時に対象年の範囲について全日分を事前計算しておき（CalendarIndex）、
+リクエスト時は "YYYY-MM-DD" をキーにO(1)で引く。
+範囲外の日付や不正な形式の文字列は従来どおりその場で計算する。
+jpholiday のインポートは重いため、最初の計算時（または起動時のウォームアップ）まで遅らせる。
+"""
+
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+import structured_logging
+
+
+logger = structured_logging.get_logger(__name__)
+
+
+WEEKDAYS_JA = ["月曜日", "火曜日", "水曜日", "木曜日", "金曜日", "土曜日", "日曜日"]
+
+# 月 → 季節（日本の季節）
+SEASONS_BY_MONTH = {
+    3: "春", 4: "春", 5: "春",
+    6: "夏", 7: "夏", 8: "夏",
+    9: "秋", 10: "秋", 11: "秋",
+}
+
+
+def get_season(month: int) -> str:
+    """月から季節を判定（日本の季節）"""
+    return SEASONS_BY_MONTH.get(month, "冬")
+
+
+def compute_weekday_info(date_str: str) -> Dict[str, Any]:
+    """日付文字列から曜日情報を計算（インデックスを使わない）"""
+    try:
+        date_obj = datetime.strptime(date_str, "%Y-%m-%d")
+
+        # 曜日名（日本語）
+        weekday_ja = WEEKDAYS_JA[date_obj.weekday()]
+
+        # 週末判定
+        is_weekend = date_obj.weekday() >= 5  # 土曜日(5)または日曜日(6)
+
+        return {
+            "weekday": weekday_ja,
+            "is_weekend": is_weekend,
+            "day_type": "週末" if is_weekend else "平日"
+        }
+    except (ValueError, TypeError):
+        return {
+            "weekday": "不明",
+            "is_weekend": None,
+            "day_type": "不明"
+        }
+
+
+def _consecutive_context(is_holiday: bool, is_weekend_current: bool,
+                         holiday_before: Optional[str], is_weekend_before: bool,
+                         holiday_after: Optional[str], is_weekend_after: bool) -> str:
+    """前後の日の祝日・週末情報から連休のコンテキストを生成"""
+    if (holiday_before or is_weekend_before) and (holiday_after or is_weekend_after):
+        return "3連休の中日"
+    elif holiday_after or is_weekend_after:
+        return "連休初日"
+    elif holiday_before or is_weekend_before:
+        return "連休最終日"
+    elif is_holiday:
+        return "祝日"
+    elif is_weekend_current:
+        return "週末"
+    return ""
+
+
+def compute_holiday_context(date: str) -> Dict[str, Any]:
+    """
+    指定日の祝日・連休情報を計算（インデックスを使わない）
+
+    Args:
+        date: 日付 (YYYY-MM-DD形式)
+
+    Returns:
+        祝日情報と連休コンテキストを含む辞書
+    """
+    try:
+        import jpholiday
+
+        date_obj = datetime.strptime(date, "%Y-%m-%d")
+
+        # 祝日判定
+        holiday_name = jpholiday.is_holiday_name(date_obj)
+
+        # 前後の日付を確認して連休判定
+        day_before = date_obj - timedelta(days=1)
+        day_after = date_obj + timedelta(days=1)
+
+        return {
+            "is_holiday": holiday_name is not None,
+            "holiday_name": holiday_name,
+            "consecutive_context": _consecutive_context(
+                holiday_name is not None, date_obj.weekday() >= 5,
+                jpholiday.is_holiday_name(day_before), day_before.weekday() >= 5,
+                jpholiday.is_holiday_name(day_after), day_after.weekday() >= 5
+            ),
+            "is_weekend": date_obj.weekday() >= 5
+        }
+    except Exception as e:
+        logger.warning("祝日情報の取得に失敗: %s", e)
+        return {
+            "is_holiday": False,
+            "holiday_name": None,
+            "consecutive_context": "",
+            "is_weekend": False
+        }
+
+
+class CalendarIndex:
+    """日付キー（YYYY-MM-DD）→ 曜日・祝日・季節情報の事前計算インデックス"""
+
+    def __init__(self):
+        self._weekday_info: Dict[str, Dict[str, Any]] = {}
+        self._holiday_context: Dict[str, Dict[str, Any]] = {}
+        self.start_year: Optional[int] = None
+        self.end_year: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self._weekday_info)
+
+    def build(self, start_year: int, end_year: int):
+        """start_year〜end_year（両端を含む）の全日を事前計算"""
+        import jpholiday
+
+        first = datetime(start_year, 1, 1)
+        last = datetime(end_year, 12, 31)
+
+        # 祝日名は前後1日を含めて1日1回だけ判定する
+        holiday_names = {}
+        day = first - timedelta(days=1)
+        while day <= last + timedelta(days=1):
+            holiday_names[day] = jpholiday.is_holiday_name(day)
+            day += timedelta(days=1)
+
+        weekday_info = {}
+        holiday_context = {}
+        day = first
+        while day <= last:
+            key = day.strftime("%Y-%m-%d")
+            day_before = day - timedelta(days=1)
+            day_after = day + timedelta(days=1)
+            is_weekend = day.weekday() >= 5
+            holiday_name = holiday_names[day]
+
+            weekday_info[key] = {
+                "weekday": WEEKDAYS_JA[day.weekday()],
+                "is_weekend": is_weekend,
+                "day_type": "週末" if is_weekend else "平日"
+            }
+            holiday_context[key] = {
+                "is_holiday": holiday_name is not None,
+                "holiday_name": holiday_name,
+                "consecutive_context": _consecutive_context(
+                    holiday_name is not None, is_weekend,
+                    holiday_names[day_before], day_before.weekday() >= 5,
+                    holiday_names[day_after], day_after.weekday() >= 5
+                ),
+                "is_weekend": is_weekend
+            }
+            day = day_after
+
+        self._weekday_info = weekday_info
+        self._holiday_context = holiday_context
+        self.start_year = start_year
+        self.end_year = end_year
+
+    def weekday_info(self, date_str: str) -> Optional[Dict[str, Any]]:
+        entry = self._weekday_info.get(date_str)
+        return dict(entry) if entry is not None else None
+
+    def holiday_context(self, date_str: str) -> Optional[Dict[str, Any]]:
+        entry = self._holiday_context.get(date_str)
+        return dict(entry) if entry is not None else None
+
+
+# アプリケーション全体で共有するインデックス
+calendar_index = CalendarIndex()
+
+
+def build_calendar_index(start_year: Optional[int] = None, end_year: Optional[int] = None) -> CalendarIndex:
+    """
+    共有インデックスを構築
+    範囲は引数 → 環境変数（CALENDAR_INDEX_START_YEAR / CALENDAR_INDEX_END_YEAR）→ 今年±1年 の順で決定
+    """
+    this_year = datetime.now().year
+    if start_year is None:
+        start_year = int(os.getenv("CALENDAR_INDEX_START_YEAR", str(this_year - 1)))
+    if end_year is None:
+        end_year = int(os.getenv("CALENDAR_INDEX_END_YEAR", str(this_year + 1)))
+
+    calendar_index.build(start_year, end_year)
+    logger.info("✅ Calendar index built", extra={"start_year": start_year, "end_year": end_year, "days": len(calendar_index)})
+    return calendar_index
+
+
+def get_weekday_info(date_str: str) -> Dict[str, Any]:
+    """日付文字列から曜日情報を取得"""
+    info = calendar_index.weekday_info(date_str)
+    if info is not None:
+        return info
+    return compute_weekday_info(date_str)
+
+
+def get_holiday_context(date: str) -> Dict[str, Any]:
+    """
+    指定日の祝日・連休情報を取得
+
+    Returns:
+        is_holiday, holiday_name, consecutive_context, is_weekend を含む辞書
+    """
+    context = calendar_index.holiday_context(date)
+    if context is not None:
+        return context
+    return compute_holiday_context(date)
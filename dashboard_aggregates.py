@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Dashboard Summary Aggregates
+============================
+dashboardテーブルのタイムブロック結果（summary / vibe_score）から
+dashboard_summary用の集計（vibe_scores配列・統計・タイムライン）を作るモジュール
+
+集計値は dashboard_summary.aggregates（JSONB）に保存できる形で保持し、
+インクリメンタルモードでは前回以降に追加・更新されたブロックだけを反映する。
+"""
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+
+
+# 保存形式のバージョン（形式を変えた場合は上げる。一致しない場合はフル再集計）
+AGGREGATES_VERSION = 1
+
+# タイムブロック → vibe_scores配列のインデックス（00-00 → 0 ... 23-30 → 47）
+TIME_BLOCK_TO_INDEX = {
+    f"{hour:02d}-{minute}": hour * 2 + minute_idx
+    for hour in range(24)
+    for minute_idx, minute in enumerate(["00", "30"])
+}
+
+
+def empty_aggregates() -> Dict[str, Any]:
+    """空の集計値"""
+    return {
+        "version": AGGREGATES_VERSION,
+        "blocks": {},
+        # vibe_scores配列に配置されたスコアの合計・件数（average_vibe用）
+        "vibe_score_sum": 0,
+        "vibe_score_count": 0,
+        # スコアのある全ブロックの合計・件数（statistics.avg_vibe_score用）
+        "total_vibe_score": 0,
+        "valid_score_count": 0,
+        "positive_blocks": 0,
+        "negative_blocks": 0,
+        "neutral_blocks": 0,
+        "last_time_block": None,
+        # 取り込み済みブロックの最大updated_at（以降に更新されたブロックを再取得するため）
+        "watermark": None
+    }
+
+
+def is_valid_aggregates(aggregates: Any) -> bool:
+    """保存済みの集計値がこのバージョンで利用できるか"""
+    return isinstance(aggregates, dict) and aggregates.get("version") == AGGREGATES_VERSION
+
+
+def _add_score(aggregates: Dict[str, Any], time_block: str, vibe_score: Optional[float], sign: int):
+    """1ブロック分のスコアを集計値に加算（sign=-1で減算）"""
+    if vibe_score is None:
+        return
+
+    if time_block in TIME_BLOCK_TO_INDEX:
+        aggregates["vibe_score_sum"] += sign * vibe_score
+        aggregates["vibe_score_count"] += sign
+
+    aggregates["total_vibe_score"] += sign * vibe_score
+    aggregates["valid_score_count"] += sign
+
+    if vibe_score > 20:
+        aggregates["positive_blocks"] += sign
+    elif vibe_score < -20:
+        aggregates["negative_blocks"] += sign
+    else:
+        aggregates["neutral_blocks"] += sign
+
+
+def apply_blocks(aggregates: Dict[str, Any], rows: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    dashboardの行を集計値に反映する
+    既に取り込み済みのタイムブロックは差し替え（古いスコアを差し引いてから加算）、
+    status が 'completed' でなくなった行は集計から取り除く
+    """
+    blocks = aggregates["blocks"]
+
+    for row in rows:
+        time_block = row["time_block"]
+        status = row.get("status", "completed")
+
+        previous = blocks.pop(time_block, None)
+        if previous is not None:
+            _add_score(aggregates, time_block, previous["vibe_score"], -1)
+
+        updated_at = row.get("updated_at")
+        if updated_at and (aggregates["watermark"] is None or updated_at > aggregates["watermark"]):
+            aggregates["watermark"] = updated_at
+
+        if status != "completed":
+            continue
+
+        blocks[time_block] = {
+            # NULLの場合は空文字列に変換
+            "summary": row.get("summary") or "",
+            "vibe_score": row.get("vibe_score")
+        }
+        _add_score(aggregates, time_block, row.get("vibe_score"), 1)
+
+    aggregates["last_time_block"] = max(blocks) if blocks else None
+    return aggregates
+
+
+def build_aggregates(rows: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """dashboardの行から集計値を新規に作成"""
+    return apply_blocks(empty_aggregates(), rows)
+
+
+def watermark_with_overlap(watermark: str, overlap_seconds: float) -> str:
+    """
+    差分取得に使うwatermarkを overlap_seconds だけ過去にずらす
+    updated_atは書き込んだ各プロセスの時計で付くため、時計のずれや書き込みの遅延で
+    watermarkより古いupdated_atの行が後から現れても取りこぼさないようにする
+    （重複して取得した行はタイムブロック単位で差し替えられるため集計には影響しない）
+    """
+    try:
+        parsed = datetime.fromisoformat(watermark)
+    except ValueError:
+        return watermark
+    return (parsed - timedelta(seconds=overlap_seconds)).isoformat()
+
+
+def processed_count(aggregates: Dict[str, Any]) -> int:
+    return len(aggregates["blocks"])
+
+
+def vibe_scores_array(aggregates: Dict[str, Any]) -> List[Optional[float]]:
+    """グラフ描画用の48要素の配列（データのないブロックはnull）"""
+    scores: List[Optional[float]] = [None] * 48
+    for time_block, block in aggregates["blocks"].items():
+        if time_block in TIME_BLOCK_TO_INDEX and block["vibe_score"] is not None:
+            scores[TIME_BLOCK_TO_INDEX[time_block]] = block["vibe_score"]
+    return scores
+
+
+def average_vibe(aggregates: Dict[str, Any]) -> Optional[float]:
+    """vibe_scores配列の平均値（nullを除外）"""
+    count = aggregates["vibe_score_count"]
+    return aggregates["vibe_score_sum"] / count if count > 0 else None
+
+
+def timeline(aggregates: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """時系列順のタイムライン（summaryとvibe_scoreのみ）"""
+    return [
+        {
+            "time_block": time_block,
+            "summary": aggregates["blocks"][time_block]["summary"],
+            "vibe_score": aggregates["blocks"][time_block]["vibe_score"]
+        }
+        for time_block in sorted(aggregates["blocks"])
+    ]
+
+
+def statistics(aggregates: Dict[str, Any]) -> Dict[str, Any]:
+    """統計情報（プロンプト・レスポンス用）"""
+    count = aggregates["valid_score_count"]
+    return {
+        "avg_vibe_score": aggregates["total_vibe_score"] / count if count > 0 else None,
+        "positive_blocks": aggregates["positive_blocks"],
+        "negative_blocks": aggregates["negative_blocks"],
+        "neutral_blocks": aggregates["neutral_blocks"],
+        "valid_score_count": count
+    }
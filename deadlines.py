@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Request Deadlines
+=================
+リクエストごとの処理時間の上限（deadline）を保持し、Supabase呼び出しに引き継ぐモジュール
+
+- ミドルウェアがリクエスト開始時に deadline を設定する
+  （REQUEST_DEADLINE_SECONDS、バッチ・ダッシュボードサマリーは REQUEST_DEADLINE_LONG_SECONDS。
+  リクエストヘッダー X-Request-Timeout（秒）で上書き可能）
+- AsyncSupabaseClient.execute は残り時間をHTTPタイムアウトとして使い、残り時間がなくなった呼び出しは
+  DeadlineExceeded（HTTP 504）で打ち切る
+- 残り時間はcontextvarsで保持するため、同じリクエスト内の並行処理にも同じ deadline が適用される
+
+使い方:
+    with deadlines.deadline(10.0):
+        result = await supabase.execute(...)
+"""
+
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from fastapi import HTTPException
+
+
+DEFAULT_REQUEST_DEADLINE_SECONDS = 30.0
+# nginxのタイムアウト（180秒）より短くする
+DEFAULT_MAX_REQUEST_DEADLINE_SECONDS = 170.0
+DEFAULT_LONG_REQUEST_DEADLINE_SECONDS = 170.0
+
+TIMEOUT_HEADER = "x-request-timeout"
+
+# deadlineを適用しないパス（進捗をストリーミングする長時間の処理）
+EXEMPT_PATHS = ("/backfill-timeblock-prompts",)
+
+# 件数・データ量に比例して時間がかかるため REQUEST_DEADLINE_LONG_SECONDS を適用するパス
+# （最大200件のバッチ、1日分のdashboardを集計するサマリー）
+LONG_PATHS = ("/generate-timeblock-prompts", "/generate-dashboard-summary")
+
+_deadline_at: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline_at", default=None)
+
+
+class DeadlineExceeded(HTTPException):
+    """リクエストの処理時間の上限を超えた（504 Gateway Timeout として返す）"""
+
+    def __init__(self, stage: str = ""):
+        detail = "処理時間の上限を超えたため処理を中断しました"
+        if stage:
+            detail += f"（{stage}）"
+        super().__init__(status_code=504, detail=detail)
+
+
+def default_budget(path: str = "") -> Optional[float]:
+    """
+    パスに適用するデフォルトの上限（0以下の場合はdeadlineなし）
+    LONG_PATHS は REQUEST_DEADLINE_LONG_SECONDS、それ以外は REQUEST_DEADLINE_SECONDS
+    """
+    if path.endswith(LONG_PATHS):
+        seconds = float(os.getenv("REQUEST_DEADLINE_LONG_SECONDS", str(DEFAULT_LONG_REQUEST_DEADLINE_SECONDS)))
+    else:
+        seconds = float(os.getenv("REQUEST_DEADLINE_SECONDS", str(DEFAULT_REQUEST_DEADLINE_SECONDS)))
+    return seconds if seconds > 0 else None
+
+
+def budget_for_request(path: str, header_value: Optional[str]) -> Optional[float]:
+    """リクエストに適用する処理時間の上限（秒、Noneの場合はdeadlineなし）"""
+    if path.endswith(EXEMPT_PATHS):
+        return None
+    budget = default_budget(path)
+    if header_value:
+        try:
+            budget = float(header_value)
+        except ValueError:
+            pass
+    if budget is None or budget <= 0:
+        return None
+    return min(budget, float(os.getenv("REQUEST_DEADLINE_MAX_SECONDS", str(DEFAULT_MAX_REQUEST_DEADLINE_SECONDS))))
+
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[None]:
+    """ブロック内の処理に seconds 秒後の deadline を設定する（Noneの場合はdeadlineなし）"""
+    token = _deadline_at.set(time.monotonic() + seconds if seconds is not None else None)
+    try:
+        yield
+    finally:
+        _deadline_at.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """deadlineまでの残り秒数（deadlineがない場合はNone、超過している場合は0以下）"""
+    deadline_at = _deadline_at.get()
+    return deadline_at - time.monotonic() if deadline_at is not None else None
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
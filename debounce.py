@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Debounce
+========
+同じキーへの要求が短時間に続いた場合に、最後の要求から一定時間（window）待ってから1回だけ実行するモジュール
+
+バックログの消化などで同じデバイス・日付のブロックが続けて完了すると、そのたびに
+/generate-dashboard-summary が1日分を読み直して dashboard_summary を書き直す。
+debounceを使うと、window 内に届いた要求をまとめて1回の再生成にする。
+
+- 要求のたびに実行予定を window 秒後に延ばす（最初の要求から max_wait 秒を超えては延ばさない）
+- 実行が始まった後に届いた要求は次の実行にまとめる（実行中のデータの変更を取りこぼさない）。
+  次の実行は同じキーの実行が終わってから始め、古い結果で上書きしないようにする
+  （run は single-flight 等で実行中の処理に相乗りせず、必ずデータを読み直すこと）
+- 呼び出し側は結果を待つ（future を await）か、受付だけ返すかを選べる
+- 終了時（flush）は待機中の要求を即座に実行する
+
+使い方:
+    pending = dashboard_summary_debouncer.submit((device_id, date), lambda: build(device_id, date))
+    result = await asyncio.shield(pending.future)
+"""
+
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+import metrics
+import structured_logging
+
+
+logger = structured_logging.get_logger(__name__)
+
+
+DEFAULT_WINDOW_SECONDS = 5.0
+DEFAULT_MAX_WAIT_SECONDS = 30.0
+
+
+class PendingRun:
+    """実行待ちの1キー分の要求（同じキーの要求は同じ future を共有する）"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, run: Callable[[], Awaitable[Any]]):
+        self.future: asyncio.Future = loop.create_future()
+        self.run = run
+        self.first_requested_at = time.monotonic()
+        self.scheduled_at = self.first_requested_at
+        self.requests = 0
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+    def seconds_until_run(self) -> float:
+        return max(0.0, self.scheduled_at - time.monotonic())
+
+
+class Debouncer:
+    """キーごとに実行待ちの要求をまとめ、window 秒間新しい要求がなければ実行する"""
+
+    def __init__(self, name: str, window: float = DEFAULT_WINDOW_SECONDS, max_wait: float = DEFAULT_MAX_WAIT_SECONDS):
+        self.name = name
+        self.window = window
+        self.max_wait = max_wait
+        self._pending: Dict[Hashable, PendingRun] = {}
+        self._running: Dict[asyncio.Task, PendingRun] = {}
+        # キーごとの最後に開始した実行（次の実行はこの完了を待ってから始める）
+        self._last_run: Dict[Hashable, asyncio.Task] = {}
+        self.submitted = 0
+        self.runs = 0
+
+    def submit(self, key: Hashable, run: Callable[[], Awaitable[Any]]) -> PendingRun:
+        """
+        要求を登録して実行待ちの PendingRun を返す（同じキーが実行待ちならまとめる）
+        まとめた場合は最後に登録された run を実行する
+        """
+        loop = asyncio.get_running_loop()
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = PendingRun(loop, run)
+            self._pending[key] = pending
+        else:
+            pending.run = run
+            pending.handle.cancel()
+            metrics.DEBOUNCE_COLLAPSED.labels(name=self.name).inc()
+
+        pending.requests += 1
+        self.submitted += 1
+        now = time.monotonic()
+        pending.scheduled_at = min(now + self.window, pending.first_requested_at + self.max_wait)
+        pending.handle = loop.call_later(max(0.0, pending.scheduled_at - now), self._fire, key)
+        return pending
+
+    def _fire(self, key: Hashable):
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        self.runs += 1
+        logger.info("⏱️ Debounced run started", extra={
+            "debounce": self.name,
+            "key": list(key) if isinstance(key, tuple) else key,
+            "collapsed_requests": pending.requests
+        })
+        task = asyncio.create_task(self._run_after(self._last_run.get(key), pending.run))
+        self._running[task] = pending
+        self._last_run[key] = task
+        task.add_done_callback(self._finish)
+        task.add_done_callback(lambda done, key=key: self._forget_run(key, done))
+
+    @staticmethod
+    async def _run_after(previous: Optional[asyncio.Task], run: Callable[[], Awaitable[Any]]) -> Any:
+        """同じキーの前の実行が終わるのを待ってから run を実行する（前の実行の成否は問わない）"""
+        if previous is not None and not previous.done():
+            await asyncio.wait([previous])
+        return await run()
+
+    def _forget_run(self, key: Hashable, task: asyncio.Task):
+        if self._last_run.get(key) is task:
+            del self._last_run[key]
+
+    def _finish(self, task: asyncio.Task):
+        pending = self._running.pop(task)
+        if pending.future.done():
+            return
+        if task.cancelled():
+            pending.future.cancel()
+        elif task.exception() is not None:
+            logger.warning("⚠️ Debounced run failed: %s", task.exception(), extra={"debounce": self.name})
+            pending.future.set_exception(task.exception())
+            # 受付のみ（結果を待つ呼び出し側がいない）の場合でも警告を出さないよう、ここで取得済みにする
+            pending.future.exception()
+        else:
+            pending.future.set_result(task.result())
+
+    async def flush(self):
+        """実行待ちの要求を即座に実行し、実行中のものを含めて完了まで待つ"""
+        for key in list(self._pending):
+            self._pending[key].handle.cancel()
+            self._fire(key)
+        futures = [pending.future for pending in self._running.values()]
+        if futures:
+            await asyncio.gather(*futures, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "running": len(self._running),
+            "submitted": self.submitted,
+            "runs": self.runs,
+            "window_seconds": self.window,
+            "max_wait_seconds": self.max_wait
+        }
+
+
+# /generate-dashboard-summary?debounce=true: (device_id, date)
+dashboard_summary_debouncer = Debouncer(
+    "dashboard_summary",
+    window=float(os.getenv("DASHBOARD_SUMMARY_DEBOUNCE_SECONDS", str(DEFAULT_WINDOW_SECONDS))),
+    max_wait=float(os.getenv("DASHBOARD_SUMMARY_DEBOUNCE_MAX_WAIT_SECONDS", str(DEFAULT_MAX_WAIT_SECONDS)))
+)
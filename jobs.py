@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Async Jobs
+==========
+リクエストを待たせずに処理するための、プロセス内のジョブキューとワーカー
+
+/generate-timeblock-prompt・/generate-dashboard-summary は取得・生成・保存が終わるまで接続を保持するため、
+呼び出し側（Lambda）の同時実行数を消費する。async=true を指定すると処理をキューに積んで
+すぐに202とジョブIDを返し、結果は GET /jobs/{job_id} で取得する。
+
+- キューの長さは JOB_QUEUE_MAX_SIZE まで（満杯の場合は503で受け付けない）
+- JOB_WORKERS 個のワーカーが順に処理する（ジョブごとに、受け付けたパスの上限で改めて deadline を設定する）
+- 完了したジョブの結果は JOB_RESULT_TTL_SECONDS の間保持する
+- キューはプロセス内のため、再起動時に未処理のジョブは失われる（終了時は一定時間処理を待つ）
+
+使い方:
+    job = job_queue.submit("timeblock_prompt", {"device_id": ...}, lambda: process(...))
+    job_queue.get(job.id).to_dict()
+"""
+
+import asyncio
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+
+import deadlines
+import metrics
+import structured_logging
+from ttl_cache import TTLCache, MISSING
+
+
+logger = structured_logging.get_logger(__name__)
+
+
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_MAX_SIZE = 100
+DEFAULT_RESULT_TTL_SECONDS = 600.0
+DEFAULT_RESULT_MAX_SIZE = 1000
+DEFAULT_SHUTDOWN_TIMEOUT_SECONDS = 10.0
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class Job:
+    """キューに積まれた1件の処理と、その状態・結果"""
+
+    def __init__(self, kind: str, params: Dict[str, Any], run: Callable[[], Awaitable[Any]], budget: Optional[float]):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.run = run
+        self.budget = budget
+        self.status = QUEUED
+        self.created_at = _now()
+        self.started_at: Optional[str] = None
+        self.finished_at: Optional[str] = None
+        self.enqueued = time.perf_counter()
+        self.result: Any = None
+        self.error: Optional[Dict[str, Any]] = None
+        # ジョブのログを受け付けたリクエストのログと紐付ける
+        self.request_id = structured_logging.request_id_var.get()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "params": self.params,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error
+        }
+
+
+class JobQueue:
+    """有界キュー（asyncio.Queue）と固定数のワーカーによるジョブ実行"""
+
+    def __init__(self, name: str, workers: int = DEFAULT_WORKERS, max_queue_size: int = DEFAULT_QUEUE_MAX_SIZE,
+                 result_ttl: float = DEFAULT_RESULT_TTL_SECONDS, result_max_size: int = DEFAULT_RESULT_MAX_SIZE):
+        self.name = name
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        # 未完了のジョブは追い出されないよう、完了したものだけをTTLキャッシュに移す
+        self._active: Dict[str, Job] = {}
+        self._finished = TTLCache(ttl_seconds=result_ttl, max_size=result_max_size)
+        self.submitted = 0
+        self.rejected = 0
+        metrics.JOB_QUEUE_DEPTH.labels(queue=name).set_function(self.depth)
+        metrics.JOBS_RUNNING.labels(queue=name).set_function(self.running)
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def running(self) -> int:
+        return sum(1 for job in self._active.values() if job.status == RUNNING)
+
+    def start(self):
+        """ワーカーを起動（イベントループ上で呼ぶ）"""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info("🧵 Job workers started", extra={"queue": self.name, "workers": self.workers, "max_queue_size": self.max_queue_size})
+
+    async def stop(self, timeout: float = DEFAULT_SHUTDOWN_TIMEOUT_SECONDS):
+        """キューに残ったジョブを timeout 秒まで待ってからワーカーを停止する"""
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("⚠️ Job queue not drained before shutdown", extra={"queue": self.name, "remaining": self.depth()})
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+
+    def submit(self, kind: str, params: Dict[str, Any], run: Callable[[], Awaitable[Any]],
+               budget: Optional[float] = None) -> Job:
+        """
+        ジョブをキューに積んで返す
+        budget: 実行時の処理時間の上限（秒、省略時は REQUEST_DEADLINE_SECONDS）
+
+        Raises:
+            HTTPException: キューが満杯（503）またはワーカーが起動していない（503）
+        """
+        if self._queue is None:
+            raise HTTPException(status_code=503, detail="ジョブを受け付けられません（ワーカーが起動していません）")
+        job = Job(kind, params, run, budget if budget is not None else deadlines.default_budget())
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            metrics.JOBS.labels(kind=kind, outcome="rejected").inc()
+            raise HTTPException(
+                status_code=503,
+                detail=f"ジョブキューが満杯です（最大{self.max_queue_size}件）。しばらくしてから再試行してください。",
+                headers={"Retry-After": "1"}
+            )
+        self._active[job.id] = job
+        self.submitted += 1
+        metrics.JOBS.labels(kind=kind, outcome="queued").inc()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        job = self._active.get(job_id)
+        if job is not None:
+            return job
+        job = self._finished.get(job_id)
+        return None if job is MISSING else job
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        job.status = RUNNING
+        job.started_at = _now()
+        metrics.JOB_WAIT_SECONDS.labels(kind=job.kind).observe(time.perf_counter() - job.enqueued)
+        tokens = structured_logging.bind_request(job.request_id, job.params.get("device_id"))
+        try:
+            # キューで待った時間は含めず、実行開始時点から deadline を設定する
+            with deadlines.deadline(job.budget):
+                job.result = await job.run()
+            job.status = SUCCEEDED
+        except asyncio.CancelledError:
+            job.status = FAILED
+            job.error = {"status_code": 503, "detail": "サーバーの停止によりジョブが中断されました"}
+            raise
+        except HTTPException as e:
+            job.status = FAILED
+            job.error = {"status_code": e.status_code, "detail": e.detail}
+            if isinstance(e, deadlines.DeadlineExceeded):
+                metrics.ERRORS.labels(source="deadline").inc()
+        except Exception as e:
+            logger.exception("❌ Job failed: %s", e, extra={"queue": self.name, "job_id": job.id, "kind": job.kind})
+            job.status = FAILED
+            job.error = {"status_code": 500, "detail": str(e)}
+        finally:
+            job.finished_at = _now()
+            job.run = None
+            self._active.pop(job.id, None)
+            self._finished.set(job.id, job)
+            metrics.JOBS.labels(kind=job.kind, outcome=job.status).inc()
+            structured_logging.reset_request(tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": len(self._workers),
+            "queue_depth": self.depth(),
+            "max_queue_size": self.max_queue_size,
+            "running": self.running(),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "results": self._finished.stats()
+        }
+
+
+# async=true の /generate-timeblock-prompt・/generate-dashboard-summary
+job_queue = JobQueue(
+    "default",
+    workers=int(os.getenv("JOB_WORKERS", str(DEFAULT_WORKERS))),
+    max_queue_size=int(os.getenv("JOB_QUEUE_MAX_SIZE", str(DEFAULT_QUEUE_MAX_SIZE))),
+    result_ttl=float(os.getenv("JOB_RESULT_TTL_SECONDS", str(DEFAULT_RESULT_TTL_SECONDS))),
+    result_max_size=int(os.getenv("JOB_RESULT_MAX_SIZE", str(DEFAULT_RESULT_MAX_SIZE)))
+)
@@ -7,27 +7,81 @@ https://api.hey-watch.me/vibe-aggregator
 Supabase対応版: vibe_whisperテーブルから読み込み、vibe_whisper_promptテーブルに保存
 """
 
+import asyncio
+import importlib
 import os
 import json
+import threading
+import time
 import uvicorn
-from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from datetime import datetime
 from typing import List, Dict, Any, Optional
-import jpholiday
-from fastapi import FastAPI, HTTPException, Query
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Request
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from brotli_asgi import BrotliMiddleware
 
 # .envファイルの読み込み
 load_dotenv()
 
-from supabase import create_client, Client
+from async_supabase import AsyncSupabaseClient
+import metrics
+import query_accounting
+import deadlines
+import debounce
+import jobs
+import readiness
+import single_flight
+import structured_logging
+import write_behind
+from projections import (
+    DASHBOARD_COMPLETED_BLOCKS,
+    DASHBOARD_SUMMARY_AGGREGATES,
+    DASHBOARD_SUMMARY_BLOCKS,
+    VIBE_WHISPER_TRANSCRIPTS,
+    or_filter
+)
+
+logger = structured_logging.get_logger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    起動: 書き込みバッファ・ジョブワーカーを開始し、ウォームアップをバックグラウンドで実行（完了まで /ready は503）
+    終了: ウォームアップを中断し、実行待ちのジョブを処理して書き込みバッファをフラッシュし、Supabase用スレッドプールを停止
+    """
+    readiness.state.reset()
+    if write_behind.is_enabled():
+        # ジャーナルに残った書き込みを再送
+        await write_behind.start(get_supabase_client())
+    jobs.job_queue.start()
+    warmup_task = asyncio.create_task(warmup_application())
+    try:
+        yield
+    finally:
+        warmup_task.cancel()
+        try:
+            await warmup_task
+        except asyncio.CancelledError:
+            pass
+        # キューに残ったジョブ・debounceで実行待ちのサマリー再生成を済ませてから停止
+        await jobs.job_queue.stop(float(os.getenv("JOB_SHUTDOWN_TIMEOUT_SECONDS", str(jobs.DEFAULT_SHUTDOWN_TIMEOUT_SECONDS))))
+        await debounce.dashboard_summary_debouncer.flush()
+        await shutdown_supabase_client()
+
 
 # FastAPIアプリケーションの初期化
 app = FastAPI(
     title="Mood Chart Prompt Generator API",
     description="1日分のトランスクリプションを統合し、ChatGPT分析用プロンプトを生成 (Supabase対応版)",
-    version="2.0.0"
+    version="2.0.0",
+    # orjsonでシリアライズ（日本語を含む数KBのプロンプトを返すため標準のjsonより高速）
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # CORS設定
@@ -39,26 +93,180 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# レスポンス圧縮（Accept-Encodingに応じてbrotli、非対応ならgzip）
+# COMPRESSION_MINIMUM_SIZE バイト未満のレスポンスは圧縮しない
+# バックフィルの進捗ストリーミング（NDJSON）は逐次届くよう圧縮対象から除外する
+app.add_middleware(
+    BrotliMiddleware,
+    quality=int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4")),
+    minimum_size=int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1000")),
+    gzip_fallback=True,
+    excluded_handlers=[r"/backfill-timeblock-prompts$"]
+)
+
+
+@app.middleware("http")
+async def bind_request_context(request: Request, call_next):
+    """リクエストID（X-Request-IDがあれば引き継ぐ）とdevice_idをログのコンテキストに設定"""
+    request_id = request.headers.get("x-request-id") or structured_logging.new_request_id()
+    tokens = structured_logging.bind_request(request_id, request.query_params.get("device_id"))
+    try:
+        response = await call_next(request)
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        structured_logging.reset_request(tokens)
+
+
+@app.middleware("http")
+async def apply_request_deadline(request: Request, call_next):
+    """
+    リクエストの処理時間の上限（REQUEST_DEADLINE_SECONDS、バッチ・ダッシュボードサマリーは
+    REQUEST_DEADLINE_LONG_SECONDS。X-Request-Timeoutヘッダーで上書き可能）を設定
+    Supabase呼び出しは残り時間で打ち切られ、間に合わない場合は504を返す
+    """
+    budget = deadlines.budget_for_request(request.url.path, request.headers.get(deadlines.TIMEOUT_HEADER))
+    with deadlines.deadline(budget):
+        response = await call_next(request)
+    # 504を返すのは DeadlineExceeded のみ（例外の生成・再送出の回数ではなく、返したレスポンスの数を数える）
+    if response.status_code == 504:
+        metrics.ERRORS.labels(source="deadline").inc()
+    return response
+
+
+@app.middleware("http")
+async def attach_query_stats(request: Request, call_next):
+    """QUERY_STATS_HEADERS が有効な場合、リクエストごとのSupabaseクエリ数・送受信バイト数をレスポンスヘッダーに付与（ストリーミングは応答開始まで）"""
+    if not query_accounting.headers_enabled():
+        return await call_next(request)
+    with query_accounting.track() as stats:
+        response = await call_next(request)
+    response.headers.update(stats.headers())
+    return response
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """エンドポイントごとのレイテンシを記録（ラベルはパステンプレート、ストリーミングは応答開始まで）"""
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else metrics.UNMATCHED_ROUTE
+        metrics.observe_http_request(request.method, endpoint, status_code, time.perf_counter() - start)
+
 # Supabaseクライアントの遅延初期化
+# 同期版supabase-pyの呼び出しは AsyncSupabaseClient 経由でスレッドプールに逃がす
 supabase_client = None
+_supabase_client_lock = threading.Lock()
 
-def get_supabase_client():
-    """Supabaseクライアントを遅延初期化して取得"""
+def get_supabase_client() -> AsyncSupabaseClient:
+    """Supabaseクライアント（非同期アクセス用）を遅延初期化して取得"""
     global supabase_client
     if supabase_client is None:
+        with _supabase_client_lock:
+            if supabase_client is None:
+                try:
+                    supabase_client = AsyncSupabaseClient.from_env()
+                    logger.info("✅ Supabase client initialized", extra={"workers": supabase_client.max_workers})
+                except Exception as e:
+                    logger.error("❌ Failed to initialize Supabase client: %s", e)
+                    raise
+    return supabase_client
+
+
+async def shutdown_supabase_client():
+    """アプリケーション終了時に書き込みバッファをフラッシュし、Supabase用スレッドプールを停止"""
+    global supabase_client
+    await write_behind.stop()
+    if supabase_client is not None:
+        supabase_client.shutdown()
+        supabase_client = None
+
+
+# ===============================
+# 起動時のウォームアップ
+# ===============================
+# 起動時（import時）には読み込まず、ウォームアップで読み込む重いモジュール
+WARMUP_IMPORTS = ("supabase", "numpy", "jpholiday")
+
+
+def import_heavy_modules():
+    for module_name in WARMUP_IMPORTS:
+        importlib.import_module(module_name)
+
+
+def validate_supabase_query(client):
+    """疎通確認用の軽いクエリ"""
+    return client.table("devices").select("device_id").limit(1)
+
+
+def prime_prompt_build():
+    """合成データでプロンプトを1回生成し、プロンプト生成のコードパス（NumPy・カレンダー参照など）を温める"""
+    generate_timeblock_prompt_v2(
+        "ウォームアップ",
+        [{"label": "Speech", "prob": 0.9}],
+        "12-00",
+        date=datetime.now().strftime("%Y-%m-%d"),
+        subject_info={"age": 5, "gender": "女性"},
+        opensmile_data=[{"timestamp": "00:00:00", "features": {"Loudness_sma3": 0.5, "jitterLocal_sma3nz": 0.01}}]
+    )
+
+
+async def prime_subject_cache(supabase: AsyncSupabaseClient, device_ids: List[str]):
+    await asyncio.gather(*(get_subject_info(supabase, device_id) for device_id in device_ids))
+
+
+async def warmup_application():
+    """
+    起動時のウォームアップ（完了すると /ready が200を返す）
+    1. 重いモジュール（supabase-py / NumPy / jpholiday）のインポート
+    2. Supabaseクライアントの生成と疎通確認（keep-alive接続を事前に確立）
+    3. 曜日・祝日・季節のインデックスの事前計算
+    4. プロンプト生成のコードパスの実行
+    5. WARMUP_DEVICE_IDS（カンマ区切り）の観測対象者情報をキャッシュに読み込み
+
+    各ステップは失敗時に WARMUP_RETRY_INTERVAL_SECONDS から倍々に（最大 WARMUP_MAX_RETRY_INTERVAL_SECONDS）
+    待って WARMUP_MAX_ATTEMPTS 回まで再試行する。
+    1・2が失敗し続けた場合は failed（503）にした上で WARMUP_MAX_RETRY_INTERVAL_SECONDS ごとに再試行を続け、
+    成功すれば ready に戻る。3〜5は初回リクエストを速くするためのもので、失敗してもリクエストは処理できるため ready にする
+    """
+    state = readiness.state
+    retry = {
+        "attempts": int(os.getenv("WARMUP_MAX_ATTEMPTS", "5")),
+        "retry_interval": float(os.getenv("WARMUP_RETRY_INTERVAL_SECONDS", "5")),
+        "max_retry_interval": float(os.getenv("WARMUP_MAX_RETRY_INTERVAL_SECONDS", "60"))
+    }
+    device_ids = [device_id.strip() for device_id in os.getenv("WARMUP_DEVICE_IDS", "").split(",") if device_id.strip()]
+
+    while True:
         try:
-            url = os.getenv("SUPABASE_URL")
-            key = os.getenv("SUPABASE_KEY")
-            
-            if not url or not key:
-                raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in environment variables")
-            
-            supabase_client = create_client(url, key)
-            print(f"✅ Supabase client initialized")
+            if not state.step_done("imports"):
+                await state.run_step("imports", asyncio.to_thread, import_heavy_modules, **retry)
+            supabase = get_supabase_client()
+            if not state.step_done("supabase_client"):
+                await state.run_step("supabase_client", supabase.warmup, validate_supabase_query, **retry)
+            break
         except Exception as e:
-            print(f"❌ Failed to initialize Supabase client: {e}")
-            raise
-    return supabase_client
+            state.mark_failed(e)
+            await asyncio.sleep(retry["max_retry_interval"])
+
+    optional_steps = [
+        ("calendar_index", asyncio.to_thread, build_calendar_index),
+        ("prompt_build", asyncio.to_thread, prime_prompt_build)
+    ]
+    if device_ids:
+        optional_steps.append(("subject_cache", prime_subject_cache, supabase, device_ids))
+    for name, fn, *args in optional_steps:
+        try:
+            await state.run_step(name, fn, *args, **retry)
+        except Exception as e:
+            logger.warning("⚠️ Warmup step skipped: %s", e, extra={"step": name})
+    state.mark_ready()
 
 # レスポンスモデル
 class PromptResponse(BaseModel):
@@ -66,6 +274,25 @@ class PromptResponse(BaseModel):
     message: Optional[str] = None
     output_path: Optional[str] = None
 
+# バッチ処理の最大アイテム数
+TIMEBLOCK_BATCH_MAX_ITEMS = int(os.getenv("TIMEBLOCK_BATCH_MAX_ITEMS", "200"))
+
+# バックフィルの最大日数と日単位の並行数
+BACKFILL_MAX_DAYS = int(os.getenv("BACKFILL_MAX_DAYS", "92"))
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", "4"))
+
+# インクリメンタル集計で前回のwatermarkより遡って再取得する秒数（書き込み側の時計のずれ・遅延対策）
+DASHBOARD_WATERMARK_OVERLAP_SECONDS = float(os.getenv("DASHBOARD_WATERMARK_OVERLAP_SECONDS", "300"))
+
+# リクエストモデル（タイムブロックのバッチ処理）
+class TimeblockItem(BaseModel):
+    device_id: str = Field(..., description="デバイスID")
+    date: str = Field(..., description="日付 (YYYY-MM-DD)")
+    time_block: str = Field(..., description="タイムブロック (例: 14-30)")
+
+class TimeblockBatchRequest(BaseModel):
+    items: List[TimeblockItem] = Field(..., min_length=1, max_length=TIMEBLOCK_BATCH_MAX_ITEMS)
+
 def generate_chatgpt_prompt(device_id: str, date: str, texts: List[str]) -> str:
     """
     ChatGPT分析用のプロンプトを生成
@@ -137,11 +364,168 @@ def generate_chatgpt_prompt(device_id: str, date: str, texts: List[str]) -> str:
     
     return prompt
 
+def get_time_blocks() -> List[str]:
+    """1日分（48個）の時間帯リスト（00-00から23-30まで）を返す"""
+    time_blocks = []
+    for hour in range(24):
+        for minute in ["00", "30"]:
+            time_blocks.append(f"{hour:02d}-{minute}")
+    return time_blocks
+
+
+def get_time_blocks_until(until_time_block: Optional[str] = None) -> List[str]:
+    """
+    00-00〜until_time_block（この時間帯を含む、省略時は23-30）の時間帯リストを返す
+
+    Raises:
+        ValueError: until_time_block が HH-MM 形式の時間帯（00-00〜23-30）でない
+    """
+    time_blocks = get_time_blocks()
+    if until_time_block is None:
+        return time_blocks
+    if until_time_block not in time_blocks:
+        raise ValueError(f"invalid time block: {until_time_block}")
+    return time_blocks[:time_blocks.index(until_time_block) + 1]
+
+
+def find_missing_time_blocks(time_blocks: List[str], completed_blocks) -> List[str]:
+    """time_blocks のうち completed_blocks（処理済みの時間帯）にないものを順に返す"""
+    completed = set(completed_blocks)
+    return [time_block for time_block in time_blocks if time_block not in completed]
+
+
+async def fetch_vibe_whisper_day(client: AsyncSupabaseClient, device_id: str, date: str):
+    """
+    vibe_whisperテーブルから指定デバイス・日付の全時間帯を1クエリで取得し、
+    48スロット分のテキスト・処理済み・欠損リストをメモリ上で組み立てる
+    
+    Args:
+        client: Supabaseクライアント（非同期アクセス用）
+        device_id: デバイスID
+        date: 日付（YYYY-MM-DD形式）
+        
+    Returns:
+        (texts, processed_files, missing_files) のタプル
+    """
+    time_blocks = get_time_blocks()
+    
+    try:
+        response = await client.execute(
+            lambda c: VIBE_WHISPER_TRANSCRIPTS.select(c).eq(
+                'device_id', device_id
+            ).eq(
+                'date', date
+            )
+        )
+    except deadlines.DeadlineExceeded:
+        raise
+    except Exception as e:
+        # 1日分の取得に失敗した場合は全時間帯を取得エラーとして扱う
+        logger.error("❌ vibe_whisperの1日分の取得エラー: %s", e, extra={"date": date})
+        return [], [], [f"{time_block} (取得エラー)" for time_block in time_blocks]
+    
+    # time_blockごとの最初のレコードを採用（従来の response.data[0] と同じ扱い）
+    rows_by_block = {}
+    for row in response.data or []:
+        rows_by_block.setdefault(row.get('time_block'), row)
+    
+    texts = []
+    processed_files = []
+    missing_files = []
+    
+    for time_block in time_blocks:
+        row = rows_by_block.get(time_block)
+        if row is None:
+            # レコードが存在しない場合のみ欠損として処理（nullとして扱う）
+            missing_files.append(time_block)
+            continue
+        
+        transcription = (row.get('transcription') or '').strip()
+        if transcription:
+            # 発話あり：テキストを分析
+            texts.append(f"[{time_block}] {transcription}")
+        else:
+            # 空文字列の場合：録音は成功したが発話なし（0点として処理）
+            texts.append(f"[{time_block}] (発話なし)")
+        processed_files.append(time_block)
+    
+    return texts, processed_files, missing_files
+
+
 @app.get("/health")
 async def health_check():
     """ヘルスチェックエンドポイント"""
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
+
+@app.get("/ready")
+async def readiness_check():
+    """
+    レディネスチェック（ウォームアップ完了後のみ200、それまでは503）
+    ロードバランサー・デプロイのヘルスチェックにはこちらを使用
+    """
+    return ORJSONResponse(
+        status_code=200 if readiness.state.is_ready else 503,
+        content=readiness.state.to_dict()
+    )
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus形式のメトリクス（エンドポイント・ステージごとのレイテンシ、Supabaseのラウンドトリップ・転送量、エラー数）"""
+    body, content_type = metrics.render()
+    return Response(content=body, headers={"Content-Type": content_type})
+
+
+@app.get("/supabase-pool/stats")
+async def get_supabase_pool_stats():
+    """Supabase用コネクションプールの設定・新規接続数・現在の接続数（idle / active）"""
+    return get_supabase_client().pool_stats_snapshot()
+
+
+@app.get("/write-behind/stats")
+async def get_write_behind_stats():
+    """write-behindの状態（未送信・送信済み・dead_writesに移した件数、最後のエラー）"""
+    if write_behind.buffer is None:
+        return {"enabled": False}
+    return {"enabled": True, **write_behind.buffer.stats()}
+
+
+@app.get("/jobs/stats")
+async def get_job_stats():
+    """ジョブキューの状態（実行待ち・実行中の件数、受付・拒否した件数）"""
+    return jobs.job_queue.stats()
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    async=true で受け付けたジョブの状態と結果
+    status: queued / running / succeeded（result に同期実行時と同じレスポンス）/ failed（error にステータスコードと詳細）
+    """
+    job = jobs.job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません（完了後の保持期間を過ぎた可能性があります）")
+    return job.to_dict()
+
+
+def accept_job(request: Request, kind: str, params: Dict[str, Any], run) -> ORJSONResponse:
+    """処理をジョブキューに積み、202とジョブID・状態確認用のパスを返す（キューが満杯の場合は503）"""
+    job = jobs.job_queue.submit(kind, params, run, budget=deadlines.default_budget(request.url.path))
+    status_url = request.scope.get("root_path", "") + app.url_path_for("get_job", job_id=job.id)
+    logger.info("📥 Job queued", extra={"job_id": job.id, "kind": kind, "queue_depth": jobs.job_queue.depth()})
+    return ORJSONResponse(
+        status_code=202,
+        headers={"Location": status_url},
+        content={
+            "status": jobs.QUEUED,
+            "job_id": job.id,
+            "kind": kind,
+            "status_url": status_url,
+            "queue_depth": jobs.job_queue.depth()
+        }
+    )
+
 @app.get("/generate-mood-prompt-supabase", response_model=PromptResponse)
 async def generate_mood_prompt_supabase(
     device_id: str = Query(..., description="デバイスID"),
@@ -157,6 +541,8 @@ async def generate_mood_prompt_supabase(
     3. ChatGPT用プロンプトを生成
     4. vibe_whisper_promptテーブルにUPSERT（既存レコードは更新）
     
+    ※ vibe_whisperは48時間帯分を1クエリでまとめて取得する
+    
     入力テーブル: vibe_whisper
     - device_id: デバイス識別子
     - date: 日付（YYYY-MM-DD）
@@ -171,7 +557,7 @@ async def generate_mood_prompt_supabase(
     - missing_files: 欠損している時間帯のリスト
     - generated_at: 生成日時
     """
-    print(f"🌟 Supabaseエンドポイントが呼ばれました: device_id={device_id}, date={date}")
+    logger.info("🌟 Supabaseエンドポイントが呼ばれました", extra={"device_id": device_id, "date": date})
     
     try:
         # 日付形式の検証
@@ -186,46 +572,16 @@ async def generate_mood_prompt_supabase(
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Supabaseクライアントの初期化に失敗しました: {str(e)}")
         
-        # vibe_whisperテーブルからデータを取得
-        texts = []
-        processed_files = []
-        missing_files = []
-        
-        # 時間帯リスト（00-00から23-30まで）
-        time_blocks = []
-        for hour in range(24):
-            for minute in ["00", "30"]:
-                time_blocks.append(f"{hour:02d}-{minute}")
-        
-        # 各時間帯のデータを取得
-        for time_block in time_blocks:
-            try:
-                # Supabaseから該当レコードを取得
-                response = client.table('vibe_whisper').select('transcription').eq('device_id', device_id).eq('date', date).eq('time_block', time_block).execute()
-                
-                if response.data and len(response.data) > 0:
-                    transcription = (response.data[0].get('transcription') or '').strip()
-                    if transcription:
-                        # 発話あり：テキストを分析
-                        texts.append(f"[{time_block}] {transcription}")
-                        processed_files.append(time_block)
-                    else:
-                        # 空文字列の場合：録音は成功したが発話なし（0点として処理）
-                        texts.append(f"[{time_block}] (発話なし)")
-                        processed_files.append(time_block)
-                else:
-                    # レコードが存在しない場合のみ欠損として処理（nullとして扱う）
-                    missing_files.append(time_block)
-                    
-            except Exception as e:
-                print(f"❌ 時間帯 {time_block} の取得エラー: {e}")
-                missing_files.append(f"{time_block} (取得エラー)")
-        
-        # デバッグ情報
-        print(f"✅ 処理済み: {len(processed_files)}個の時間帯")
-        print(f"❌ 欠損: {len(missing_files)}個の時間帯")
-        if missing_files[:5]:  # 最初の5個だけ表示
-            print(f"   欠損時間帯例: {missing_files[:5]}...")
+        # vibe_whisperテーブルから1日分のデータを1クエリで取得
+        texts, processed_files, missing_files = await fetch_vibe_whisper_day(client, device_id, date)
+        
+        # デバッグ情報（欠損時間帯は最初の5個だけ）
+        logger.info("📊 vibe_whisperの取得結果", extra={
+            "date": date,
+            "processed_count": len(processed_files),
+            "missing_count": len(missing_files),
+            "missing_examples": missing_files[:5]
+        })
         
         # ChatGPT用プロンプトの生成
         prompt = generate_chatgpt_prompt(device_id, date, texts)
@@ -242,23 +598,27 @@ async def generate_mood_prompt_supabase(
         
         try:
             # 既存レコードを更新または新規作成
-            response = client.table('vibe_whisper_prompt').upsert(prompt_data, on_conflict='device_id,date').execute()
+            response = await client.execute(
+                lambda c: c.table('vibe_whisper_prompt').upsert(prompt_data, on_conflict='device_id,date')
+            )
             
-            print(f"✅ vibe_whisper_promptテーブルに保存完了")
+            logger.info("✅ vibe_whisper_promptテーブルに保存完了", extra={"date": date})
             
             return PromptResponse(
                 status="success",
                 message=f"プロンプトが正常に生成され、データベースに保存されました。処理済み: {len(processed_files)}個、欠損: {len(missing_files)}個"
             )
             
+        except deadlines.DeadlineExceeded:
+            raise
         except Exception as e:
-            print(f"❌ データベース保存エラー: {e}")
+            logger.error("❌ データベース保存エラー: %s", e, extra={"date": date})
             raise HTTPException(status_code=500, detail=f"データベース保存エラー: {str(e)}")
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ 予期しないエラー: {e}")
+        logger.exception("❌ 予期しないエラー: %s", e)
         raise HTTPException(status_code=500, detail=f"内部サーバーエラー: {str(e)}")
 
 # ===============================
@@ -268,87 +628,167 @@ from timeblock_endpoint import (
     process_and_save_to_dashboard,
     get_weekday_info,
     get_season,
-    generate_age_context
+    generate_age_context,
+    get_subject_info,
+    subject_cache
+)
+import dashboard_aggregates
+from timeblock_endpoint_v2 import (
+    generate_timeblock_prompt_v2,
+    process_timeblock_v3,
+    process_timeblock_batch_v3,
+    process_timeblock_backfill_v3,
+    expand_date_range
 )
-from timeblock_endpoint_v2 import process_timeblock_v3
+from calendar_context import get_holiday_context, build_calendar_index
 
-def get_holiday_context(date: str) -> Dict[str, Any]:
-    """
-    指定日の祝日・連休情報を取得
-    
-    Args:
-        date: 日付 (YYYY-MM-DD形式)
-    
-    Returns:
-        祝日情報と連休コンテキストを含む辞書
-    """
-    try:
-        date_obj = datetime.strptime(date, "%Y-%m-%d")
-        
-        # 祝日判定
-        holiday_name = jpholiday.is_holiday_name(date_obj)
-        is_holiday = holiday_name is not None
-        
-        # 前後の日付を確認して連休判定
-        day_before = date_obj - timedelta(days=1)
-        day_after = date_obj + timedelta(days=1)
-        
-        holiday_before = jpholiday.is_holiday_name(day_before)
-        holiday_after = jpholiday.is_holiday_name(day_after)
-        is_weekend_before = day_before.weekday() >= 5
-        is_weekend_after = day_after.weekday() >= 5
-        is_weekend_current = date_obj.weekday() >= 5
-        
-        # 連休のコンテキスト生成
-        consecutive_context = ""
-        if (holiday_before or is_weekend_before) and (holiday_after or is_weekend_after):
-            consecutive_context = "3連休の中日"
-        elif holiday_after or is_weekend_after:
-            consecutive_context = "連休初日"
-        elif holiday_before or is_weekend_before:
-            consecutive_context = "連休最終日"
-        elif is_holiday:
-            consecutive_context = "祝日"
-        elif is_weekend_current:
-            consecutive_context = "週末"
-        
-        return {
-            "is_holiday": is_holiday,
-            "holiday_name": holiday_name,
-            "consecutive_context": consecutive_context,
-            "is_weekend": is_weekend_current
-        }
-    except Exception as e:
-        print(f"祝日情報の取得に失敗: {e}")
-        return {
-            "is_holiday": False,
-            "holiday_name": None,
-            "consecutive_context": "",
-            "is_weekend": False
-        }
 
 @app.get("/generate-timeblock-prompt")
 async def generate_timeblock_prompt(
+    request: Request,
     device_id: str = Query(..., description="デバイスID"),
     date: str = Query(..., description="日付 (YYYY-MM-DD)"),
-    time_block: str = Query(..., description="タイムブロック (例: 14-30)")
+    time_block: str = Query(..., description="タイムブロック (例: 14-30)"),
+    async_mode: bool = Query(False, alias="async", description="ジョブとして受け付けて202とジョブIDをすぐに返すか（結果は /jobs/{job_id}）")
 ):
     """
     30分単位でWhisper + SEDデータ + 観測対象者情報を使用してプロンプト生成
+    同じ (device_id, date, time_block) の処理が実行中の場合は、その結果を共有する
     """
     try:
         # Supabaseクライアント取得
         supabase = get_supabase_client()
         
         # 処理実行（改善版V3を使用）
-        result = await process_timeblock_v3(supabase, device_id, date, time_block)
+        def run():
+            return single_flight.timeblock_flight.do(
+                (device_id, date, time_block),
+                lambda: process_timeblock_v3(supabase, device_id, date, time_block),
+                budget=deadlines.default_budget(request.url.path)
+            )
+        
+        if async_mode:
+            return accept_job(
+                request, "timeblock_prompt",
+                {"device_id": device_id, "date": date, "time_block": time_block},
+                run
+            )
+        
+        result = await run()
         
         return result
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/generate-timeblock-prompts")
+async def generate_timeblock_prompts_batch(request: TimeblockBatchRequest):
+    """
+    複数の (device_id, date, time_block) のプロンプトをまとめて生成するバッチ版
+    audio_featuresの取得とaudio_aggregatorへの保存をそれぞれ1回のクエリで行う
+    結果は items と同じ順番で返す
+    """
+    # 日付形式の検証（不正なアイテムがあればバッチ全体を拒否）
+    for item in request.items:
+        try:
+            datetime.strptime(item.date, "%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(
+                status_code=400,
+                detail=f"無効な日付形式です。YYYY-MM-DD形式で入力してください。: {item.date}"
+            )
+    
+    try:
+        supabase = get_supabase_client()
+        
+        results = await process_timeblock_batch_v3(
+            supabase,
+            [(item.device_id, item.date, item.time_block) for item in request.items]
+        )
+        
+        success_count = sum(1 for result in results if result["status"] == "success")
+        error_count = sum(1 for result in results if result["status"] == "error")
+        return {
+            "status": "success" if success_count == len(results) else "partial",
+            "count": len(results),
+            "success_count": success_count,
+            "error_count": error_count,
+            # deadline を過ぎて保存などが間に合わなかったアイテム数
+            "partial_count": len(results) - success_count - error_count,
+            "results": results
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/backfill-timeblock-prompts")
+async def backfill_timeblock_prompts(
+    device_id: str = Query(..., description="デバイスID"),
+    start_date: str = Query(..., description="開始日 (YYYY-MM-DD)"),
+    end_date: str = Query(..., description="終了日 (YYYY-MM-DD、この日を含む)"),
+    include_prompts: bool = Query(False, description="進捗に生成したプロンプト本文を含めるか"),
+    concurrency: int = Query(BACKFILL_CONCURRENCY, ge=1, le=16, description="日単位の並行処理数")
+):
+    """
+    デバイスの日付範囲のタイムブロックを一括で再処理する（遅延アップロードやプロンプト変更時用）
+    audio_featuresを期間分まとめて取得し、日ごとにプロンプト生成・audio_aggregator保存を行う
+    進捗はNDJSON（1行1イベント: start → day... → done）でストリーミング返却する
+    """
+    try:
+        dates = expand_date_range(start_date, end_date)
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail="無効な日付形式です。YYYY-MM-DD形式で入力してください。"
+        )
+    if not dates:
+        raise HTTPException(status_code=400, detail="end_dateはstart_date以降の日付を指定してください。")
+    if len(dates) > BACKFILL_MAX_DAYS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"バックフィルの期間は最大{BACKFILL_MAX_DAYS}日までです。"
+        )
+    
+    try:
+        supabase = get_supabase_client()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    async def event_stream():
+        async for event in process_timeblock_backfill_v3(
+            supabase, device_id, start_date, end_date,
+            concurrency=concurrency, include_prompts=include_prompts
+        ):
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+
+@app.post("/subject-cache/invalidate")
+async def invalidate_subject_cache(
+    device_id: Optional[str] = Query(None, description="デバイスID（省略時は全件クリア）")
+):
+    """
+    観測対象者情報キャッシュを無効化する
+    devices/subjectsテーブルを更新した後に呼び出すと、次回リクエストから最新情報が使われる
+    """
+    invalidated = subject_cache.invalidate(device_id)
+    logger.info("🧹 観測対象者キャッシュを無効化しました", extra={"device_id": device_id or "ALL", "invalidated": invalidated})
+    
+    return {
+        "status": "success",
+        "device_id": device_id,
+        "invalidated": invalidated,
+        "cache": subject_cache.stats()
+    }
+
+
 @app.get("/test-timeblock")
 async def test_timeblock_processing():
     """
@@ -376,17 +816,92 @@ async def test_timeblock_processing():
 
 @app.get("/generate-dashboard-summary")
 async def generate_dashboard_summary(
+    request: Request,
     device_id: str = Query(..., description="デバイスID"),
-    date: str = Query(..., description="日付 (YYYY-MM-DD)")
+    date: str = Query(..., description="日付 (YYYY-MM-DD)"),
+    incremental: bool = Query(False, description="前回の集計値から差分のみを反映するか"),
+    debounce_mode: bool = Query(False, alias="debounce", description="同じデバイス・日付の要求をまとめて一定時間後に1回だけ再生成するか"),
+    wait: bool = Query(True, description="debounce時、再生成の完了を待って結果を返すか（falseの場合は受付のみを202で返す）"),
+    async_mode: bool = Query(False, alias="async", description="ジョブとして受け付けて202とジョブIDをすぐに返すか（結果は /jobs/{job_id}、debounce時は無視）")
 ):
     """
     dashboardテーブルの1日分の分析結果を統合してdashboard_summaryテーブルに保存
+    同じ (device_id, date) の処理が実行中の場合は、その結果を共有する
+    （incrementalの指定が異なっても結果は同じため相乗りする）
+    
+    debounce=true の場合:
+    - DASHBOARD_SUMMARY_DEBOUNCE_SECONDS の間に届いた同じ (device_id, date) の要求をまとめて1回だけ再生成する
+    - wait=true（デフォルト）はまとめた再生成の結果を、wait=false は受付（202）をすぐに返す
+
+    async=true の場合（debounce=false のとき）はジョブキューに積み、202とジョブIDを返す
+    """
+    def run():
+        return single_flight.dashboard_summary_flight.do(
+            (device_id, date),
+            lambda: build_dashboard_summary(device_id, date, incremental),
+            budget=deadlines.default_budget(request.url.path)
+        )
+
+    if not debounce_mode and not async_mode:
+        return await run()
+
+    try:
+        datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail="無効な日付形式です。YYYY-MM-DD形式で入力してください。"
+        )
+
+    if not debounce_mode:
+        return accept_job(
+            request, "dashboard_summary",
+            {"device_id": device_id, "date": date, "incremental": incremental},
+            run
+        )
+
+    async def run_debounced():
+        # 要求したリクエストの deadline は引き継がず、実行開始時点から改めて設定する
+        # 実行中の（まとめる前の要求による）処理に相乗りすると変更後のデータを読まないため、single-flight を通さない
+        with deadlines.deadline(deadlines.default_budget(request.url.path)):
+            return await build_dashboard_summary(device_id, date, incremental)
+
+    pending = debounce.dashboard_summary_debouncer.submit((device_id, date), run_debounced)
+    if wait:
+        # 待っているリクエストが切断・タイムアウトしても再生成は続ける
+        left = deadlines.remaining()
+        try:
+            return await asyncio.wait_for(asyncio.shield(pending.future), left)
+        except asyncio.TimeoutError:
+            raise deadlines.DeadlineExceeded("dashboard_summaryの再生成待ち")
+
+    return ORJSONResponse(
+        status_code=202,
+        content={
+            "status": "scheduled",
+            "device_id": device_id,
+            "date": date,
+            "scheduled_in_seconds": round(pending.seconds_until_run(), 3),
+            "collapsed_requests": pending.requests
+        }
+    )
+
+
+async def build_dashboard_summary(device_id: str, date: str, incremental: bool = False):
+    """
+    dashboardテーブルの1日分の分析結果を統合してdashboard_summaryテーブルに保存
     
     処理内容:
     1. dashboardテーブルから該当日のstatus='completed'のレコードを取得
     2. summaryとvibe_scoreから累積型プロンプトを生成
     3. vibe_scoreから48要素の配列を生成（グラフ描画用）
     4. プロンプトをdashboard_summaryテーブルのpromptカラムに保存
+    
+    incremental=true の場合:
+    - dashboard_summary.aggregates に保存した前回の集計値を読み込み、
+      last_time_blockより後のブロックと前回以降に更新されたブロックだけを取得して反映する
+    - 集計値がない（初回・形式変更時）場合は1日分を取得して集計し直す
+    - 更新後の集計値を dashboard_summary.aggregates に保存する
     """
     try:
         # 日付形式の検証
@@ -401,121 +916,57 @@ async def generate_dashboard_summary(
         # Supabaseクライアント取得
         supabase = get_supabase_client()
         
-        # dashboardテーブルから該当日の全レコードを取得（時系列順）
-        # status='completed'のデータを全て対象とする（vibe_scoreの有無に関係なく）
-        # 失敗レコード（vibe_score=null）も含めて取得し、累積分析に含める
-        dashboard_response = supabase.table("dashboard").select("*").eq(
-            "device_id", device_id
-        ).eq(
-            "date", date
-        ).eq(
-            "status", "completed"  # status='completed'のデータを全て対象
-        ).order(
-            "time_block", desc=False
-        ).execute()
+        aggregates = None
+        if incremental:
+            aggregates = await load_dashboard_aggregates(supabase, device_id, date)
+        
+        if aggregates is not None:
+            # 差分のみ取得して前回の集計値に反映
+            with metrics.stage(metrics.DASHBOARD_FETCH):
+                new_blocks = await fetch_dashboard_blocks_since(supabase, device_id, date, aggregates)
+            dashboard_aggregates.apply_blocks(aggregates, new_blocks)
+            logger.info("🔄 インクリメンタル集計", extra={"date": date, "applied_blocks": len(new_blocks)})
+        else:
+            # dashboardテーブルから該当日の全レコードを取得（時系列順）
+            # status='completed'のデータを全て対象とする（vibe_scoreの有無に関係なく）
+            # 失敗レコード（vibe_score=null）も含めて取得し、累積分析に含める
+            with metrics.stage(metrics.DASHBOARD_FETCH):
+                dashboard_response = await supabase.execute(
+                    lambda c: DASHBOARD_SUMMARY_BLOCKS.select(c).eq(
+                        "device_id", device_id
+                    ).eq(
+                        "date", date
+                    ).eq(
+                        "status", "completed"  # status='completed'のデータを全て対象
+                    ).order(
+                        "time_block", desc=False
+                    )
+                )
+            aggregates = dashboard_aggregates.build_aggregates(dashboard_response.data or [])
 
-        if not dashboard_response.data:
+        processed_count = dashboard_aggregates.processed_count(aggregates)
+        if processed_count == 0:
             return {
                 "status": "warning",
                 "message": f"処理済みデータが見つかりません。device_id: {device_id}, date: {date}",
                 "processed_count": 0
             }
         
-        # データの整理と統合
-        processed_blocks = dashboard_response.data
-        processed_count = len(processed_blocks)
-        
         # 最後のタイムブロックを取得
-        last_time_block = processed_blocks[-1]["time_block"] if processed_blocks else None
-        
-        # ========== 処理B: vibe_scores配列の生成（新規追加） ==========
-        # 48要素の配列を初期化（全てnull）
-        vibe_scores_array = [None] * 48
-        
-        # 時間ブロックのマッピング辞書を作成
-        time_block_to_index = {}
-        for hour in range(24):
-            for minute_idx, minute in enumerate(["00", "30"]):
-                time_block = f"{hour:02d}-{minute}"
-                index = hour * 2 + minute_idx
-                time_block_to_index[time_block] = index
-        
-        # vibe_scoreデータを配列の適切な位置に配置
-        vibe_score_sum = 0
-        vibe_score_count = 0
-        
-        for block in processed_blocks:
-            time_block = block.get("time_block")
-            vibe_score = block.get("vibe_score")
-            
-            # 対応するインデックスにvibe_scoreを設定
-            if time_block in time_block_to_index and vibe_score is not None:
-                index = time_block_to_index[time_block]
-                vibe_scores_array[index] = vibe_score
-                vibe_score_sum += vibe_score
-                vibe_score_count += 1
-        
-        # vibe_scoreの平均値を計算（nullを除外）
-        average_vibe = vibe_score_sum / vibe_score_count if vibe_score_count > 0 else None
-        
-        # ========== シンプル化されたタイムライン生成処理 ==========
-        # summaryとvibe_scoreのみを使用
-        timeline = []
-        total_vibe_score = 0
-        valid_score_count = 0
-        positive_blocks = 0
-        negative_blocks = 0
-        neutral_blocks = 0
-        
-        for block in processed_blocks:
-            # summaryとvibe_scoreのみを取得（analysis_resultは使わない）
-            summary = block.get("summary") or ""  # NULLの場合は空文字列に変換
-            vibe_score = block.get("vibe_score")
-            
-            # スコアの統計
-            if vibe_score is not None:
-                total_vibe_score += vibe_score
-                valid_score_count += 1
-                
-                if vibe_score > 20:
-                    positive_blocks += 1
-                elif vibe_score < -20:
-                    negative_blocks += 1
-                else:
-                    neutral_blocks += 1
-            
-            # シンプルなタイムラインエントリの作成（summaryとvibe_scoreのみ）
-            timeline_entry = {
-                "time_block": block["time_block"],
-                "summary": summary,
-                "vibe_score": vibe_score
-            }
-            
-            timeline.append(timeline_entry)
+        last_time_block = aggregates["last_time_block"]
         
-        # 統計情報の計算（既存処理用）
-        avg_vibe_score = total_vibe_score / valid_score_count if valid_score_count > 0 else None
+        # vibe_scores配列（48要素、グラフ描画用）と平均値（nullを除外）
+        vibe_scores_array = dashboard_aggregates.vibe_scores_array(aggregates)
+        vibe_score_count = aggregates["vibe_score_count"]
+        average_vibe = dashboard_aggregates.average_vibe(aggregates)
         
-        # 観測対象者情報を取得（devicesテーブルとsubjectsテーブルを結合）
-        subject_info = None
-        try:
-            # devicesテーブルからsubject_idを取得
-            device_response = supabase.table("devices").select("subject_id").eq(
-                "device_id", device_id
-            ).single().execute()
-            
-            if device_response.data and device_response.data.get("subject_id"):
-                subject_id = device_response.data["subject_id"]
-                # subjectsテーブルから情報を取得
-                subject_response = supabase.table("subjects").select("*").eq(
-                    "subject_id", subject_id
-                ).single().execute()
-                
-                if subject_response.data:
-                    subject_info = subject_response.data
-        except Exception as e:
-            # エラーが発生しても処理を継続（subject_info = Noneのまま）
-            print(f"観測対象者情報の取得に失敗しました（処理は継続）: {e}")
+        # summaryとvibe_scoreのみのタイムラインと統計情報
+        timeline = dashboard_aggregates.timeline(aggregates)
+        statistics = dashboard_aggregates.statistics(aggregates)
+        
+        # 観測対象者情報を取得（devices → subjects、キャッシュ経由）
+        # エラーが発生しても処理を継続（subject_info = None）
+        subject_info = await get_subject_info(supabase, device_id)
         
         # 統合プロンプトの生成（累積型、subject_info追加）
         daily_summary_prompt = generate_daily_summary_prompt(
@@ -523,10 +974,10 @@ async def generate_dashboard_summary(
             date=date,
             timeline=timeline,
             statistics={
-                "avg_vibe_score": avg_vibe_score,
-                "positive_blocks": positive_blocks,
-                "negative_blocks": negative_blocks,
-                "neutral_blocks": neutral_blocks,
+                "avg_vibe_score": statistics["avg_vibe_score"],
+                "positive_blocks": statistics["positive_blocks"],
+                "negative_blocks": statistics["negative_blocks"],
+                "neutral_blocks": statistics["neutral_blocks"],
                 "total_blocks": processed_count
             },
             last_time_block=last_time_block,
@@ -544,12 +995,17 @@ async def generate_dashboard_summary(
             "last_time_block": last_time_block,
             "updated_at": datetime.now().isoformat()
         }
+        if incremental:
+            upsert_data["aggregates"] = aggregates  # 次回のインクリメンタル集計用
         
         # UPSERTの実行（既存データは上書き）
-        summary_response = supabase.table("dashboard_summary").upsert(
-            upsert_data,
-            on_conflict="device_id,date"
-        ).execute()
+        with metrics.stage(metrics.DASHBOARD_SUMMARY_UPSERT):
+            summary_response = await supabase.execute(
+                lambda c: c.table("dashboard_summary").upsert(
+                    upsert_data,
+                    on_conflict="device_id,date"
+                )
+            )
         
         return {
             "status": "success",
@@ -561,24 +1017,70 @@ async def generate_dashboard_summary(
             "last_time_block": last_time_block,
             "vibe_scores_count": vibe_score_count,  # 新規追加: 有効なスコア数
             "average_vibe": average_vibe,           # 新規追加: 平均値
-            "statistics": {
-                "avg_vibe_score": avg_vibe_score,
-                "positive_blocks": positive_blocks,
-                "negative_blocks": negative_blocks,
-                "neutral_blocks": neutral_blocks,
-                "valid_score_count": valid_score_count
-            }
+            "statistics": statistics
         }
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"エラー詳細: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("エラー詳細: %s", e)
         raise HTTPException(status_code=500, detail=f"サーバーエラー: {str(e)}")
 
 
+async def load_dashboard_aggregates(supabase: AsyncSupabaseClient, device_id: str, date: str) -> Optional[Dict[str, Any]]:
+    """
+    dashboard_summary.aggregates から前回の集計値を読み込む
+    存在しない・形式が異なる・取得に失敗した場合はNone（フル再集計）
+    """
+    try:
+        response = await supabase.execute(
+            lambda c: DASHBOARD_SUMMARY_AGGREGATES.select(c).eq(
+                "device_id", device_id
+            ).eq(
+                "date", date
+            )
+        )
+    except deadlines.DeadlineExceeded:
+        raise
+    except Exception as e:
+        logger.warning("⚠️ 前回の集計値の取得に失敗しました（フル再集計します）: %s", e, extra={"date": date})
+        return None
+    
+    if response.data and dashboard_aggregates.is_valid_aggregates(response.data[0].get("aggregates")):
+        return response.data[0]["aggregates"]
+    return None
+
+
+async def fetch_dashboard_blocks_since(supabase: AsyncSupabaseClient, device_id: str, date: str,
+                                       aggregates: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    前回の集計以降に追加・更新されたdashboardのブロックを取得
+    - last_time_blockより後のタイムブロック
+    - updated_atが前回のwatermark（取り込み済みの行の最大updated_at）から
+      DASHBOARD_WATERMARK_OVERLAP_SECONDS 遡った時刻以降のブロック（再処理された過去ブロック）
+    status='completed'以外になったブロックも集計から外すため、statusでは絞り込まない
+    """
+    last_time_block = aggregates["last_time_block"]
+    watermark = aggregates["watermark"]
+    if watermark:
+        watermark = dashboard_aggregates.watermark_with_overlap(watermark, DASHBOARD_WATERMARK_OVERLAP_SECONDS)
+    
+    def build(c):
+        query = DASHBOARD_SUMMARY_BLOCKS.select(c).eq(
+            "device_id", device_id
+        ).eq(
+            "date", date
+        )
+        if last_time_block and watermark:
+            query = or_filter(query, f'time_block.gt."{last_time_block}"', f'updated_at.gte."{watermark}"')
+        elif last_time_block:
+            query = query.gt("time_block", last_time_block)
+        return query.order("time_block", desc=False)
+    
+    response = await supabase.execute(build)
+    return response.data or []
+
+
 def detect_burst_events(timeline: List[Dict], threshold: int = 30) -> List[Dict]:
     """
     タイムラインから感情の大きな変化点（バーストイベント）を検出
@@ -796,6 +1298,35 @@ def generate_daily_summary_prompt(device_id: str, date: str, timeline: List[Dict
     return prompt
 
 
+def get_failure_user_message(failure_reason: str) -> str:
+    """失敗理由からユーザー向けメッセージを生成"""
+    if failure_reason == "quota_exceeded":
+        return "音声の文字起こしに失敗しました。再処理を行っていますので、しばらくお待ちください。"
+    elif failure_reason == "api_error":
+        return "一時的なエラーが発生しました。再処理を行っていますので、しばらくお待ちください。"
+    else:
+        return "処理に失敗しました。再処理を行っていますので、しばらくお待ちください。"
+
+
+def build_failed_record(device_id: str, date: str, time_block: str, user_message: str) -> Dict[str, Any]:
+    """dashboardテーブルに挿入する失敗レコード"""
+    now = datetime.now().isoformat()
+    return {
+        "device_id": device_id,
+        "date": date,
+        "time_block": time_block,
+        "summary": user_message,
+        "vibe_score": 0,  # 重要: 未処理(null)と区別するため0にする
+        "status": "completed",  # 重要: 次のプロセスに進ませるため
+        "behavior": "不明",
+        "created_at": now,
+        "updated_at": now,
+        "prompt": None,
+        "processed_at": None,
+        "analysis_result": None
+    }
+
+
 @app.post("/create-failed-record")
 async def create_failed_record(
     device_id: str = Query(..., description="デバイスID"),
@@ -836,36 +1367,16 @@ async def create_failed_record(
         supabase = get_supabase_client()
 
         # ユーザー向けメッセージの生成
-        if failure_reason == "quota_exceeded":
-            user_message = "音声の文字起こしに失敗しました。再処理を行っていますので、しばらくお待ちください。"
-        elif failure_reason == "api_error":
-            user_message = "一時的なエラーが発生しました。再処理を行っていますので、しばらくお待ちください。"
-        else:
-            user_message = "処理に失敗しました。再処理を行っていますので、しばらくお待ちください。"
+        user_message = get_failure_user_message(failure_reason)
 
         # dashboardテーブルに失敗レコードを挿入
-        dashboard_record = {
-            "device_id": device_id,
-            "date": date,
-            "time_block": time_block,
-            "summary": user_message,
-            "vibe_score": 0,  # 重要: 未処理(null)と区別するため0にする
-            "status": "completed",  # 重要: 次のプロセスに進ませるため
-            "behavior": "不明",
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat(),
-            "prompt": None,
-            "processed_at": None,
-            "analysis_result": None
-        }
+        dashboard_record = build_failed_record(device_id, date, time_block, user_message)
 
         # UPSERT（再処理時は上書きされる）
-        response = supabase.table("dashboard").upsert(
-            dashboard_record,
-            on_conflict="device_id,date,time_block"
-        ).execute()
+        # 直後の /generate-dashboard-summary がSupabaseから読むため、write-behind有効時もその場で書き込む
+        await write_behind.upsert(supabase, "dashboard", dashboard_record, on_conflict="device_id,date,time_block", write_through=True)
 
-        print(f"✅ 失敗レコードをdashboardテーブルに作成しました: {device_id}, {date}, {time_block}")
+        logger.info("✅ 失敗レコードをdashboardテーブルに作成しました", extra={"date": date, "time_block": time_block})
 
         return {
             "status": "success",
@@ -880,15 +1391,103 @@ async def create_failed_record(
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ 失敗レコード作成エラー: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ 失敗レコード作成エラー: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"失敗レコードの作成に失敗しました: {str(e)}"
         )
 
 
+@app.post("/create-failed-records")
+async def create_failed_records(
+    device_id: str = Query(..., description="デバイスID"),
+    date: str = Query(..., description="日付 (YYYY-MM-DD)"),
+    failure_reason: str = Query("quota_exceeded", description="失敗理由"),
+    error_message: str = Query("", description="エラーメッセージ"),
+    until_time_block: Optional[str] = Query(None, description="この時間帯（を含む）までを対象にする (例: 22-30)。当日分は指定してください")
+):
+    """
+    1日分（48ブロック）のうち、dashboardにstatus='completed'のレコードがない時間帯を検出し、
+    まとめて失敗レコードを作成する
+
+    処理内容:
+    1. dashboardテーブルから該当日のcompletedな時間帯を1クエリで取得
+    2. 00-00〜until_time_block（省略時は23-30）のうち、completedなレコードがない時間帯を抽出
+    3. 抽出した全時間帯の失敗レコードを1回のUPSERTで作成（vibe_score=0, status=completed）
+
+    Returns:
+        作成した時間帯のリストを含むレスポンス
+    """
+    try:
+        # 日付形式の検証
+        try:
+            datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(
+                status_code=400,
+                detail="無効な日付形式です。YYYY-MM-DD形式で入力してください。"
+            )
+
+        try:
+            time_blocks = get_time_blocks_until(until_time_block)
+        except ValueError:
+            raise HTTPException(
+                status_code=400,
+                detail="無効なタイムブロックです。HH-MM形式（00-00〜23-30）で入力してください。"
+            )
+
+        # Supabaseクライアント取得
+        supabase = get_supabase_client()
+
+        # 処理済み（completed）の時間帯を取得
+        with metrics.stage(metrics.DASHBOARD_FETCH):
+            response = await supabase.execute(
+                lambda c: DASHBOARD_COMPLETED_BLOCKS.select(c).eq(
+                    "device_id", device_id
+                ).eq(
+                    "date", date
+                ).eq(
+                    "status", "completed"
+                )
+            )
+        missing_blocks = find_missing_time_blocks(time_blocks, (row["time_block"] for row in response.data or []))
+
+        user_message = get_failure_user_message(failure_reason)
+        if missing_blocks:
+            # 全ての欠損時間帯を1回のUPSERTで作成（再処理時は上書きされる。write-behind有効時もその場で書き込む）
+            dashboard_records = [
+                build_failed_record(device_id, date, time_block, user_message)
+                for time_block in missing_blocks
+            ]
+            await write_behind.upsert(supabase, "dashboard", dashboard_records, on_conflict="device_id,date,time_block", write_through=True)
+
+        logger.info("✅ 失敗レコードを一括作成しました", extra={
+            "date": date,
+            "created_count": len(missing_blocks),
+            "target_count": len(time_blocks)
+        })
+
+        return {
+            "status": "success",
+            "message": f"{len(missing_blocks)}件の失敗レコードを作成しました",
+            "device_id": device_id,
+            "date": date,
+            "failure_reason": failure_reason,
+            "user_message": user_message,
+            "created_count": len(missing_blocks),
+            "time_blocks": missing_blocks
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("❌ 失敗レコード一括作成エラー: %s", e)
+        raise HTTPException(
+            status_code=500,
+            detail=f"失敗レコードの一括作成に失敗しました: {str(e)}"
+        )
+
+
 if __name__ == "__main__":
     # アプリケーションの起動
-    uvicorn.run(app, host="0.0.0.0", port=8009)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8009)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics
+=======
+Prometheus形式（/metrics）で公開するレイテンシ・ラウンドトリップ・ペイロード量・エラーのメトリクス
+
+- エンドポイントごとのレイテンシ: vibe_aggregator_http_request_duration_seconds
+- 処理ステージごとのレイテンシ: vibe_aggregator_stage_duration_seconds
+  （audio_features_fetch / subject_fetch / prompt_build / audio_aggregator_upsert /
+    dashboard_fetch / dashboard_summary_upsert）
+- Supabase（PostgREST）のラウンドトリップ数・所要時間・送受信バイト数
+- Supabaseへの新規接続数とコネクションプール内の接続数
+- 実行中の同一リクエストに相乗りしたリクエスト数（single-flight）・debounceでまとめられた要求数
+- エラー数（ステージ・Supabase呼び出し・5xxレスポンス）
+
+使い方:
+    with metrics.stage('audio_features_fetch'):
+        result = await supabase.execute(...)
+"""
+
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+
+AUDIO_FEATURES_FETCH = 'audio_features_fetch'
+SUBJECT_FETCH = 'subject_fetch'
+PROMPT_BUILD = 'prompt_build'
+AUDIO_AGGREGATOR_UPSERT = 'audio_aggregator_upsert'
+DASHBOARD_FETCH = 'dashboard_fetch'
+DASHBOARD_SUMMARY_UPSERT = 'dashboard_summary_upsert'
+
+# ルートに一致しなかったリクエストのラベル（パスをそのままラベルにしないため）
+UNMATCHED_ROUTE = '<unmatched>'
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'vibe_aggregator_http_request_duration_seconds',
+    'エンドポイントごとのリクエスト処理時間（秒）',
+    ['method', 'endpoint', 'status']
+)
+
+STAGE_SECONDS = Histogram(
+    'vibe_aggregator_stage_duration_seconds',
+    '処理ステージごとの所要時間（秒）',
+    ['stage']
+)
+
+SUPABASE_REQUEST_SECONDS = Histogram(
+    'vibe_aggregator_supabase_request_duration_seconds',
+    'Supabase（PostgREST）1リクエストあたりの所要時間（スレッドプールの待ち時間を含む、秒）',
+    ['table', 'method']
+)
+
+SUPABASE_ROUND_TRIPS = Counter(
+    'vibe_aggregator_supabase_round_trips_total',
+    'Supabase（PostgREST）へのラウンドトリップ数',
+    ['table', 'method']
+)
+
+SUPABASE_PAYLOAD_BYTES = Counter(
+    'vibe_aggregator_supabase_payload_bytes_total',
+    'Supabase（PostgREST）との送受信バイト数',
+    ['table', 'direction']
+)
+
+SUPABASE_CONNECTIONS_OPENED = Counter(
+    'vibe_aggregator_supabase_connections_opened_total',
+    'Supabase（PostgREST）への新規TCP接続数（keep-alive中の接続を再利用した場合は増えない）'
+)
+
+SUPABASE_POOL_CONNECTIONS = Gauge(
+    'vibe_aggregator_supabase_pool_connections',
+    'Supabase（PostgREST）用コネクションプール内の接続数（state: idle / active）',
+    ['state']
+)
+
+SINGLE_FLIGHT_COALESCED = Counter(
+    'vibe_aggregator_single_flight_coalesced_total',
+    '実行中の同一リクエストに相乗りした（処理を実行しなかった）リクエスト数',
+    ['name']
+)
+
+DEBOUNCE_COLLAPSED = Counter(
+    'vibe_aggregator_debounce_collapsed_total',
+    'debounceで実行待ちの要求にまとめられた（実行回数を増やさなかった）要求数',
+    ['name']
+)
+
+JOB_QUEUE_DEPTH = Gauge(
+    'vibe_aggregator_job_queue_depth',
+    'async=trueで受け付けて実行待ちのジョブ数',
+    ['queue']
+)
+
+JOBS_RUNNING = Gauge(
+    'vibe_aggregator_jobs_running',
+    '実行中のジョブ数',
+    ['queue']
+)
+
+JOBS = Counter(
+    'vibe_aggregator_jobs_total',
+    'ジョブ数（outcome: queued / rejected: キュー満杯 / succeeded / failed）',
+    ['kind', 'outcome']
+)
+
+JOB_WAIT_SECONDS = Histogram(
+    'vibe_aggregator_job_wait_seconds',
+    'ジョブがキューで実行を待った時間（秒）',
+    ['kind']
+)
+
+SUPABASE_HEDGED_REQUESTS = Counter(
+    'vibe_aggregator_supabase_hedged_requests_total',
+    '応答が遅いため追加で送った読み取りクエリ数（outcome: launched / won: 追加した方が先に応答した）',
+    ['table', 'outcome']
+)
+
+ERRORS = Counter(
+    'vibe_aggregator_errors_total',
+    'エラー数（source: ステージ名 / supabase / http / deadline）',
+    ['source']
+)
+
+if TYPE_CHECKING:
+    import httpx
+
+
+@contextmanager
+def stage(name: str):
+    """ブロック内の所要時間をステージのレイテンシとして記録（例外時はエラー数も加算）"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.labels(source=name).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage=name).observe(time.perf_counter() - start)
+
+
+def observe_http_request(method: str, endpoint: str, status: int, seconds: float):
+    HTTP_REQUEST_SECONDS.labels(method=method, endpoint=endpoint, status=str(status)).observe(seconds)
+    if status >= 500:
+        ERRORS.labels(source='http').inc()
+
+
+def observe_supabase_request(table: str, method: str, seconds: float, failed: bool = False):
+    SUPABASE_ROUND_TRIPS.labels(table=table, method=method).inc()
+    SUPABASE_REQUEST_SECONDS.labels(table=table, method=method).observe(seconds)
+    if failed:
+        ERRORS.labels(source='supabase').inc()
+
+
+def _table_from_url(url: "httpx.URL") -> str:
+    # /rest/v1/<table> の最後の要素
+    return url.path.rstrip('/').rsplit('/', 1)[-1]
+
+
+def _on_request(request: "httpx.Request"):
+    SUPABASE_PAYLOAD_BYTES.labels(table=_table_from_url(request.url), direction='sent').inc(len(request.content))
+
+
+def _on_response(response: "httpx.Response"):
+    # フック内で本文を読み込んでおく（後続のJSONデコードは読み込み済みの本文を使う）
+    response.read()
+    SUPABASE_PAYLOAD_BYTES.labels(table=_table_from_url(response.request.url), direction='received').inc(
+        len(response.content)
+    )
+
+
+def instrument_http_client(session: "httpx.Client"):
+    """PostgRESTのhttpxクライアントに送受信バイト数を記録するフックを追加"""
+    session.event_hooks['request'].append(_on_request)
+    session.event_hooks['response'].append(_on_response)
+
+
+def register_pool_gauges(snapshot):
+    """コネクションプールの接続数をスクレイプ時に snapshot() から取得するゲージを登録"""
+    for state in ('idle', 'active'):
+        SUPABASE_POOL_CONNECTIONS.labels(state=state).set_function(lambda state=state: snapshot()[state])
+
+
+def render():
+    """/metrics のレスポンス本文とContent-Type"""
+    return generate_latest(), CONTENT_TYPE_LATEST
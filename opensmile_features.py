@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+OpenSMILE Feature Statistics
+============================
+emotion_extractor_result.selected_features_timeline（1秒毎の特徴量の辞書リスト）を
+タイムブロックごとに1回だけNumPy配列へ変換し、プロンプト生成に必要な統計量をまとめて計算する
+
+両方のプロンプト（generate_timeblock_prompt / generate_timeblock_prompt_v2）が同じ値を使う。
+"""
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, List, Optional
+
+if TYPE_CHECKING:
+    # NumPyのインポートは重いため、最初の変換時（または起動時のウォームアップ）まで遅らせる
+    import numpy as np
+
+
+LOUDNESS_KEY = 'Loudness_sma3'
+JITTER_KEY = 'jitterLocal_sma3nz'
+
+
+@dataclass
+class OpenSmileFeatures:
+    """1タイムブロック分のOpenSMILE時系列（列形式）と統計量"""
+    timestamps: List[Any]
+    loudness: "np.ndarray"
+    jitter: "np.ndarray"
+
+    # 統計量（from_timeline で一括計算）
+    avg_loudness: float = 0.0
+    max_loudness: float = 0.0
+    min_loudness: float = 0.0
+    avg_jitter: float = 0.0
+    max_jitter: float = 0.0
+    silent_seconds: int = 0      # Jitter=0（発話なし）の秒数
+    speaking_seconds: int = 0    # Jitter>0（人の声あり）の秒数
+
+    @property
+    def total_seconds(self) -> int:
+        return len(self.jitter)
+
+    @property
+    def speech_ratio(self) -> float:
+        return self.speaking_seconds / self.total_seconds if self.total_seconds > 0 else 0
+
+    @classmethod
+    def from_timeline(cls, timeline: Optional[list]) -> Optional["OpenSmileFeatures"]:
+        """
+        selected_features_timeline から生成（データがない場合はNone）
+        特徴量が欠けている秒は0として扱う
+        """
+        if not timeline:
+            return None
+
+        import numpy as np
+
+        feature_rows = [item.get('features') or {} for item in timeline]
+        loudness = np.fromiter(
+            (features.get(LOUDNESS_KEY) or 0 for features in feature_rows), dtype=np.float64, count=len(feature_rows)
+        )
+        jitter = np.fromiter(
+            (features.get(JITTER_KEY) or 0 for features in feature_rows), dtype=np.float64, count=len(feature_rows)
+        )
+
+        return cls(
+            timestamps=[item.get('timestamp', 'N/A') for item in timeline],
+            loudness=loudness,
+            jitter=jitter,
+            avg_loudness=float(loudness.mean()),
+            max_loudness=float(loudness.max()),
+            min_loudness=float(loudness.min()),
+            avg_jitter=float(jitter.mean()),
+            max_jitter=float(jitter.max()),
+            silent_seconds=int(np.count_nonzero(jitter == 0)),
+            speaking_seconds=int(np.count_nonzero(jitter > 0))
+        )
+
+    def rows(self, limit: int):
+        """先頭から最大limit秒分の (timestamp, loudness, jitter) を返す"""
+        return zip(self.timestamps[:limit], self.loudness[:limit].tolist(), self.jitter[:limit].tolist())
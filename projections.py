@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Query Projections
+=================
+各エンドポイントがSupabase（PostgREST）から取得するカラムを宣言するモジュール
+
+select("*") の代わりに必要なカラムだけを取得し、JSONBカラムは
+"alias:column->key" 形式のサブパスで必要な要素だけをサーバー側で切り出す。
+（例: behavior_extractor_result 全体ではなく events 配列のみ）
+
+使い方:
+    result = await supabase.execute(
+        lambda c: DASHBOARD_SUMMARY_BLOCKS.select(c).eq('device_id', device_id)
+    )
+"""
+
+from dataclasses import dataclass
+from typing import Tuple
+
+
+def jsonb_path(alias: str, column: str, *keys: str) -> str:
+    """JSONBカラムのサブパスを alias 名で取得するselect指定を返す（例: sed_events:behavior_extractor_result->events）"""
+    return f"{alias}:{column}" + "".join(f"->{key}" for key in keys)
+
+
+def or_filter(query, *conditions: str):
+    """
+    PostgRESTの or=(条件1,条件2,...) フィルタを追加する
+    （postgrest-py 0.13系のクエリビルダーには or_ がないため、パラメータを直接追加する）
+    """
+    query.params = query.params.add('or', f"({','.join(conditions)})")
+    return query
+
+
+@dataclass(frozen=True)
+class Projection:
+    """テーブルと取得カラムの組"""
+    table: str
+    columns: Tuple[str, ...]
+
+    def select(self, client, *extra_columns: str):
+        """client.table(table).select(...) を返す（extra_columnsはキー列などの追加カラム）"""
+        return client.table(self.table).select(*extra_columns, *self.columns)
+
+
+# audio_features: プロンプト生成に使う3種類の分析結果
+# - vibe_transcriber_result: トランスクリプト
+# - sed_events: YAMNetの音響イベント（behavior_extractor_result.events）
+# - opensmile_timeline: Kushinadaの感情特徴の時系列（emotion_extractor_result.selected_features_timeline）
+AUDIO_FEATURES_PROMPT = Projection('audio_features', (
+    'vibe_transcriber_result',
+    jsonb_path('sed_events', 'behavior_extractor_result', 'events'),
+    jsonb_path('opensmile_timeline', 'emotion_extractor_result', 'selected_features_timeline'),
+))
+
+# 一括取得時に行を (device_id, date, time_block) に振り分けるためのキー列
+AUDIO_FEATURES_KEY_COLUMNS = ('device_id', 'date', 'time_block')
+# ページング用の並び順（postgrest-py 0.13系は .order() を重ねると order パラメータが重複するため1つにまとめる）
+ORDER_BY_AUDIO_FEATURES_KEY = ','.join(AUDIO_FEATURES_KEY_COLUMNS)
+
+# devices → subjects: 観測対象者情報
+DEVICE_SUBJECT = Projection('devices', ('subject_id',))
+SUBJECT_PROFILE = Projection('subjects', ('subject_id', 'name', 'age', 'gender', 'notes'))
+
+# vibe_whisper: ムードプロンプト用のトランスクリプト
+VIBE_WHISPER_TRANSCRIPTS = Projection('vibe_whisper', ('time_block', 'transcription'))
+
+# dashboard: 日次サマリーの集計に使う列のみ（prompt / analysis_result などの大きい列は取得しない）
+# status / updated_at はインクリメンタル集計の差し替え判定とwatermarkに使う
+DASHBOARD_SUMMARY_BLOCKS = Projection('dashboard', ('time_block', 'summary', 'vibe_score', 'status', 'updated_at'))
+
+# dashboard: 処理済み（completed）の時間帯の検出用
+DASHBOARD_COMPLETED_BLOCKS = Projection('dashboard', ('time_block',))
+
+# dashboard_summary: 前回の集計値
+DASHBOARD_SUMMARY_AGGREGATES = Projection('dashboard_summary', ('aggregates',))
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Content-Addressed Prompt Cache
+==============================
+入力内容（トランスクリプト・SED・OpenSMILE・観測対象者情報・プロンプトバージョン）の
+ハッシュをキーにして生成済みプロンプトを保持するキャッシュと、
+audio_aggregator に最後に書き込んだプロンプトの記録
+
+Lambdaのリトライ・再トリガーで入力が変わっていないタイムブロックが再度要求された場合、
+プロンプトを再生成せず、audio_aggregator の内容も同じであればUPSERTを省略する。
+
+audio_aggregator は (device_id, date) で1日1レコードのため、書き込みの省略は
+「その日のレコードに最後に書き込んだプロンプトが今回と同じ」場合に限る。
+（同じ日の別ブロックが後から書き込まれていれば、通常どおり書き込む）
+
+書き込みの記録はプロセス内のメモリにしかないため、他のワーカー・再起動後は記録がなく
+通常どおり書き込む（省略されないだけで結果は正しい）。逆に他のプロセスがレコードを
+書き換えた場合はこのプロセスからは見えないため、記録は WRITTEN_PROMPT_TTL_SECONDS
+（デフォルト60秒）で失効させ、古い記録で書き込みを省略し続けないようにする。
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Dict, Optional
+
+from ttl_cache import TTLCache, MISSING
+
+
+# プロンプトの生成ロジックを変更した場合は上げる（古いキャッシュを使わないため）
+PROMPT_VERSION = "v3-improved"
+
+# 入力ハッシュ → 生成済みプロンプト
+prompt_cache = TTLCache(
+    ttl_seconds=float(os.getenv("PROMPT_CACHE_TTL_SECONDS", "3600")),
+    max_size=int(os.getenv("PROMPT_CACHE_MAX_SIZE", "4096"))
+)
+
+# (device_id, date) → audio_aggregatorに最後に書き込んだプロンプトのハッシュ
+# 他インスタンス・他経路での更新を長く取りこぼさないよう、プロンプトキャッシュより短いTTLで失効させる
+written_prompts = TTLCache(
+    ttl_seconds=float(os.getenv("WRITTEN_PROMPT_TTL_SECONDS", "60")),
+    max_size=int(os.getenv("WRITTEN_PROMPT_MAX_SIZE", "4096"))
+)
+
+
+def _sha256(payload: Any) -> str:
+    encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def prompt_cache_key(device_id: str, date: str, time_block: str, transcription: Optional[str],
+                     sed_data: Optional[list], opensmile_data: Optional[list],
+                     subject_info: Optional[Dict], version: str = PROMPT_VERSION) -> str:
+    """プロンプト生成の入力内容から決まるキャッシュキー（sha256）"""
+    return _sha256([
+        version, device_id, date, time_block,
+        transcription, sed_data, opensmile_data, subject_info
+    ])
+
+
+def get_cached_prompt(cache_key: str) -> Optional[str]:
+    """キャッシュ済みのプロンプト（ない場合はNone）"""
+    prompt = prompt_cache.get(cache_key)
+    return None if prompt is MISSING else prompt
+
+
+def cache_prompt(cache_key: str, prompt: str):
+    prompt_cache.set(cache_key, prompt)
+
+
+def is_prompt_written(device_id: str, date: str, prompt: str) -> bool:
+    """audio_aggregatorの (device_id, date) のレコードに最後に書き込んだプロンプトと同じか"""
+    return written_prompts.get((device_id, date)) == _sha256(prompt)
+
+
+def mark_prompt_written(device_id: str, date: str, prompt: str):
+    written_prompts.set((device_id, date), _sha256(prompt))
+
+
+def forget_prompt_written(device_id: str, date: str):
+    """書き込みに失敗した場合など、レコードの内容が不明になったときに記録を消す"""
+    written_prompts.invalidate((device_id, date))
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        "prompts": prompt_cache.stats(),
+        "written_prompts": written_prompts.stats()
+    }
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Query Accounting
+================
+1リクエスト（または任意の処理単位）ごとにSupabase（PostgREST）へのクエリ数と送受信バイト数を数えるモジュール
+
+- 集計対象はcontextvarsで保持するため、同じリクエスト内の並行クエリ（asyncio.gather）もまとめて数えられる
+  （AsyncSupabaseClient.execute がコンテキストごとワーカースレッドに引き継ぐ）
+- QUERY_STATS_HEADERS が有効な場合、レスポンスヘッダー（X-DB-Queries など）にリクエストごとの値を付与する
+- query_budget() でクエリ数の上限を検証できる（N+1パターンの混入をテスト・ベンチマークで検出する用途。
+  エンドポイントごとの上限は tests/test_query_budgets.py で検証している）
+
+使い方:
+    with query_accounting.query_budget(max_queries=4):
+        await process_timeblock_v3(supabase, device_id, date, time_block)
+"""
+
+import contextvars
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+
+HEADER_QUERIES = "X-DB-Queries"
+HEADER_BYTES_SENT = "X-DB-Bytes-Sent"
+HEADER_BYTES_RECEIVED = "X-DB-Bytes-Received"
+
+
+class QueryBudgetExceeded(AssertionError):
+    """クエリ数・受信バイト数が上限を超えた（テストでは失敗として扱われる）"""
+
+
+class QueryStats:
+    """クエリ数・送受信バイト数の集計（複数のワーカースレッドから更新される）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.by_table: Counter = Counter()
+
+    def record_query(self, table: str, method: str):
+        with self._lock:
+            self.queries += 1
+            self.by_table[f"{method} {table}"] += 1
+
+    def record_bytes(self, sent: int = 0, received: int = 0):
+        with self._lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def headers(self) -> Dict[str, str]:
+        return {
+            HEADER_QUERIES: str(self.queries),
+            HEADER_BYTES_SENT: str(self.bytes_sent),
+            HEADER_BYTES_RECEIVED: str(self.bytes_received),
+        }
+
+    def to_dict(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "queries": self.queries,
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "by_table": dict(self.by_table),
+            }
+
+
+_current_stats: contextvars.ContextVar[Optional[QueryStats]] = contextvars.ContextVar("query_stats", default=None)
+
+
+def headers_enabled() -> bool:
+    return os.getenv("QUERY_STATS_HEADERS", "false").lower() in ("1", "true", "yes")
+
+
+def current() -> Optional[QueryStats]:
+    """現在のコンテキストの集計（集計中でなければNone）"""
+    return _current_stats.get()
+
+
+@contextmanager
+def track() -> Iterator[QueryStats]:
+    """ブロック内のクエリを新しいQueryStatsに集計する"""
+    stats = QueryStats()
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+def record_query(table: str, method: str):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.record_query(table, method)
+
+
+def record_bytes(sent: int = 0, received: int = 0):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.record_bytes(sent=sent, received=received)
+
+
+def check_budget(stats: QueryStats, max_queries: int, max_bytes_received: Optional[int] = None, label: str = ""):
+    """集計値が上限以内であることを検証する（超過時は QueryBudgetExceeded）"""
+    prefix = f"{label}: " if label else ""
+    if stats.queries > max_queries:
+        raise QueryBudgetExceeded(
+            f"{prefix}{stats.queries} queries exceeded the budget of {max_queries} ({dict(stats.by_table)})"
+        )
+    if max_bytes_received is not None and stats.bytes_received > max_bytes_received:
+        raise QueryBudgetExceeded(
+            f"{prefix}{stats.bytes_received} bytes received exceeded the budget of {max_bytes_received}"
+        )
+
+
+@contextmanager
+def query_budget(max_queries: int, max_bytes_received: Optional[int] = None, label: str = "") -> Iterator[QueryStats]:
+    """ブロック内のクエリ数（と受信バイト数）が上限以内であることを検証する"""
+    with track() as stats:
+        yield stats
+    check_budget(stats, max_queries, max_bytes_received, label)
+
+
+def _on_request(request):
+    record_bytes(sent=len(request.content))
+
+
+def _on_response(response):
+    response.read()
+    record_bytes(received=len(response.content))
+
+
+def instrument_http_client(session):
+    """PostgRESTのhttpxクライアントに、現在のコンテキストの集計へ送受信バイト数を加えるフックを追加"""
+    session.event_hooks['request'].append(_on_request)
+    session.event_hooks['response'].append(_on_response)
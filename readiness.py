@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Readiness
+=========
+起動時のウォームアップ（重いモジュールのインポート、Supabaseクライアントの生成・疎通確認、
+カレンダーインデックスの構築、キャッシュの事前読み込みなど）の進捗を保持するモジュール
+
+- /health（プロセスが生きているか）とは別に、/ready はウォームアップが完了するまで503を返す
+  （ロードバランサー・デプロイのヘルスチェックは /ready を使うことで、デプロイ直後の初回リクエストが遅くならない）
+- ステップごとの所要時間・状態・試行回数を /ready のレスポンスで確認できる
+- 失敗したステップは間隔を倍々に延ばしながら上限回数まで再試行する。failed になった後も
+  ウォームアップが成功すれば ready に戻る
+
+使い方:
+    await readiness.state.run_step("calendar_index", asyncio.to_thread, build_calendar_index)
+    readiness.state.mark_ready()
+"""
+
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import structured_logging
+
+
+logger = structured_logging.get_logger(__name__)
+
+
+STARTING = "starting"
+WARMING_UP = "warming_up"
+READY = "ready"
+FAILED = "failed"
+
+
+class ReadinessState:
+    """ウォームアップの状態（starting → warming_up → ready / failed）とステップごとの結果"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.status = STARTING
+        self.steps: Dict[str, Dict[str, Any]] = {}
+        self.error: Optional[str] = None
+        self.started_at = time.perf_counter()
+        self.ready_at: Optional[str] = None
+        self.warmup_seconds: Optional[float] = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self.status == READY
+
+    def step_done(self, name: str) -> bool:
+        return self.steps.get(name, {}).get("status") == "done"
+
+    async def run_step(self, name: str, fn: Callable[..., Awaitable[Any]], *args,
+                       attempts: int = 1, retry_interval: float = 1.0, max_retry_interval: float = 60.0) -> Any:
+        """
+        ウォームアップの1ステップを実行して所要時間を記録する
+        失敗した場合は retry_interval 秒（以降は倍々、最大 max_retry_interval 秒）待って、最大 attempts 回まで試行する
+        （全て失敗した場合は最後の例外を送出）
+        """
+        if self.status == STARTING:
+            self.status = WARMING_UP
+        delay = retry_interval
+        for attempt in range(1, max(1, attempts) + 1):
+            self.steps[name] = {"status": "running", "attempt": attempt}
+            start = time.perf_counter()
+            try:
+                result = await fn(*args)
+            except Exception as e:
+                self.steps[name] = {"status": FAILED, "seconds": round(time.perf_counter() - start, 3), "attempt": attempt, "error": str(e)}
+                if attempt >= attempts:
+                    raise
+                logger.warning("⚠️ Warmup step failed, retrying: %s", e, extra={"step": name, "attempt": attempt, "retry_in_seconds": delay})
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_retry_interval)
+                continue
+            seconds = round(time.perf_counter() - start, 3)
+            self.steps[name] = {"status": "done", "seconds": seconds, "attempt": attempt}
+            logger.info("🔥 Warmup step done: %s", name, extra={"step": name, "seconds": seconds})
+            return result
+
+    def mark_ready(self):
+        self.status = READY
+        self.error = None
+        self.ready_at = datetime.now(timezone.utc).isoformat()
+        self.warmup_seconds = round(time.perf_counter() - self.started_at, 3)
+        logger.info("✅ Warmup completed, ready to serve", extra={"warmup_seconds": self.warmup_seconds})
+
+    def mark_failed(self, error: Exception):
+        """必須のステップが上限回数まで失敗した（再試行が成功すれば mark_ready で ready に戻る）"""
+        self.status = FAILED
+        self.error = str(error)
+        logger.error("❌ Warmup failed: %s", error)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "status": self.status,
+            "ready_at": self.ready_at,
+            "warmup_seconds": self.warmup_seconds,
+            "steps": self.steps,
+            "error": self.error
+        }
+
+
+# アプリケーション全体で共有する状態
+state = ReadinessState()
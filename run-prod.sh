@@ -31,10 +31,13 @@ docker-compose -f docker-compose.prod.yml down
 echo -e "\n${YELLOW}▶️  新しいコンテナを起動中...${NC}"
 docker-compose -f docker-compose.prod.yml up -d
 
-# 5. ヘルスチェック
+# 5. ヘルスチェック（ウォームアップ完了まで最大60秒待つ）
 echo -e "\n${YELLOW}🔍 ヘルスチェック中...${NC}"
-sleep 5
-curl -f http://localhost:8009/health
+for i in $(seq 1 30); do
+    curl -sf http://localhost:8009/ready > /dev/null && break
+    sleep 2
+done
+curl -f http://localhost:8009/ready
 if [ $? -eq 0 ]; then
     echo -e "\n${GREEN}✅ ヘルスチェック成功${NC}"
 else
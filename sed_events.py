@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+SED Event Summary
+=================
+behavior_extractor_result.events（YAMNetの {label, prob} リスト）を
+タイムブロックごとに1回だけ要約し、両方のプロンプト生成で共有するモジュール
+
+- 全件ソートの代わりに上位k件のみを選択（heapq.nlargest。sorted(...)[:k] と同じ順序）
+- ラベルはIDに変換（intern）し、Speech / 子供の声 / ノイズの判定はラベルごとに1回だけ行う
+- 確率帯（70%以上 / 40-70%）の件数は1パスで集計
+"""
+
+import heapq
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+
+# 上位イベントとして保持する件数（詳細リスト・子供の声・多様性の判定に使う）
+TOP_K = 20
+
+HIGH_PROB_THRESHOLD = 0.7
+MID_PROB_THRESHOLD = 0.4
+ACTIVITY_PROB_THRESHOLD = 0.3
+
+# ラベルのカテゴリフラグ
+FLAG_SPEECH = 1
+FLAG_CHILD = 2
+FLAG_NOISE = 4
+
+
+class LabelRegistry:
+    """ラベル文字列 ↔ ラベルID の対応とカテゴリフラグを保持（YAMNetのクラス数で上限がある）"""
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._labels: List[str] = []
+        self._flags: List[int] = []
+        self._lock = threading.Lock()
+
+    def intern(self, label: str) -> int:
+        label_id = self._ids.get(label)
+        if label_id is not None:
+            return label_id
+
+        with self._lock:
+            label_id = self._ids.get(label)
+            if label_id is None:
+                flags = 0
+                if 'Speech' in label:
+                    flags |= FLAG_SPEECH
+                if 'Child' in label or 'Baby' in label:
+                    flags |= FLAG_CHILD
+                if 'Noise' in label:
+                    flags |= FLAG_NOISE
+
+                label_id = len(self._labels)
+                self._labels.append(label)
+                self._flags.append(flags)
+                self._ids[label] = label_id
+            return label_id
+
+    def label(self, label_id: int) -> str:
+        return self._labels[label_id]
+
+    def flags(self, label_id: int) -> int:
+        return self._flags[label_id]
+
+
+label_registry = LabelRegistry()
+
+
+@dataclass
+class SedSummary:
+    """1タイムブロック分の音響イベント要約"""
+    total_events: int
+    # 確率順の上位イベント (label_id, prob)
+    top_events: List[Tuple[int, float]] = field(default_factory=list)
+    high_prob_count: int = 0
+    mid_prob_count: int = 0
+    # Speechを含むラベルの最大確率（%）
+    speech_prob: float = 0
+
+    @classmethod
+    def from_events(cls, events: Optional[list], top_k: int = TOP_K) -> Optional["SedSummary"]:
+        """events から生成（データがない場合はNone）"""
+        if not events:
+            return None
+
+        label_ids = []
+        probs = []
+        high_prob_count = 0
+        mid_prob_count = 0
+        speech_prob = 0
+
+        for event in events:
+            prob = event.get('prob', 0) or 0
+            label_id = label_registry.intern(str(event.get('label', 'Unknown')))
+            label_ids.append(label_id)
+            probs.append(prob)
+
+            if prob >= HIGH_PROB_THRESHOLD:
+                high_prob_count += 1
+            elif prob >= MID_PROB_THRESHOLD:
+                mid_prob_count += 1
+
+            if label_registry.flags(label_id) & FLAG_SPEECH and prob * 100 > speech_prob:
+                speech_prob = prob * 100
+
+        top_indices = heapq.nlargest(top_k, range(len(probs)), key=probs.__getitem__)
+
+        return cls(
+            total_events=len(events),
+            top_events=[(label_ids[i], probs[i]) for i in top_indices],
+            high_prob_count=high_prob_count,
+            mid_prob_count=mid_prob_count,
+            speech_prob=speech_prob
+        )
+
+    def top(self, limit: int) -> List[Tuple[str, float]]:
+        """確率順の上位limit件の (label, prob)"""
+        return [(label_registry.label(label_id), prob) for label_id, prob in self.top_events[:limit]]
+
+    def _any_flag(self, flag: int, limit: int) -> bool:
+        return any(label_registry.flags(label_id) & flag for label_id, _ in self.top_events[:limit])
+
+    @property
+    def has_child_voice(self) -> bool:
+        """上位20件に子供・赤ちゃんの声があるか"""
+        return self._any_flag(FLAG_CHILD, 20)
+
+    @property
+    def has_noise(self) -> bool:
+        """上位10件に環境ノイズがあるか"""
+        return self._any_flag(FLAG_NOISE, 10)
+
+    @property
+    def activity_diversity(self) -> int:
+        """上位20件のうち確率30%超のイベント数"""
+        return sum(1 for _, prob in self.top_events[:20] if prob > ACTIVITY_PROB_THRESHOLD)
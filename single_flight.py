@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Single-Flight
+=============
+同じキーの処理が実行中の場合、新しく実行せずに実行中の処理の結果（例外を含む）を共有するモジュール
+
+Lambdaのリトライやトリガーの重複で同じ (device_id, date, time_block) / (device_id, date) の
+リクエストが同時に届いた場合に、Supabaseからの重複取得・プロンプトの重複生成・UPSERTの競合を防ぐ。
+
+- 処理は最初のリクエストとは別のタスクで実行するため、最初のリクエストが切断（キャンセル）されても
+  相乗りしている他のリクエストには結果が返る
+- 処理は呼び出し側が渡した budget（エンドポイントのデフォルトの上限）を deadline として実行し、
+  各リクエストは自分の deadline までだけ結果を待つ
+  （最初のリクエストの短い X-Request-Timeout で、後から相乗りしたリクエストが504にならないように）
+- 結果は共有されるため、呼び出し側で変更しないこと
+- 完了した処理の結果は保持しない（キャッシュではない）
+
+使い方:
+    result = await timeblock_flight.do((device_id, date, time_block), lambda: process(...),
+                                       budget=deadlines.default_budget(request.url.path))
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+import deadlines
+import metrics
+import structured_logging
+
+
+logger = structured_logging.get_logger(__name__)
+
+
+class SingleFlight:
+    """キーごとに実行中の処理（asyncio.Task）を1つだけ保持する"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]], budget: Optional[float] = None) -> Any:
+        """
+        key の処理が実行中ならその結果を待ち、なければ fn() を実行して結果を返す
+        budget: fn() の処理時間の上限（秒、Noneの場合はdeadlineなし）。最初の呼び出し側の deadline は引き継がない
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            # タスクは作成時のコンテキストを引き継ぐため、呼び出し側の deadline を budget で置き換えてから作成する
+            with deadlines.deadline(budget):
+                task = asyncio.create_task(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done, key=key: self._finish(key, done))
+            self.executions += 1
+        else:
+            self.coalesced += 1
+            metrics.SINGLE_FLIGHT_COALESCED.labels(name=self.name).inc()
+            logger.info("🔗 Joined in-flight request", extra={"single_flight": self.name, "key": list(key) if isinstance(key, tuple) else key})
+        # 待っているリクエストがキャンセル・時間切れになっても処理自体は続ける
+        left = deadlines.remaining()
+        if left is None:
+            return await asyncio.shield(task)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), max(left, 0))
+        except asyncio.TimeoutError:
+            if task.done():
+                raise
+            raise deadlines.DeadlineExceeded("実行中の同じ処理の完了待ち中")
+
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # 全員がキャンセルして誰も結果を受け取らなかった場合の警告（exception was never retrieved）を防ぐ
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._in_flight),
+            "executions": self.executions,
+            "coalesced": self.coalesced
+        }
+
+
+# /generate-timeblock-prompt: (device_id, date, time_block)
+timeblock_flight = SingleFlight("timeblock_prompt")
+# /generate-dashboard-summary: (device_id, date)
+dashboard_summary_flight = SingleFlight("dashboard_summary")
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Structured Logging
+==================
+JSON形式の構造化ログを、キュー経由でバックグラウンドスレッドから出力するモジュール
+
+- リクエスト処理側（イベントループ）はログレコードをキューに積むだけで、stdoutへの書き込みを待たない
+  （QueueHandler → QueueListener）
+- 各レコードには request_id / device_id（contextvarsで保持）を自動で付与する
+- レベルごとのサンプリング（LOG_SAMPLE_RATES="DEBUG=0.1,INFO=0.5" など）で高負荷時のログ量を抑える
+  （サンプリングで捨てるレコードはメッセージの組み立て前に破棄される。そのため値はf-stringで埋め込まず、
+  %s の引数か extra で渡す）
+
+使い方:
+    logger = structured_logging.get_logger(__name__)
+    logger.info("✅ Prompt saved", extra={"date": date, "time_block": time_block})
+    logger.error("Error fetching subject info: %s", e, extra={"device_id": device_id})
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+
+ROOT_LOGGER_NAME = "vibe_aggregator"
+
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+device_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("device_id", default=None)
+
+# LogRecordの標準属性（extraで渡されたフィールドと区別するため）
+_STANDARD_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+
+def bind_request(request_id: Optional[str], device_id: Optional[str] = None):
+    """現在のコンテキスト（リクエスト）に request_id / device_id を設定し、reset用のトークンを返す"""
+    return request_id_var.set(request_id), device_id_var.set(device_id)
+
+
+def reset_request(tokens):
+    request_token, device_token = tokens
+    request_id_var.reset(request_token)
+    device_id_var.reset(device_token)
+
+
+def parse_sample_rates(value: str) -> Dict[int, float]:
+    """ "DEBUG=0.1,INFO=0.5" → {logging.DEBUG: 0.1, logging.INFO: 0.5} """
+    rates = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        level_name, rate = item.split("=", 1)
+        level = logging.getLevelName(level_name.strip().upper())
+        if isinstance(level, int):
+            rates[level] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """レベルごとの割合でレコードを間引く（指定のないレベルは全件出力）"""
+
+    def __init__(self, rates: Dict[int, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    キューに積む前に request_id / device_id を付与し、メッセージ・例外を文字列化するQueueHandler
+    （contextvarsはログを出したスレッド・タスクでしか参照できないため、ここで取り込む）
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+
+        if not hasattr(record, "request_id"):
+            record.request_id = request_id_var.get()
+        if not hasattr(record, "device_id") or record.device_id is None:
+            record.device_id = device_id_var.get()
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコード1行のJSON（extraで渡したフィールドもそのまま出力）"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_RECORD_ATTRS and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    """
+    ルートロガー（vibe_aggregator）にキュー出力を設定し、出力スレッドを開始する（複数回呼んでも1回だけ）
+    - LOG_LEVEL: 出力レベル（デフォルト INFO）
+    - LOG_SAMPLE_RATES: レベルごとのサンプリング率（例: DEBUG=0.1,INFO=0.5）
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+
+    queue_handler = ContextQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", ""))))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    root.handlers = [queue_handler]
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """キューに残っているログを出力して出力スレッドを停止"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """vibe_aggregator 配下のロガー（初回呼び出し時にキュー出力を設定）"""
+    setup_logging()
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Supabase HTTP Connection Pool
+=============================
+Supabase（PostgREST）呼び出しで共有するhttpxセッション（コネクションプール）の設定と統計
+
+- 全ワーカースレッドが1つのセッション（httpx.Client はスレッドセーフ）を共有し、
+  時間帯リクエストが集中してもTLS接続を張り直さずにkeep-alive中の接続を再利用する
+- プールサイズ・keep-alive・HTTP/2・タイムアウトは環境変数で調整可能
+- 呼び出しごとのタイムアウトは call_timeout（contextvar）で上書きできる
+- 新規接続数（TCP接続・TLSハンドシェイク）とプール内の接続の状態を統計として返す
+
+supabase-py / httpx のインポートは重いため、セッション生成時まで遅らせる。
+"""
+
+import contextvars
+import os
+import threading
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Optional
+
+import metrics
+
+
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 10
+DEFAULT_KEEPALIVE_EXPIRY_SECONDS = 30.0
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 5.0
+DEFAULT_READ_TIMEOUT_SECONDS = 10.0
+DEFAULT_WRITE_TIMEOUT_SECONDS = 10.0
+DEFAULT_POOL_TIMEOUT_SECONDS = 5.0
+
+# 呼び出しごとのタイムアウト（秒、Noneの場合はセッションのデフォルト）
+call_timeout: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("supabase_call_timeout", default=None)
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes")
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    """コネクションプールとタイムアウトの設定"""
+    max_connections: int = DEFAULT_MAX_CONNECTIONS
+    max_keepalive_connections: int = DEFAULT_MAX_KEEPALIVE_CONNECTIONS
+    keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY_SECONDS
+    http2: bool = True
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT_SECONDS
+    read_timeout: float = DEFAULT_READ_TIMEOUT_SECONDS
+    write_timeout: float = DEFAULT_WRITE_TIMEOUT_SECONDS
+    pool_timeout: float = DEFAULT_POOL_TIMEOUT_SECONDS
+
+    @classmethod
+    def from_env(cls) -> "PoolConfig":
+        return cls(
+            max_connections=int(os.getenv("SUPABASE_POOL_MAX_CONNECTIONS", str(DEFAULT_MAX_CONNECTIONS))),
+            max_keepalive_connections=int(os.getenv("SUPABASE_POOL_MAX_KEEPALIVE", str(DEFAULT_MAX_KEEPALIVE_CONNECTIONS))),
+            keepalive_expiry=float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY_SECONDS", str(DEFAULT_KEEPALIVE_EXPIRY_SECONDS))),
+            http2=_env_bool("SUPABASE_HTTP2", True),
+            connect_timeout=float(os.getenv("SUPABASE_CONNECT_TIMEOUT_SECONDS", str(DEFAULT_CONNECT_TIMEOUT_SECONDS))),
+            read_timeout=float(os.getenv("SUPABASE_READ_TIMEOUT_SECONDS", str(DEFAULT_READ_TIMEOUT_SECONDS))),
+            write_timeout=float(os.getenv("SUPABASE_WRITE_TIMEOUT_SECONDS", str(DEFAULT_WRITE_TIMEOUT_SECONDS))),
+            pool_timeout=float(os.getenv("SUPABASE_POOL_TIMEOUT_SECONDS", str(DEFAULT_POOL_TIMEOUT_SECONDS)))
+        )
+
+
+class PoolStats:
+    """新規接続数などのカウンター（httpxのtrace拡張から更新される）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+        self.tls_handshakes = 0
+
+    def trace(self, event_name: str, info: Dict[str, Any]):
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.connections_opened += 1
+            metrics.SUPABASE_CONNECTIONS_OPENED.inc()
+        elif event_name == "connection.start_tls.complete":
+            with self._lock:
+                self.tls_handshakes += 1
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "connections_opened": self.connections_opened,
+                "tls_handshakes": self.tls_handshakes,
+                # 1接続あたりのリクエスト数（大きいほど接続を再利用できている）
+                "requests_per_connection": round(self.requests / self.connections_opened, 2) if self.connections_opened else None
+            }
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_session(base_url: str, headers: Dict[str, str], config: PoolConfig, stats: PoolStats):
+    """
+    PostgRESTクライアントに差し込む共有セッションを生成
+    （SUPABASE_HTTP2 が有効でも h2 がインストールされていない場合はHTTP/1.1で接続する）
+    """
+    import httpx
+    from postgrest.utils import SyncClient
+
+    class PooledSession(SyncClient):
+        """呼び出しごとのタイムアウトと接続数の計測を追加したPostgREST用セッション"""
+
+        def request(self, method, url, **kwargs):
+            timeout = call_timeout.get()
+            if timeout is not None and "timeout" not in kwargs:
+                kwargs["timeout"] = timeout
+            extensions = dict(kwargs.pop("extensions", None) or {})
+            extensions.setdefault("trace", stats.trace)
+            stats.count_request()
+            return super().request(method, url, extensions=extensions, **kwargs)
+
+    http2 = config.http2 and _http2_available()
+    session = PooledSession(
+        base_url=base_url,
+        headers=headers,
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=config.max_connections,
+            max_keepalive_connections=config.max_keepalive_connections,
+            keepalive_expiry=config.keepalive_expiry
+        ),
+        timeout=httpx.Timeout(
+            connect=config.connect_timeout,
+            read=config.read_timeout,
+            write=config.write_timeout,
+            pool=config.pool_timeout
+        )
+    )
+    session.http2_enabled = http2
+    return session
+
+
+def pool_snapshot(session) -> Dict[str, int]:
+    """
+    プール内の接続数（idle: keep-alive中 / active: リクエスト処理中 / http2: HTTP/2接続）
+    httpx / httpcore の内部属性を読むため（公開APIがない）、バージョンの違いで読めない場合は0のまま返す
+    """
+    snapshot = {"connections": 0, "idle": 0, "active": 0, "http2": 0}
+    try:
+        pool = getattr(getattr(session, "_transport", None), "_pool", None)
+        connections = list(getattr(pool, "connections", None) or [])
+        counts = {"connections": 0, "idle": 0, "active": 0, "http2": 0}
+        for connection in connections:
+            counts["connections"] += 1
+            if connection.is_idle():
+                counts["idle"] += 1
+            else:
+                counts["active"] += 1
+            if "HTTP/2" in str(connection.info()):
+                counts["http2"] += 1
+    except Exception:
+        return snapshot
+    return counts
+
+
+def describe(config: PoolConfig, stats: PoolStats, session=None) -> Dict[str, Any]:
+    """設定・カウンター・現在のプールの状態をまとめた統計"""
+    return {
+        "config": {**asdict(config), "http2_enabled": getattr(session, "http2_enabled", False)},
+        **stats.to_dict(),
+        "pool": pool_snapshot(session) if session is not None else None
+    }
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+テスト共通のフィクスチャ
+"""
+
+import os
+
+import pytest
+
+from benchmarks.fake_postgrest import FakePostgrestServer, FakePostgrestStore, build_dataset
+from benchmarks.run_benchmarks import FAKE_SUPABASE_KEY
+import main
+
+
+@pytest.fixture(scope="module")
+def fake_postgrest():
+    """
+    benchmarks/fake_postgrest のサーバー（合成データ: 2デバイス×1日）を起動し、
+    アプリのSupabaseクライアントの接続先にする（テーブルの行は store.tables で参照・変更できる）
+    """
+    store = FakePostgrestStore(build_dataset(devices=2, days=1))
+    server = FakePostgrestServer(store).start()
+    env = {"SUPABASE_URL": server.url, "SUPABASE_KEY": FAKE_SUPABASE_KEY}
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    main.supabase_client = None
+    yield store
+    if main.supabase_client is not None:
+        main.supabase_client.shutdown()
+        main.supabase_client = None
+    server.stop()
+    for name, value in saved.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+/backfill-timeblock-prompts の日付範囲の展開・検証と、バックフィルの進捗イベントのテスト
+"""
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import main
+from timeblock_endpoint_v2 import expand_date_range
+
+
+def test_single_day_range():
+    assert expand_date_range("2025-09-01", "2025-09-01") == ["2025-09-01"]
+
+
+def test_end_before_start_is_empty():
+    assert expand_date_range("2025-09-02", "2025-09-01") == []
+
+
+def test_range_crosses_month_year_and_leap_day():
+    assert expand_date_range("2024-02-28", "2024-03-01") == ["2024-02-28", "2024-02-29", "2024-03-01"]
+    assert expand_date_range("2025-02-28", "2025-03-01") == ["2025-02-28", "2025-03-01"]
+    assert expand_date_range("2025-12-31", "2026-01-01") == ["2025-12-31", "2026-01-01"]
+
+
+def test_range_counts_calendar_days_across_dst_changes_elsewhere():
+    # 日付は暦日として数える（他地域の夏時間の切り替え日でも1日ずつ進む）
+    march = expand_date_range("2025-03-08", "2025-03-31")
+    assert len(march) == 24
+    assert march[1] == "2025-03-09"
+    assert len(expand_date_range("2025-01-01", "2025-12-31")) == 365
+
+
+@pytest.mark.parametrize("start_date, end_date", [
+    ("2025/09/01", "2025-09-02"),
+    ("2025-09-01", "2025-09-31"),
+    ("2025-9-1x", "2025-09-02"),
+])
+def test_invalid_dates_raise_value_error(start_date, end_date):
+    with pytest.raises(ValueError):
+        expand_date_range(start_date, end_date)
+
+
+def post_backfill(params):
+    async def send():
+        async with httpx.AsyncClient(app=main.app, base_url="http://test") as client:
+            return await client.post("/backfill-timeblock-prompts", params=params)
+
+    return asyncio.run(send())
+
+
+@pytest.mark.parametrize("start_date, end_date", [
+    ("2025-09-02", "2025-09-01"),
+    ("2025-09-01", "20250902"),
+])
+def test_backfill_rejects_invalid_range(start_date, end_date):
+    response = post_backfill({"device_id": "device-1", "start_date": start_date, "end_date": end_date})
+
+    assert response.status_code == 400
+
+
+def test_backfill_rejects_range_longer_than_max_days(monkeypatch):
+    monkeypatch.setattr(main, "BACKFILL_MAX_DAYS", 3)
+
+    at_limit = expand_date_range("2025-09-01", "2025-09-03")
+    over_limit = post_backfill({"device_id": "device-1", "start_date": "2025-09-01", "end_date": "2025-09-04"})
+
+    assert len(at_limit) == main.BACKFILL_MAX_DAYS
+    assert over_limit.status_code == 400
+    assert "3日" in over_limit.json()["detail"]
+
+
+def test_backfill_streams_progress_for_each_day(fake_postgrest):
+    device_id = fake_postgrest.tables["devices"][0]["device_id"]
+    date = fake_postgrest.tables["audio_features"][0]["date"]
+
+    response = post_backfill({"device_id": device_id, "start_date": date, "end_date": date})
+    events = [json.loads(line) for line in response.text.splitlines()]
+
+    assert response.status_code == 200
+    assert [event["event"] for event in events] == ["start", "day", "done"]
+    assert events[0]["days"] == 1
+    assert events[1]["date"] == date
+    assert events[1]["blocks"] == 48
+    assert events[1]["aggregator_saved"] is True
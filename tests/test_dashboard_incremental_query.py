@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+/generate-dashboard-summary?incremental=true の差分取得クエリのテスト
+postgrest-py（0.13系）の実際のクエリビルダーでクエリを組み立て、送信されるパラメータを確認する
+"""
+
+import asyncio
+
+from postgrest import SyncPostgrestClient
+
+import dashboard_aggregates
+import main
+
+
+class CapturingSupabase:
+    """execute() に渡されたクエリを実行せずに保持する"""
+
+    def __init__(self):
+        self.queries = []
+
+    async def execute(self, build, **kwargs):
+        query = build(SyncPostgrestClient("http://localhost:3000"))
+        self.queries.append(query)
+        return type("Response", (), {"data": []})()
+
+
+def build_incremental_query(aggregates):
+    supabase = CapturingSupabase()
+    asyncio.run(main.fetch_dashboard_blocks_since(supabase, "device-1", "2025-09-01", aggregates))
+    assert len(supabase.queries) == 1
+    return supabase.queries[0]
+
+
+def test_incremental_query_uses_or_filter_for_new_and_updated_blocks(monkeypatch):
+    monkeypatch.setattr(main, "DASHBOARD_WATERMARK_OVERLAP_SECONDS", 300.0)
+    query = build_incremental_query({"last_time_block": "10-00", "watermark": "2025-09-01T10:15:00+00:00"})
+
+    assert query.path == "/dashboard"
+    # watermarkから overlap 分遡って再取得する
+    assert query.params.get_list("or") == ['(time_block.gt."10-00",updated_at.gte."2025-09-01T10:10:00+00:00")']
+    assert query.params.get_list("device_id") == ["eq.device-1"]
+    assert query.params.get_list("date") == ["eq.2025-09-01"]
+    assert query.params.get_list("order") == ["time_block"]
+
+
+def test_incremental_query_without_watermark_filters_by_time_block_only():
+    query = build_incremental_query({"last_time_block": "10-00", "watermark": None})
+
+    assert query.params.get_list("or") == []
+    assert query.params.get_list("time_block") == ["gt.10-00"]
+
+
+def test_watermark_is_max_updated_at_of_rows_read():
+    aggregates = dashboard_aggregates.build_aggregates([
+        {"time_block": "10-00", "vibe_score": 10, "updated_at": "2025-09-01T10:40:00+00:00"},
+        {"time_block": "10-30", "vibe_score": 20, "updated_at": "2025-09-01T11:05:00+00:00"},
+        {"time_block": "11-00", "vibe_score": None, "status": "failed", "updated_at": "2025-09-01T11:02:00+00:00"},
+    ])
+
+    assert aggregates["watermark"] == "2025-09-01T11:05:00+00:00"
+
+
+def test_watermark_overlap_keeps_unparsable_value():
+    assert dashboard_aggregates.watermark_with_overlap("2025-09-01T10:15:00", 60) == "2025-09-01T10:14:00"
+    assert dashboard_aggregates.watermark_with_overlap("not-a-timestamp", 60) == "not-a-timestamp"
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+/create-failed-records の欠損時間帯の検出と一括作成のテスト
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+def test_time_blocks_until_includes_the_given_block():
+    assert main.get_time_blocks_until("00-00") == ["00-00"]
+    assert main.get_time_blocks_until("01-30") == ["00-00", "00-30", "01-00", "01-30"]
+    assert main.get_time_blocks_until("23-30") == main.get_time_blocks()
+    assert len(main.get_time_blocks_until()) == 48
+
+
+@pytest.mark.parametrize("until_time_block", ["24-00", "10-15", "1-30", "10:30", ""])
+def test_time_blocks_until_rejects_invalid_block(until_time_block):
+    with pytest.raises(ValueError):
+        main.get_time_blocks_until(until_time_block)
+
+
+def test_missing_blocks_keep_time_order():
+    time_blocks = main.get_time_blocks_until("03-00")
+    completed = ["02-30", "00-00", "01-00"]
+
+    assert main.find_missing_time_blocks(time_blocks, completed) == ["00-30", "01-30", "02-00", "03-00"]
+
+
+def test_missing_blocks_when_nothing_or_everything_is_completed():
+    time_blocks = main.get_time_blocks()
+
+    assert main.find_missing_time_blocks(time_blocks, []) == time_blocks
+    assert main.find_missing_time_blocks(time_blocks, time_blocks) == []
+
+
+def test_completed_blocks_after_until_are_ignored():
+    time_blocks = main.get_time_blocks_until("00-30")
+
+    assert main.find_missing_time_blocks(time_blocks, ["12-00", "23-30"]) == ["00-00", "00-30"]
+
+
+def request(method, path, **kwargs):
+    async def send():
+        async with httpx.AsyncClient(app=main.app, base_url="http://test") as client:
+            return await client.request(method, path, **kwargs)
+
+    return asyncio.run(send())
+
+
+def test_create_failed_records_fills_only_missing_blocks(fake_postgrest):
+    device_id = fake_postgrest.tables["devices"][0]["device_id"]
+    date = fake_postgrest.tables["dashboard"][0]["date"]
+    removed = {"10-00", "10-30", "22-00"}
+    fake_postgrest.tables["dashboard"] = [
+        row for row in fake_postgrest.tables["dashboard"]
+        if not (row["device_id"] == device_id and row["time_block"] in removed)
+    ]
+    params = {"device_id": device_id, "date": date, "until_time_block": "12-00"}
+
+    response = request("POST", "/create-failed-records", params=params)
+    # 作成後は欠損がないため、もう一度呼んでも作成しない
+    second = request("POST", "/create-failed-records", params=params)
+
+    assert response.status_code == 200
+    assert response.json()["time_blocks"] == ["10-00", "10-30"]
+    assert response.json()["created_count"] == 2
+    created = [
+        row for row in fake_postgrest.tables["dashboard"]
+        if row["device_id"] == device_id and row["time_block"] in removed
+    ]
+    assert sorted(row["time_block"] for row in created) == ["10-00", "10-30"]
+    assert all(row["status"] == "completed" and row["vibe_score"] == 0 for row in created)
+    assert second.json()["created_count"] == 0
+
+
+def test_create_failed_records_rejects_invalid_input(fake_postgrest):
+    device_id = fake_postgrest.tables["devices"][0]["device_id"]
+
+    invalid_block = request("POST", "/create-failed-records",
+                            params={"device_id": device_id, "date": "2025-09-01", "until_time_block": "25-00"})
+    invalid_date = request("POST", "/create-failed-records", params={"device_id": device_id, "date": "2025/09/01"})
+
+    assert invalid_block.status_code == 400
+    assert invalid_date.status_code == 400
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+jobs.JobQueue と /jobs/{job_id} のテスト
+有界キューの受付拒否、ジョブの状態遷移（queued → running → succeeded / failed）、
+結果・エラーの表示、完了後の保持期限を確認する
+"""
+
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import deadlines
+import jobs
+import main
+
+
+async def wait_until_finished(queue, job_id, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while queue.get(job_id).status in (jobs.QUEUED, jobs.RUNNING):
+        assert asyncio.get_running_loop().time() < deadline, "job did not finish"
+        await asyncio.sleep(0.01)
+    return queue.get(job_id)
+
+
+def test_submit_is_rejected_when_queue_is_full():
+    async def scenario():
+        # ワーカーなし: 積んだジョブは queued のまま残る
+        queue = jobs.JobQueue("test", workers=0, max_queue_size=2)
+        queue.start()
+
+        async def noop():
+            return None
+
+        accepted = [queue.submit("kind", {}, noop) for _ in range(2)]
+        with pytest.raises(HTTPException) as rejected:
+            queue.submit("kind", {}, noop)
+        return queue, accepted, rejected.value
+
+    queue, accepted, rejected = asyncio.run(scenario())
+
+    assert [job.status for job in accepted] == [jobs.QUEUED, jobs.QUEUED]
+    assert rejected.status_code == 503
+    assert rejected.headers == {"Retry-After": "1"}
+    assert queue.stats()["queue_depth"] == 2
+    assert (queue.submitted, queue.rejected) == (2, 1)
+
+
+def test_submit_before_start_is_rejected():
+    queue = jobs.JobQueue("test")
+
+    async def noop():
+        return None
+
+    with pytest.raises(HTTPException) as rejected:
+        queue.submit("kind", {}, noop)
+
+    assert rejected.value.status_code == 503
+
+
+def test_job_moves_from_queued_to_running_to_succeeded():
+    async def scenario():
+        queue = jobs.JobQueue("test", workers=1)
+        release = asyncio.Event()
+        statuses = []
+
+        async def work():
+            statuses.append(job.status)
+            await release.wait()
+            return {"status": "success"}
+
+        queue.start()
+        job = queue.submit("kind", {"device_id": "device-1"}, work)
+        statuses.append(job.status)
+        await asyncio.sleep(0.01)
+        running = queue.running()
+        release.set()
+        finished = await wait_until_finished(queue, job.id)
+        await queue.stop()
+        return statuses, running, finished
+
+    statuses, running, job = asyncio.run(scenario())
+
+    assert statuses == [jobs.QUEUED, jobs.RUNNING]
+    assert running == 1
+    assert job.status == jobs.SUCCEEDED
+    assert job.result == {"status": "success"}
+    assert job.error is None
+    assert job.started_at is not None and job.finished_at is not None
+
+
+@pytest.mark.parametrize("error, expected", [
+    (HTTPException(status_code=404, detail="not found"), {"status_code": 404, "detail": "not found"}),
+    (RuntimeError("boom"), {"status_code": 500, "detail": "boom"}),
+])
+def test_failed_job_keeps_status_code_and_detail(error, expected):
+    async def scenario():
+        queue = jobs.JobQueue("test", workers=1)
+        queue.start()
+
+        async def work():
+            raise error
+
+        job = queue.submit("kind", {}, work)
+        finished = await wait_until_finished(queue, job.id)
+        await queue.stop()
+        return finished
+
+    job = asyncio.run(scenario())
+
+    assert job.status == jobs.FAILED
+    assert job.error == expected
+    assert job.result is None
+
+
+def test_job_runs_under_its_budget():
+    async def scenario():
+        queue = jobs.JobQueue("test", workers=1)
+        queue.start()
+
+        async def work():
+            return deadlines.remaining()
+
+        # 受け付けたリクエストの deadline は引き継がない
+        with deadlines.deadline(0.01):
+            job = queue.submit("kind", {}, work, budget=30.0)
+        await asyncio.sleep(0.05)
+        finished = await wait_until_finished(queue, job.id)
+        await queue.stop()
+        return finished
+
+    job = asyncio.run(scenario())
+
+    assert job.status == jobs.SUCCEEDED
+    assert job.result == pytest.approx(30.0, abs=1.0)
+
+
+def test_get_job_endpoint_shows_result_error_and_expiry(monkeypatch):
+    async def scenario():
+        queue = jobs.JobQueue("test", workers=1, result_ttl=0.2)
+        monkeypatch.setattr(jobs, "job_queue", queue)
+        queue.start()
+
+        async def succeed():
+            return {"prompt": "..."}
+
+        async def fail():
+            raise HTTPException(status_code=400, detail="無効な日付形式です。")
+
+        succeeded = queue.submit("timeblock_prompt", {"device_id": "device-1"}, succeed)
+        failed = queue.submit("timeblock_prompt", {"device_id": "device-1"}, fail)
+        await wait_until_finished(queue, succeeded.id)
+        await wait_until_finished(queue, failed.id)
+
+        async with httpx.AsyncClient(app=main.app, base_url="http://test") as client:
+            responses = {
+                "succeeded": await client.get(f"/jobs/{succeeded.id}"),
+                "failed": await client.get(f"/jobs/{failed.id}"),
+                "unknown": await client.get("/jobs/unknown"),
+            }
+            await asyncio.sleep(0.3)
+            responses["expired"] = await client.get(f"/jobs/{succeeded.id}")
+        await queue.stop()
+        return responses
+
+    responses = asyncio.run(scenario())
+
+    succeeded = responses["succeeded"].json()
+    assert responses["succeeded"].status_code == 200
+    assert succeeded["status"] == jobs.SUCCEEDED
+    assert succeeded["kind"] == "timeblock_prompt"
+    assert succeeded["params"] == {"device_id": "device-1"}
+    assert succeeded["result"] == {"prompt": "..."}
+    assert succeeded["error"] is None
+
+    failed = responses["failed"].json()
+    assert failed["status"] == jobs.FAILED
+    assert failed["result"] is None
+    assert failed["error"] == {"status_code": 400, "detail": "無効な日付形式です。"}
+
+    assert responses["unknown"].status_code == 404
+    assert responses["expired"].status_code == 404
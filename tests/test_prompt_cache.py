@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+prompt_cache の書き込み済みプロンプトの記録（audio_aggregator のUPSERT省略）のテスト
+記録の失効・上限と、書き込みの省略・再書き込みを確認する
+"""
+
+import asyncio
+
+import pytest
+
+import prompt_cache
+import timeblock_endpoint
+import write_behind
+from ttl_cache import TTLCache
+
+
+class FakeClock:
+    """手動で進める時計"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(prompt_cache, "written_prompts", TTLCache(ttl_seconds=60, max_size=2, clock=clock))
+    return clock
+
+
+@pytest.fixture
+def upserts(monkeypatch):
+    calls = []
+
+    async def upsert(supabase, table, data, on_conflict):
+        calls.append((table, data["device_id"], data["date"], data["vibe_aggregator_result"]))
+        return False
+
+    monkeypatch.setattr(write_behind, "upsert", upsert)
+    return calls
+
+
+def save(prompt, device_id="device-1", date="2025-09-01"):
+    return asyncio.run(timeblock_endpoint.save_prompt_to_dashboard(None, device_id, date, "10-00", prompt))
+
+
+def test_same_prompt_is_written_once_within_ttl(clock, upserts):
+    assert save("prompt") and save("prompt")
+
+    assert len(upserts) == 1
+
+
+def test_record_expires_so_another_process_cannot_hide_a_revert(clock, upserts):
+    save("prompt")
+    # 他のプロセスがレコードを書き換えていても、TTL経過後は書き直す
+    clock.advance(61)
+    save("prompt")
+
+    assert len(upserts) == 2
+
+
+def test_changed_prompt_is_written(clock, upserts):
+    save("prompt")
+    save("changed")
+
+    assert [call[3] for call in upserts] == ["prompt", "changed"]
+
+
+def test_record_is_bounded_by_max_size(clock, upserts):
+    save("prompt", date="2025-09-01")
+    save("prompt", date="2025-09-02")
+    save("prompt", date="2025-09-03")
+
+    assert prompt_cache.written_prompts.stats()["size"] == 2
+    assert not prompt_cache.is_prompt_written("device-1", "2025-09-01", "prompt")
+    assert prompt_cache.is_prompt_written("device-1", "2025-09-03", "prompt")
+
+
+def test_failed_write_forgets_the_record(clock, monkeypatch):
+    prompt_cache.mark_prompt_written("device-1", "2025-09-01", "prompt")
+
+    async def upsert(supabase, table, data, on_conflict):
+        raise RuntimeError("unavailable")
+
+    monkeypatch.setattr(write_behind, "upsert", upsert)
+
+    assert save("changed") is False
+    assert not prompt_cache.is_prompt_written("device-1", "2025-09-01", "prompt")
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+エンドポイントごとのSupabaseクエリ数の上限（query_accounting.query_budget）のテスト
+benchmarks/fake_postgrest のサーバーに対してアプリを実行し、キャッシュが効いていない1リクエストで
+送られるクエリを確認する（N+1パターンが混入すると失敗する）
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+from benchmarks.run_benchmarks import QUERY_BUDGETS
+import main
+import prompt_cache
+import query_accounting
+import timeblock_endpoint
+
+
+@pytest.fixture(scope="module")
+def dataset(fake_postgrest):
+    return fake_postgrest.tables
+
+
+@pytest.fixture(autouse=True)
+def cold_caches():
+    prompt_cache.prompt_cache.invalidate()
+    prompt_cache.written_prompts.invalidate()
+    timeblock_endpoint.subject_cache.invalidate()
+
+
+def request_within_budget(method, path, max_queries, **kwargs):
+    """1リクエストを実行し、クエリ数が max_queries 以内であることを検証して (レスポンス, 集計) を返す"""
+    async def send():
+        async with httpx.AsyncClient(app=main.app, base_url="http://test") as client:
+            with query_accounting.query_budget(max_queries, label=path) as stats:
+                response = await client.request(method, path, **kwargs)
+            return response, stats
+
+    return asyncio.run(send())
+
+
+def first_key(dataset):
+    row = dataset["audio_features"][0]
+    return row["device_id"], row["date"], row["time_block"]
+
+
+def test_timeblock_prompt_query_budget(dataset):
+    device_id, date, time_block = first_key(dataset)
+
+    response, stats = request_within_budget(
+        "GET", "/generate-timeblock-prompt", QUERY_BUDGETS["timeblock_prompt"],
+        params={"device_id": device_id, "date": date, "time_block": time_block}
+    )
+
+    assert response.status_code == 200
+    assert dict(stats.by_table) == {
+        "GET audio_features": 1,
+        "GET devices": 1,
+        "GET subjects": 1,
+        "POST audio_aggregator": 1,
+    }
+
+
+def test_timeblock_prompts_batch_does_not_query_per_item(dataset):
+    device_id, date, _ = first_key(dataset)
+    blocks = [row["time_block"] for row in dataset["audio_features"] if row["device_id"] == device_id][:10]
+
+    response, stats = request_within_budget(
+        "POST", "/generate-timeblock-prompts", QUERY_BUDGETS["timeblock_prompt"],
+        json={"items": [{"device_id": device_id, "date": date, "time_block": block} for block in blocks]}
+    )
+
+    assert response.status_code == 200
+    assert response.json()["count"] == len(blocks)
+    assert stats.by_table["GET audio_features"] == 1
+    assert stats.by_table["POST audio_aggregator"] == 1
+
+
+def test_dashboard_summary_query_budget(dataset):
+    device_id, date, _ = first_key(dataset)
+
+    response, stats = request_within_budget(
+        "GET", "/generate-dashboard-summary", QUERY_BUDGETS["dashboard_summary"],
+        params={"device_id": device_id, "date": date}
+    )
+
+    assert response.status_code == 200
+    assert dict(stats.by_table) == {
+        "GET dashboard": 1,
+        "GET devices": 1,
+        "GET subjects": 1,
+        "POST dashboard_summary": 1,
+    }
+
+
+def test_dashboard_summary_incremental_query_budget(dataset):
+    device_id, date, _ = first_key(dataset)
+    params = {"device_id": device_id, "date": date, "incremental": "true"}
+    # 1回目で集計値を保存し、2回目は差分取得になる
+    request_within_budget("GET", "/generate-dashboard-summary", QUERY_BUDGETS["dashboard_summary_incremental"], params=params)
+    timeblock_endpoint.subject_cache.invalidate()
+
+    response, stats = request_within_budget(
+        "GET", "/generate-dashboard-summary", QUERY_BUDGETS["dashboard_summary_incremental"], params=params
+    )
+
+    assert response.status_code == 200
+    assert stats.by_table["GET dashboard_summary"] == 1
+    assert stats.by_table["GET dashboard"] == 1
+    assert stats.by_table["POST dashboard_summary"] == 1
+
+
+def test_mood_prompt_query_budget(dataset):
+    device_id, date, _ = first_key(dataset)
+
+    response, stats = request_within_budget(
+        "GET", "/generate-mood-prompt-supabase", QUERY_BUDGETS["mood_prompt"],
+        params={"device_id": device_id, "date": date}
+    )
+
+    assert response.status_code == 200
+    assert dict(stats.by_table) == {
+        "GET vibe_whisper": 1,
+        "POST vibe_whisper_prompt": 1,
+    }
+
+
+def test_query_budget_fails_when_exceeded(dataset):
+    device_id, date, time_block = first_key(dataset)
+
+    with pytest.raises(query_accounting.QueryBudgetExceeded):
+        request_within_budget(
+            "GET", "/generate-timeblock-prompt", 1,
+            params={"device_id": device_id, "date": date, "time_block": time_block}
+        )
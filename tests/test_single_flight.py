@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+single_flight.SingleFlight のテスト
+同じキーの同時呼び出しが1回の実行を共有すること、結果・例外・キャンセルの扱いを確認する
+"""
+
+import asyncio
+
+import pytest
+
+import deadlines
+from single_flight import SingleFlight
+
+
+class Work:
+    """呼び出し回数を数え、release されるまで完了しない処理"""
+
+    def __init__(self, result=None, error=None):
+        self.calls = 0
+        self.result = result
+        self.error = error
+        self.release = None
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_concurrent_calls_with_same_key_share_one_execution():
+    async def scenario():
+        flight = SingleFlight("test")
+        work = Work(result={"ok": True})
+        work.release = asyncio.Event()
+        callers = [asyncio.create_task(flight.do(("device", "2025-09-01"), work)) for _ in range(5)]
+        await asyncio.sleep(0)
+        work.release.set()
+        return flight, work, await asyncio.gather(*callers)
+
+    flight, work, results = run(scenario())
+
+    assert work.calls == 1
+    assert results == [{"ok": True}] * 5
+    assert flight.stats() == {"in_flight": 0, "executions": 1, "coalesced": 4}
+
+
+def test_different_keys_are_not_coalesced():
+    async def scenario():
+        flight = SingleFlight("test")
+        work = Work(result="done")
+        work.release = asyncio.Event()
+        callers = [
+            asyncio.create_task(flight.do(("device", "2025-09-01", block), work))
+            for block in ("10-00", "10-30")
+        ]
+        await asyncio.sleep(0)
+        in_flight = flight.stats()["in_flight"]
+        work.release.set()
+        await asyncio.gather(*callers)
+        return flight, work, in_flight
+
+    flight, work, in_flight = run(scenario())
+
+    assert work.calls == 2
+    assert in_flight == 2
+    assert flight.stats()["coalesced"] == 0
+
+
+def test_exception_reaches_every_caller_and_frees_the_key():
+    async def scenario():
+        flight = SingleFlight("test")
+        work = Work(error=ValueError("boom"))
+        work.release = asyncio.Event()
+        callers = [asyncio.create_task(flight.do("key", work)) for _ in range(3)]
+        await asyncio.sleep(0)
+        work.release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        return flight, results
+
+    flight, results = run(scenario())
+
+    assert len(results) == 3
+    assert all(isinstance(result, ValueError) and str(result) == "boom" for result in results)
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_key_is_freed_after_completion():
+    async def scenario():
+        flight = SingleFlight("test")
+        work = Work(result=1)
+        work.release = asyncio.Event()
+        work.release.set()
+        first = await flight.do("key", work)
+        second = await flight.do("key", work)
+        return flight, work, first, second
+
+    flight, work, first, second = run(scenario())
+
+    assert (first, second) == (1, 1)
+    assert work.calls == 2
+    assert flight.stats() == {"in_flight": 0, "executions": 2, "coalesced": 0}
+
+
+def test_cancelled_caller_does_not_cancel_shared_task():
+    async def scenario():
+        flight = SingleFlight("test")
+        work = Work(result="shared")
+        work.release = asyncio.Event()
+        first = asyncio.create_task(flight.do("key", work))
+        second = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        work.release.set()
+        return first, await second
+
+    first, result = run(scenario())
+
+    assert first.cancelled()
+    assert result == "shared"
+
+
+def test_caller_deadline_does_not_cancel_shared_task():
+    async def scenario():
+        flight = SingleFlight("test")
+        work = Work(result="shared")
+        work.release = asyncio.Event()
+
+        async def call(seconds):
+            with deadlines.deadline(seconds):
+                return await flight.do("key", work)
+
+        short = asyncio.create_task(call(0.01))
+        long = asyncio.create_task(call(5.0))
+        await asyncio.sleep(0.05)
+        work.release.set()
+        return await asyncio.gather(short, long, return_exceptions=True)
+
+    short, long = run(scenario())
+
+    assert isinstance(short, deadlines.DeadlineExceeded)
+    assert long == "shared"
+
+
+def test_shared_task_runs_under_given_budget_not_callers_deadline():
+    async def scenario():
+        flight = SingleFlight("test")
+
+        async def remaining():
+            return deadlines.remaining()
+
+        with deadlines.deadline(0.5):
+            with_budget = await flight.do("a", remaining, budget=60.0)
+            without_budget = await flight.do("b", remaining)
+        return with_budget, without_budget
+
+    with_budget, without_budget = run(scenario())
+
+    assert with_budget == pytest.approx(60.0, abs=1.0)
+    assert without_budget is None
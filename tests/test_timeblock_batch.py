@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+/generate-timeblock-prompts（バッチ版）のテスト
+結果の順番、単体版との結果の一致、入力の検証、audio_aggregatorへの一括保存を確認する
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+import main
+import prompt_cache
+import timeblock_endpoint
+
+
+@pytest.fixture(autouse=True)
+def cold_caches():
+    prompt_cache.prompt_cache.invalidate()
+    prompt_cache.written_prompts.invalidate()
+    timeblock_endpoint.subject_cache.invalidate()
+
+
+def request(method, path, **kwargs):
+    async def send():
+        async with httpx.AsyncClient(app=main.app, base_url="http://test") as client:
+            return await client.request(method, path, **kwargs)
+
+    return asyncio.run(send())
+
+
+def items_for(tables, count, devices=2):
+    device_ids = [row["device_id"] for row in tables["devices"]][:devices]
+    date = tables["audio_features"][0]["date"]
+    blocks = ["23-30", "00-00", "12-00", "06-30", "18-00"][:count]
+    return [{"device_id": device_id, "date": date, "time_block": block} for block in blocks for device_id in device_ids]
+
+
+def test_results_follow_item_order_and_match_single_endpoint(fake_postgrest):
+    items = items_for(fake_postgrest.tables, 3)
+
+    response = request("POST", "/generate-timeblock-prompts", json={"items": items})
+    single = request("GET", "/generate-timeblock-prompt", params=items[0])
+
+    body = response.json()
+    assert response.status_code == 200
+    assert body["status"] == "success"
+    assert (body["count"], body["success_count"], body["error_count"], body["partial_count"]) == (len(items), len(items), 0, 0)
+    assert [(result["device_id"], result["time_block"]) for result in body["results"]] == [
+        (item["device_id"], item["time_block"]) for item in items
+    ]
+    assert all(result["aggregator_saved"] for result in body["results"])
+    assert body["results"][0]["prompt"] == single.json()["prompt"]
+
+
+def test_batch_saves_one_aggregator_row_per_day(fake_postgrest):
+    items = items_for(fake_postgrest.tables, 2)
+    fake_postgrest.tables["audio_aggregator"] = []
+
+    request("POST", "/generate-timeblock-prompts", json={"items": items})
+
+    saved = sorted((row["device_id"], row["date"]) for row in fake_postgrest.tables["audio_aggregator"])
+    assert saved == sorted({(item["device_id"], item["date"]) for item in items})
+
+
+def test_invalid_date_rejects_whole_batch(fake_postgrest):
+    items = items_for(fake_postgrest.tables, 1) + [{"device_id": "device-1", "date": "2025/09/01", "time_block": "10-00"}]
+
+    response = request("POST", "/generate-timeblock-prompts", json={"items": items})
+
+    assert response.status_code == 400
+    assert "2025/09/01" in response.json()["detail"]
+
+
+def test_empty_and_oversized_batches_are_rejected():
+    item = {"device_id": "device-1", "date": "2025-09-01", "time_block": "10-00"}
+
+    empty = request("POST", "/generate-timeblock-prompts", json={"items": []})
+    oversized = request("POST", "/generate-timeblock-prompts",
+                        json={"items": [item] * (main.TIMEBLOCK_BATCH_MAX_ITEMS + 1)})
+
+    assert empty.status_code == 422
+    assert oversized.status_code == 422
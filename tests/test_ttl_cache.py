@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+ttl_cache.TTLCache のテスト
+時計を差し替えて有効期限（TTL）による失効と、サイズ上限によるLRU追い出しを確認する
+"""
+
+from ttl_cache import MISSING, TTLCache
+
+
+class FakeClock:
+    """手動で進める時計"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def test_entry_expires_after_ttl():
+    clock = FakeClock()
+    cache = TTLCache(ttl_seconds=10, max_size=10, clock=clock)
+    cache.set("key", "value")
+
+    clock.advance(9.9)
+    assert cache.get("key") == "value"
+
+    clock.advance(0.1)
+    assert cache.get("key") is MISSING
+    assert cache.stats()["size"] == 0
+
+
+def test_set_refreshes_expiry():
+    clock = FakeClock()
+    cache = TTLCache(ttl_seconds=10, max_size=10, clock=clock)
+    cache.set("key", "old")
+    clock.advance(8)
+    cache.set("key", "new")
+
+    clock.advance(8)
+    assert cache.get("key") == "new"
+
+
+def test_get_does_not_extend_expiry():
+    clock = FakeClock()
+    cache = TTLCache(ttl_seconds=10, max_size=10, clock=clock)
+    cache.set("key", "value")
+    clock.advance(5)
+    assert cache.get("key") == "value"
+
+    clock.advance(5)
+    assert cache.get("key") is MISSING
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(ttl_seconds=60, max_size=2, clock=FakeClock())
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # a を使うと、最も古く使われたのは b になる
+    assert cache.get("a") == 1
+
+    cache.set("c", 3)
+
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["size"] == 2
+
+
+def test_none_can_be_cached():
+    cache = TTLCache(ttl_seconds=60, max_size=2, clock=FakeClock())
+    cache.set("subject", None)
+
+    assert cache.get("subject") is None
+    assert cache.get("other") is MISSING
+
+
+def test_invalidate_and_stats():
+    cache = TTLCache(ttl_seconds=60, max_size=10, clock=FakeClock())
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.get("missing")
+
+    assert cache.invalidate("a") == 1
+    assert cache.invalidate("a") == 0
+    assert cache.invalidate() == 1
+    assert cache.stats() == {"size": 0, "max_size": 10, "ttl_seconds": 60, "hits": 1, "misses": 1}
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+write_behind.WriteBehindBuffer のテスト
+送信できない行の切り分け（dead letter）、一時的なエラーの再送、まとまりごとの送信、
+再起動時のジャーナルからの再送を確認する
+"""
+
+import asyncio
+import sqlite3
+
+import pytest
+from postgrest.exceptions import APIError
+
+import write_behind
+
+
+def constraint_error():
+    return APIError({"message": "null value in column \"prompt\" violates not-null constraint", "code": "23502"})
+
+
+def unavailable_error():
+    return APIError({"message": "Service Unavailable", "code": 503})
+
+
+class FakeSupabase:
+    """UPSERTされた行をテーブルごとに保持する（fail が例外を返した場合はまとまり全体を失敗させる）"""
+
+    def __init__(self, fail=None):
+        self.fail = fail or (lambda table, rows: None)
+        self.tables = {}
+        self.calls = 0
+
+    async def execute(self, build, **kwargs):
+        return build(self)
+
+    def table(self, name):
+        supabase = self
+
+        class Upsert:
+            def upsert(self, rows, on_conflict):
+                supabase.calls += 1
+                error = supabase.fail(name, rows)
+                if error is not None:
+                    raise error
+                supabase.tables.setdefault(name, []).extend(rows)
+                return self
+
+        return Upsert()
+
+
+def block(time_block, prompt="prompt"):
+    return {"device_id": "device-1", "date": "2025-09-01", "time_block": time_block, "prompt": prompt}
+
+
+def dead_writes(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT conflict_key, attempts, error FROM dead_writes").fetchall()
+
+
+async def close(buffer):
+    await buffer._journal_call(buffer._journal.close)
+    buffer._journal_executor.shutdown(wait=True)
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / "data" / "journal.sqlite3")
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    # 失敗した行をすぐに再送対象に戻す
+    monkeypatch.setattr(write_behind, "RETRY_BACKOFF_SECONDS", 0.0)
+
+
+def test_bad_row_is_dead_lettered_and_other_rows_are_written(journal_path):
+    def fail(table, rows):
+        if any(row["prompt"] is None for row in rows):
+            return constraint_error()
+
+    async def scenario():
+        supabase = FakeSupabase(fail)
+        buffer = write_behind.WriteBehindBuffer(supabase, journal_path=journal_path)
+        await buffer.enqueue("dashboard", [block("10-00"), block("10-30", prompt=None), block("11-00")],
+                             "device_id,date,time_block")
+        flushed = await buffer.flush()
+        # 次のフラッシュで同じ行を読み直さない
+        flushed_again = await buffer.flush()
+        stats = buffer.stats()
+        await close(buffer)
+        return supabase, flushed, flushed_again, stats
+
+    supabase, flushed, flushed_again, stats = asyncio.run(scenario())
+
+    assert (flushed, flushed_again) == (2, 0)
+    assert [row["time_block"] for row in supabase.tables["dashboard"]] == ["10-00", "11-00"]
+    assert stats["pending"] == 0
+    assert stats["dead_letters"] == 1
+    dead = dead_writes(journal_path)
+    assert len(dead) == 1
+    assert dead[0][0] == '["device-1", "2025-09-01", "10-30"]'
+    assert dead[0][1] == 1
+    assert "23502" in dead[0][2]
+
+
+def test_transient_error_is_retried_until_it_succeeds(journal_path):
+    failures = [unavailable_error(), unavailable_error()]
+
+    async def scenario():
+        supabase = FakeSupabase(lambda table, rows: failures.pop(0) if failures else None)
+        buffer = write_behind.WriteBehindBuffer(supabase, journal_path=journal_path, max_attempts=3)
+        await buffer.enqueue("dashboard", [block("10-00")], "device_id,date,time_block")
+        results = [await buffer.flush() for _ in range(3)]
+        stats = buffer.stats()
+        await close(buffer)
+        return supabase, results, stats
+
+    supabase, results, stats = asyncio.run(scenario())
+
+    assert results == [0, 0, 1]
+    assert supabase.tables["dashboard"] == [block("10-00")]
+    assert stats["failed_flushes"] == 2
+    assert stats["dead_letters"] == 0
+    assert stats["pending"] == 0
+
+
+def test_row_is_dead_lettered_after_max_attempts(journal_path):
+    async def scenario():
+        supabase = FakeSupabase(lambda table, rows: unavailable_error())
+        buffer = write_behind.WriteBehindBuffer(supabase, journal_path=journal_path, max_attempts=3)
+        await buffer.enqueue("dashboard", [block("10-00")], "device_id,date,time_block")
+        for _ in range(4):
+            await buffer.flush()
+        stats = buffer.stats()
+        await close(buffer)
+        return supabase, stats
+
+    supabase, stats = asyncio.run(scenario())
+
+    # 3回目の失敗で dead letter になり、4回目のフラッシュでは送信しない
+    assert supabase.calls == 3
+    assert stats["pending"] == 0
+    assert stats["dead_letters"] == 1
+    assert dead_writes(journal_path)[0][1] == 3
+
+
+def test_failed_group_does_not_block_other_groups(journal_path):
+    def fail(table, rows):
+        if table == "dashboard":
+            return unavailable_error()
+
+    async def scenario():
+        supabase = FakeSupabase(fail)
+        buffer = write_behind.WriteBehindBuffer(supabase, journal_path=journal_path)
+        await buffer.enqueue("dashboard", [block("10-00")], "device_id,date,time_block")
+        await buffer.enqueue("audio_aggregator", [{"device_id": "device-1", "date": "2025-09-01", "prompt": "p"}],
+                             "device_id,date")
+        flushed = await buffer.flush()
+        stats = buffer.stats()
+        await close(buffer)
+        return supabase, flushed, stats
+
+    supabase, flushed, stats = asyncio.run(scenario())
+
+    assert flushed == 1
+    assert list(supabase.tables) == ["audio_aggregator"]
+    # 一時的なエラーの行は再送待ちとして残る
+    assert stats["pending"] == 1
+    assert stats["dead_letters"] == 0
+
+
+def test_later_write_to_same_key_replaces_pending_one(journal_path):
+    async def scenario():
+        supabase = FakeSupabase()
+        buffer = write_behind.WriteBehindBuffer(supabase, journal_path=journal_path)
+        await buffer.enqueue("dashboard", [block("10-00", prompt="old")], "device_id,date,time_block")
+        await buffer.enqueue("dashboard", [block("10-00", prompt="new")], "device_id,date,time_block")
+        await buffer.flush()
+        await close(buffer)
+        return supabase
+
+    supabase = asyncio.run(scenario())
+
+    assert supabase.tables["dashboard"] == [block("10-00", prompt="new")]
+
+
+def test_persisted_journal_is_replayed_after_restart(journal_path):
+    async def crash_before_flush():
+        buffer = write_behind.WriteBehindBuffer(FakeSupabase(), journal_path=journal_path)
+        await buffer.enqueue("dashboard", [block("10-00"), block("10-30")], "device_id,date,time_block")
+        # フラッシュせずに終了（プロセスの停止を模擬）
+        await close(buffer)
+
+    async def restart():
+        supabase = FakeSupabase()
+        buffer = write_behind.WriteBehindBuffer(supabase, journal_path=journal_path, flush_interval=60.0)
+        await buffer.start()
+        pending_at_start = buffer.pending
+        await buffer.stop()
+        return supabase, pending_at_start, buffer.stats()
+
+    asyncio.run(crash_before_flush())
+    supabase, pending_at_start, stats = asyncio.run(restart())
+
+    assert pending_at_start == 2
+    assert [row["time_block"] for row in supabase.tables["dashboard"]] == ["10-00", "10-30"]
+    assert stats["pending"] == 0
+
+
+def test_journal_without_attempt_columns_is_migrated(tmp_path):
+    path = str(tmp_path / "old.sqlite3")
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "CREATE TABLE pending_writes (id INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT NOT NULL, "
+            "on_conflict TEXT NOT NULL, conflict_key TEXT NOT NULL, row_json TEXT NOT NULL, created_at REAL NOT NULL, "
+            "UNIQUE (table_name, on_conflict, conflict_key))"
+        )
+        conn.execute(
+            "INSERT INTO pending_writes (table_name, on_conflict, conflict_key, row_json, created_at) "
+            "VALUES ('dashboard', 'device_id,date,time_block', '[]', '{\"time_block\": \"10-00\"}', 0)"
+        )
+
+    journal = write_behind.SqliteJournal(path)
+    try:
+        assert journal.read(10) == [(1, "dashboard", "device_id,date,time_block", '{"time_block": "10-00"}', 0)]
+    finally:
+        journal.close()
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (APIError({"message": "violates not-null constraint", "code": "23502"}), False),
+    (APIError({"message": "invalid input syntax", "code": "22P02"}), False),
+    (APIError({"message": "column does not exist", "code": "42703"}), False),
+    (APIError({"message": "schema cache", "code": "PGRST204"}), False),
+    (APIError({"message": "Bad Request", "code": 400}), False),
+    (APIError({"message": "Too Many Requests", "code": 429}), True),
+    (APIError({"message": "Bad Gateway", "code": 502}), True),
+    (APIError({"message": "deadlock detected", "code": "40P01"}), True),
+    (TimeoutError("read timeout"), True),
+])
+def test_is_retryable(error, retryable):
+    assert write_behind.is_retryable(error) is retryable
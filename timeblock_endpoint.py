@@ -5,49 +5,43 @@ Time Block Processing Endpoint
 Phase 1: Transcriptionデータのみ
 Phase 2: + SEDデータ (behavior_summary)
 Phase 3: + OpenSMILE
+
+supabase_client 引数には async_supabase.AsyncSupabaseClient を渡す
+（クエリはスレッドプール上で実行され、イベントループをブロックしない）
 """
 
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 import json
-import traceback
-
-
-def get_season(month: int) -> str:
-    """月から季節を判定（日本の季節）"""
-    if month in [3, 4, 5]:
-        return "春"
-    elif month in [6, 7, 8]:
-        return "夏"
-    elif month in [9, 10, 11]:
-        return "秋"
-    else:
-        return "冬"
-
-
-def get_weekday_info(date_str: str) -> Dict[str, Any]:
-    """日付文字列から曜日情報を取得"""
-    try:
-        date_obj = datetime.strptime(date_str, "%Y-%m-%d")
-        
-        # 曜日名（日本語）
-        weekdays_ja = ["月曜日", "火曜日", "水曜日", "木曜日", "金曜日", "土曜日", "日曜日"]
-        weekday_ja = weekdays_ja[date_obj.weekday()]
-        
-        # 週末判定
-        is_weekend = date_obj.weekday() >= 5  # 土曜日(5)または日曜日(6)
-        
-        return {
-            "weekday": weekday_ja,
-            "is_weekend": is_weekend,
-            "day_type": "週末" if is_weekend else "平日"
-        }
-    except (ValueError, TypeError):
-        return {
-            "weekday": "不明",
-            "is_weekend": None,
-            "day_type": "不明"
-        }
+import os
+
+from ttl_cache import TTLCache, MISSING
+from calendar_context import get_season, get_weekday_info
+from opensmile_features import OpenSmileFeatures
+from sed_events import SedSummary
+import deadlines
+import metrics
+import prompt_cache
+import structured_logging
+import write_behind
+from projections import (
+    AUDIO_FEATURES_PROMPT,
+    AUDIO_FEATURES_KEY_COLUMNS,
+    DEVICE_SUBJECT,
+    ORDER_BY_AUDIO_FEATURES_KEY,
+    SUBJECT_PROFILE
+)
+
+
+logger = structured_logging.get_logger(__name__)
+
+# 観測対象者情報のキャッシュ（device_id → subject_info）
+# devices/subjectsはほとんど変更されないため、TTL付きで保持する
+subject_cache = TTLCache(
+    ttl_seconds=float(os.getenv("SUBJECT_CACHE_TTL_SECONDS", "300")),
+    max_size=int(os.getenv("SUBJECT_CACHE_MAX_SIZE", "1024"))
+)
 
 
 def generate_age_context(subject_info: Optional[Dict]) -> str:
@@ -78,117 +72,173 @@ def generate_time_context(hour: int, minute: int) -> str:
     """時刻を表示用フォーマットで返す"""
     return f"{hour:02d}:{minute:02d}"
 
-async def get_whisper_data(supabase_client, device_id: str, date: str, time_block: str) -> Optional[str]:
+@dataclass
+class AudioFeatures:
     """
-    audio_featuresテーブルから特定のタイムブロックのトランスクリプトを取得
+    audio_featuresテーブル1行分（1タイムブロック）の分析結果
+    各フィールドの意味は従来の get_whisper_data / get_sed_data / get_opensmile_data の戻り値と同じ
+    """
+    transcription: Optional[str] = None
+    sed_data: Optional[list] = None
+    opensmile_data: Optional[list] = None
+
+    @property
+    def has_whisper(self) -> bool:
+        return self.transcription is not None
+
+    @property
+    def has_sed(self) -> bool:
+        return self.sed_data is not None and len(self.sed_data) > 0
+
+    @property
+    def has_opensmile(self) -> bool:
+        return self.opensmile_data is not None and len(self.opensmile_data) > 0
+
+
+def parse_audio_features_row(row: Optional[Dict[str, Any]]) -> AudioFeatures:
+    """
+    AUDIO_FEATURES_PROMPT で取得したaudio_featuresの1行をAudioFeaturesに変換（行がない場合は全てNone）
+    JSONBのサブパスはサーバー側で切り出し済み。カラムがnull・辞書でない・キーがない場合はいずれもnullになるため、
+    ここでNone（データなし）として扱う（has_sed・SedSummary・opensmile_featuresはNoneと[]を区別しない）
+    """
+    if row is None:
+        return AudioFeatures()
+    return AudioFeatures(
+        transcription=row.get('vibe_transcriber_result', ''),
+        sed_data=row.get('sed_events'),
+        opensmile_data=row.get('opensmile_timeline')
+    )
+
+
+async def get_audio_features(supabase_client, device_id: str, date: str, time_block: str) -> AudioFeatures:
+    """
+    audio_featuresテーブルから特定のタイムブロックの3種類の分析結果を1クエリで取得
+    - vibe_transcriber_result: トランスクリプト
+    - behavior_extractor_result: YAMNetの音響イベント検出結果
+    - emotion_extractor_result: Kushinadaの感情特徴データ
     """
     try:
-        result = supabase_client.table('audio_features').select('vibe_transcriber_result').eq(
-            'device_id', device_id
-        ).eq(
-            'date', date
-        ).eq(
-            'time_block', time_block
-        ).execute()
+        with metrics.stage(metrics.AUDIO_FEATURES_FETCH):
+            result = await supabase_client.execute(
+                lambda c: AUDIO_FEATURES_PROMPT.select(c).eq(
+                    'device_id', device_id
+                ).eq(
+                    'date', date
+                ).eq(
+                    'time_block', time_block
+                ),
+                hedge=True
+            )
 
         if result.data and len(result.data) > 0:
-            return result.data[0].get('vibe_transcriber_result', '')
-        return None
+            return parse_audio_features_row(result.data[0])
+        return AudioFeatures()
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
-        print(f"Error fetching transcriber data: {e}")
-        return None
+        logger.error("Error fetching audio_features data: %s", e, extra={"date": date, "time_block": time_block})
+        return AudioFeatures()
 
 
-async def get_subject_info(supabase_client, device_id: str) -> Optional[Dict]:
+async def get_audio_features_bulk(supabase_client, keys: List[Tuple[str, str, str]]) -> Dict[Tuple[str, str, str], AudioFeatures]:
     """
-    device_idから観測対象者情報を取得
-    devices → subjects テーブルを結合して情報を取得
+    複数の (device_id, date, time_block) についてaudio_featuresを1クエリ（必要に応じてページング）で取得
+    device_id・date・time_blockそれぞれの in 条件で絞り込み、要求されたキーだけを返す
+    取得できなかったキーは戻り値に含まれない（呼び出し側で AudioFeatures() として扱う）
     """
+    if not keys:
+        return {}
+
+    wanted = set(keys)
+    device_ids = sorted({key[0] for key in wanted})
+    dates = sorted({key[1] for key in wanted})
+    time_blocks = sorted({key[2] for key in wanted})
+
     try:
-        # まず devices テーブルから subject_id を取得
-        device_result = supabase_client.table('devices').select('subject_id').eq(
-            'device_id', device_id
-        ).execute()
-        
-        if not device_result.data or len(device_result.data) == 0:
-            print(f"Device not found: {device_id}")
-            return None
-            
-        subject_id = device_result.data[0].get('subject_id')
-        if not subject_id:
-            print(f"No subject_id for device: {device_id}")
-            return None
-        
-        # subjects テーブルから情報を取得
-        subject_result = supabase_client.table('subjects').select(
-            'subject_id', 'name', 'age', 'gender', 'notes'
-        ).eq(
-            'subject_id', subject_id
-        ).execute()
-        
-        if subject_result.data and len(subject_result.data) > 0:
-            return subject_result.data[0]
-        
-        return None
+        with metrics.stage(metrics.AUDIO_FEATURES_FETCH):
+            rows = await supabase_client.execute_paged(
+                lambda c: AUDIO_FEATURES_PROMPT.select(c, *AUDIO_FEATURES_KEY_COLUMNS).in_(
+                    'device_id', device_ids
+                ).in_(
+                    'date', dates
+                ).in_(
+                    'time_block', time_blocks
+                ).order(ORDER_BY_AUDIO_FEATURES_KEY),
+                hedge=True
+            )
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
-        print(f"Error fetching subject info: {e}")
-        return None
+        logger.error("Error fetching audio_features data (bulk): %s", e, extra={"keys": len(wanted)})
+        return {}
+
+    features_by_key = {}
+    for row in rows:
+        key = (row.get('device_id'), row.get('date'), row.get('time_block'))
+        # 同じキーが複数ある場合は最初の行を採用（単体取得と同じ扱い）
+        if key in wanted and key not in features_by_key:
+            features_by_key[key] = parse_audio_features_row(row)
+    return features_by_key
+
 
-async def get_sed_data(supabase_client, device_id: str, date: str, time_block: str) -> Optional[list]:
+async def get_subject_info(supabase_client, device_id: str) -> Optional[Dict]:
     """
-    audio_featuresテーブルから特定のタイムブロックの行動分析データを取得
-    behavior_extractor_resultカラムからYAMNetの音響イベント検出結果を取得
+    device_idから観測対象者情報を取得
+    devices → subjects テーブルを結合して情報を取得
+    結果（見つからなかった場合のNoneを含む）は subject_cache にTTL付きで保持する
     """
-    try:
-        result = supabase_client.table('audio_features').select('behavior_extractor_result').eq(
-            'device_id', device_id
-        ).eq(
-            'date', date
-        ).eq(
-            'time_block', time_block
-        ).execute()
+    cached = subject_cache.get(device_id)
+    if cached is not MISSING:
+        return cached
 
-        if result.data and len(result.data) > 0:
-            extractor_result = result.data[0].get('behavior_extractor_result')
-            if extractor_result:
-                # JSONB型なので直接辞書として扱える
-                # 'events'キーが存在する場合は取得
-                if isinstance(extractor_result, dict):
-                    return extractor_result.get('events', [])
-                return []
-        return None
+    try:
+        with metrics.stage(metrics.SUBJECT_FETCH):
+            subject_info = await fetch_subject_info(supabase_client, device_id)
+    except deadlines.DeadlineExceeded:
+        # 時間切れを「観測対象者なし」として扱わず、504として返す
+        raise
     except Exception as e:
-        print(f"Error fetching behavior data from audio_features: {e}")
+        # 取得エラーはキャッシュしない
+        logger.error("Error fetching subject info: %s", e, extra={"device_id": device_id})
         return None
 
+    subject_cache.set(device_id, subject_info)
+    return subject_info
+
 
-async def get_opensmile_data(supabase_client, device_id: str, date: str, time_block: str) -> Optional[list]:
+async def fetch_subject_info(supabase_client, device_id: str) -> Optional[Dict]:
     """
-    audio_featuresテーブルから特定のタイムブロックの感情分析データを取得
-    emotion_extractor_resultカラムからKushinadaの感情特徴データを取得
+    devices → subjects テーブルから観測対象者情報を取得（キャッシュを経由しない）
     """
-    try:
-        result = supabase_client.table('audio_features').select('emotion_extractor_result').eq(
+    # まず devices テーブルから subject_id を取得
+    device_result = await supabase_client.execute(
+        lambda c: DEVICE_SUBJECT.select(c).eq(
             'device_id', device_id
-        ).eq(
-            'date', date
-        ).eq(
-            'time_block', time_block
-        ).execute()
-
-        if result.data and len(result.data) > 0:
-            extractor_result = result.data[0].get('emotion_extractor_result')
-            if extractor_result:
-                # JSONB型なので直接辞書として扱える
-                # 'selected_features_timeline'キーが存在する場合は取得
-                if isinstance(extractor_result, dict):
-                    return extractor_result.get('selected_features_timeline', [])
-                return []
+        ),
+        hedge=True
+    )
+    
+    if not device_result.data or len(device_result.data) == 0:
+        logger.warning("Device not found", extra={"device_id": device_id})
         return None
-    except Exception as e:
-        print(f"Error fetching emotion data from audio_features: {e}")
+        
+    subject_id = device_result.data[0].get('subject_id')
+    if not subject_id:
+        logger.warning("No subject_id for device", extra={"device_id": device_id})
         return None
-
+    
+    # subjects テーブルから情報を取得
+    subject_result = await supabase_client.execute(
+        lambda c: SUBJECT_PROFILE.select(c).eq(
+            'subject_id', subject_id
+        ),
+        hedge=True
+    )
+    
+    if subject_result.data and len(subject_result.data) > 0:
+        return subject_result.data[0]
+    
+    return None
 
 
 def generate_timeblock_prompt(transcription: Optional[str], sed_data: Optional[list], time_block: str, 
@@ -377,47 +427,28 @@ def generate_timeblock_prompt(transcription: Optional[str], sed_data: Optional[l
     else:
         prompt_parts.append("◆ 発話: なし（録音はされたが言語的な情報なし）")
     
-    # OpenSMILEの統計情報を先に計算
-    if opensmile_data and len(opensmile_data) > 0:
-        loudness_values = [item.get('features', {}).get('Loudness_sma3', 0) for item in opensmile_data]
-        jitter_values = [item.get('features', {}).get('jitterLocal_sma3nz', 0) for item in opensmile_data]
-        
-        avg_loudness = sum(loudness_values) / len(loudness_values)
-        max_loudness = max(loudness_values)
-        min_loudness = min(loudness_values)
-        avg_jitter = sum(jitter_values) / len(jitter_values)
-        max_jitter = max(jitter_values)
-        
+    # OpenSMILEの統計情報を先に計算（列形式に1回だけ変換）
+    opensmile = OpenSmileFeatures.from_timeline(opensmile_data)
+    if opensmile is not None:
         prompt_parts.append(f"""◆ 音声特徴（OpenSMILE）統計:
-  - 記録時間: {len(opensmile_data)}秒
-  - 平均音量: {avg_loudness:.3f} (範囲: {min_loudness:.3f}〜{max_loudness:.3f})
-  - 平均声の震え: {avg_jitter:.6f} (最大: {max_jitter:.6f})
-  - 無音区間: {jitter_values.count(0)}秒 / {len(jitter_values)}秒""")
+  - 記録時間: {opensmile.total_seconds}秒
+  - 平均音量: {opensmile.avg_loudness:.3f} (範囲: {opensmile.min_loudness:.3f}〜{opensmile.max_loudness:.3f})
+  - 平均声の震え: {opensmile.avg_jitter:.6f} (最大: {opensmile.max_jitter:.6f})
+  - 無音区間: {opensmile.silent_seconds}秒 / {opensmile.total_seconds}秒""")
     else:
         prompt_parts.append("◆ 音声特徴（OpenSMILE）: データなし")
     
-    # SEDデータ（音響イベント）の統計
-    if sed_data:
-        # 確率の高い上位イベントを抽出
-        sorted_events = sorted(sed_data, key=lambda x: x.get('prob', 0), reverse=True)
-        
-        # 主要な音響イベントの統計
-        high_prob_events = [e for e in sorted_events if e.get('prob', 0) >= 0.7]
-        mid_prob_events = [e for e in sorted_events if 0.4 <= e.get('prob', 0) < 0.7]
-        
-        speech_prob = next((e.get('prob', 0)*100 for e in sorted_events if 'Speech' in e.get('label', '')), 0)
-        has_child_voice = any('Child' in e.get('label', '') or 'Baby' in e.get('label', '') for e in sorted_events[:20])
-        has_noise = any('Noise' in e.get('label', '') for e in sorted_events[:10])
-        activity_diversity = len([e for e in sorted_events[:20] if e.get('prob', 0) > 0.3])
-        
+    # SEDデータ（音響イベント）は1回だけ要約して統計・詳細リストの両方で使う
+    sed = SedSummary.from_events(sed_data)
+    if sed is not None:
         prompt_parts.append(f"""◆ 音響イベント（YAMNet）統計:
-  - 検出イベント総数: {len(sed_data)}種類
-  - 高確率イベント（70%以上）: {len(high_prob_events)}個
-  - 中確率イベント（40-70%）: {len(mid_prob_events)}個
-  - Speech検出率: {speech_prob:.1f}%
-  - 子供の声: {'検出' if has_child_voice else '未検出'}
-  - 環境ノイズ: {'高' if has_noise else '低'}
-  - 活動音の多様性: {activity_diversity}種類""")
+  - 検出イベント総数: {sed.total_events}種類
+  - 高確率イベント（70%以上）: {sed.high_prob_count}個
+  - 中確率イベント（40-70%）: {sed.mid_prob_count}個
+  - Speech検出率: {sed.speech_prob:.1f}%
+  - 子供の声: {'検出' if sed.has_child_voice else '未検出'}
+  - 環境ノイズ: {'高' if sed.has_noise else '低'}
+  - 活動音の多様性: {sed.activity_diversity}種類""")
     else:
         prompt_parts.append("◆ 音響イベント（YAMNet）: データなし")
     
@@ -432,27 +463,20 @@ def generate_timeblock_prompt(transcription: Optional[str], sed_data: Optional[l
 """)
     
     # OpenSMILEの時系列データ（詳細）
-    if opensmile_data and len(opensmile_data) > 0:
+    if opensmile is not None:
         prompt_parts.append("◆ 音声特徴の時系列（OpenSMILE、1秒毎）:")
         prompt_parts.append("時刻 | 音量(Loudness) | 声の震え(Jitter)")
         prompt_parts.append("-----|---------------|----------------")
         
-        for item in opensmile_data[:60]:  # 最大60秒分
-            timestamp = item.get('timestamp', 'N/A')
-            features = item.get('features', {})
-            loudness = features.get('Loudness_sma3', 0)
-            jitter = features.get('jitterLocal_sma3nz', 0)
+        for timestamp, loudness, jitter in opensmile.rows(60):  # 最大60秒分
             prompt_parts.append(f"{timestamp} | {loudness:.3f} | {jitter:.6f}")
     
     # SEDイベントの詳細リスト
-    if sed_data:
-        sorted_events = sorted(sed_data, key=lambda x: x.get('prob', 0), reverse=True)
+    if sed is not None:
         prompt_parts.append("\n◆ 音響イベント詳細（YAMNet、確率順）:")
         
         # 上位20個のイベントのみ表示
-        for i, event in enumerate(sorted_events[:20], 1):
-            label = event.get('label', 'Unknown')
-            prob = event.get('prob', 0)
+        for i, (label, prob) in enumerate(sed.top(20), 1):
             prompt_parts.append(f"  {i}. {label}: {prob*100:.1f}%")
     
     return "\n".join(prompt_parts)
@@ -467,18 +491,22 @@ async def update_whisper_status(supabase_client, device_id: str, date: str, time
             'status': 'completed'
         }
         
-        result = supabase_client.table('vibe_whisper').update(data).eq(
-            'device_id', device_id
-        ).eq(
-            'date', date
-        ).eq(
-            'time_block', time_block
-        ).execute()
+        result = await supabase_client.execute(
+            lambda c: c.table('vibe_whisper').update(data).eq(
+                'device_id', device_id
+            ).eq(
+                'date', date
+            ).eq(
+                'time_block', time_block
+            )
+        )
         
-        print(f"✅ Updated vibe_whisper status to completed for {time_block}")
+        logger.info("✅ Updated vibe_whisper status to completed", extra={"date": date, "time_block": time_block})
         return True
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
-        print(f"⚠️ Error updating vibe_whisper status: {e}")
+        logger.warning("⚠️ Error updating vibe_whisper status: %s", e, extra={"date": date, "time_block": time_block})
         return False
 
 
@@ -491,18 +519,22 @@ async def update_yamnet_status(supabase_client, device_id: str, date: str, time_
             'status': 'completed'
         }
         
-        result = supabase_client.table('behavior_yamnet').update(data).eq(
-            'device_id', device_id
-        ).eq(
-            'date', date
-        ).eq(
-            'time_block', time_block
-        ).execute()
+        result = await supabase_client.execute(
+            lambda c: c.table('behavior_yamnet').update(data).eq(
+                'device_id', device_id
+            ).eq(
+                'date', date
+            ).eq(
+                'time_block', time_block
+            )
+        )
         
-        print(f"✅ Updated behavior_yamnet status to completed for {time_block}")
+        logger.info("✅ Updated behavior_yamnet status to completed", extra={"date": date, "time_block": time_block})
         return True
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
-        print(f"⚠️ Error updating behavior_yamnet status: {e}")
+        logger.warning("⚠️ Error updating behavior_yamnet status: %s", e, extra={"date": date, "time_block": time_block})
         return False
 
 
@@ -515,18 +547,22 @@ async def update_opensmile_status(supabase_client, device_id: str, date: str, ti
             'status': 'completed'
         }
         
-        result = supabase_client.table('emotion_opensmile').update(data).eq(
-            'device_id', device_id
-        ).eq(
-            'date', date
-        ).eq(
-            'time_block', time_block
-        ).execute()
+        result = await supabase_client.execute(
+            lambda c: c.table('emotion_opensmile').update(data).eq(
+                'device_id', device_id
+            ).eq(
+                'date', date
+            ).eq(
+                'time_block', time_block
+            )
+        )
         
-        print(f"✅ Updated emotion_opensmile status to completed for {time_block}")
+        logger.info("✅ Updated emotion_opensmile status to completed", extra={"date": date, "time_block": time_block})
         return True
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
-        print(f"⚠️ Error updating emotion_opensmile status: {e}")
+        logger.warning("⚠️ Error updating emotion_opensmile status: %s", e, extra={"date": date, "time_block": time_block})
         return False
 
 
@@ -536,7 +572,12 @@ async def save_prompt_to_dashboard(supabase_client, device_id: str, date: str, t
 
     注意: audio_aggregatorはPrimary Key (device_id, date) で1日1レコード
     time_blockは無視して、日次で累積更新
+    最後に書き込んだプロンプトと同じ場合はUPSERTを省略する（レコードは既に最新）
     """
+    if prompt_cache.is_prompt_written(device_id, date, prompt):
+        logger.info("⏭️ Prompt unchanged, skipped audio_aggregator write", extra={"date": date, "time_block": time_block})
+        return True
+
     try:
         data = {
             'device_id': device_id,
@@ -546,15 +587,81 @@ async def save_prompt_to_dashboard(supabase_client, device_id: str, date: str, t
             'updated_at': datetime.now().isoformat()
         }
 
-        result = supabase_client.table('audio_aggregator').upsert(
-            data,
-            on_conflict='device_id,date'
-        ).execute()
-        print(f"✅ Prompt saved to audio_aggregator table for {date} (time_block: {time_block})")
+        with metrics.stage(metrics.AUDIO_AGGREGATOR_UPSERT):
+            queued = await write_behind.upsert(supabase_client, 'audio_aggregator', data, on_conflict='device_id,date')
+        prompt_cache.mark_prompt_written(device_id, date, prompt)
+        if queued:
+            logger.info("📒 Prompt queued for audio_aggregator table", extra={"date": date, "time_block": time_block})
+        else:
+            logger.info("✅ Prompt saved to audio_aggregator table", extra={"date": date, "time_block": time_block})
+        return True
+    except deadlines.DeadlineExceeded:
+        prompt_cache.forget_prompt_written(device_id, date)
+        raise
+    except Exception as e:
+        prompt_cache.forget_prompt_written(device_id, date)
+        logger.exception("Error saving prompt to audio_aggregator: %s", e, extra={"date": date, "time_block": time_block})
+        return False
+
+
+async def save_prompts_to_aggregator_bulk(supabase_client, entries: List[Tuple[str, str, str, str]]) -> bool:
+    """
+    複数のプロンプトをaudio_aggregatorテーブルに1回のUPSERTで保存
+
+    Args:
+        entries: (device_id, date, time_block, prompt) のリスト（処理順）
+
+    audio_aggregatorは (device_id, date) で1日1レコードのため、
+    同じ日のエントリが複数ある場合は順番どおりに処理した場合と同じく最後のものを保存する
+    最後に書き込んだプロンプトと同じ日はUPSERTの対象から外す
+    """
+    if not entries:
+        return True
+
+    last_prompt_by_day = {}
+    for device_id, date, time_block, prompt in entries:
+        last_prompt_by_day[(device_id, date)] = prompt
+
+    changed_days = {
+        day: prompt for day, prompt in last_prompt_by_day.items()
+        if not prompt_cache.is_prompt_written(day[0], day[1], prompt)
+    }
+    if not changed_days:
+        logger.info("⏭️ Prompts unchanged, skipped audio_aggregator write (bulk)", extra={"days": len(last_prompt_by_day)})
+        return True
+
+    try:
+        now = datetime.now().isoformat()
+        rows = [
+            {
+                'device_id': device_id,
+                'date': date,
+                'vibe_aggregator_result': prompt,
+                'vibe_aggregator_processed_at': now,
+                'updated_at': now
+            }
+            for (device_id, date), prompt in changed_days.items()
+        ]
+
+        with metrics.stage(metrics.AUDIO_AGGREGATOR_UPSERT):
+            queued = await write_behind.upsert(supabase_client, 'audio_aggregator', rows, on_conflict='device_id,date')
+        for (device_id, date), prompt in changed_days.items():
+            prompt_cache.mark_prompt_written(device_id, date, prompt)
+        message = "📒 Prompts queued for audio_aggregator table (bulk)" if queued else "✅ Prompts saved to audio_aggregator table (bulk)"
+        logger.info(message, extra={
+            "days": len(rows),
+            "time_blocks": len(entries),
+            "unchanged_days": len(last_prompt_by_day) - len(rows)
+        })
         return True
+    except deadlines.DeadlineExceeded:
+        for device_id, date in changed_days:
+            prompt_cache.forget_prompt_written(device_id, date)
+        raise
     except Exception as e:
-        print(f"Error saving prompt to audio_aggregator: {e}")
-        traceback.print_exc()
+        for device_id, date in changed_days:
+            prompt_cache.forget_prompt_written(device_id, date)
+        logger.exception("Error saving prompts to audio_aggregator (bulk): %s", e, extra={"days": len(changed_days)})
         return False
 
 
@@ -577,14 +684,30 @@ async def process_and_save_to_dashboard(supabase_client, device_id: str, date: s
         if vibe_score is not None:
             data['vibe_score'] = vibe_score
         
-        result = supabase_client.table('dashboard').upsert(data).execute()
+        result = await supabase_client.execute(lambda c: c.table('dashboard').upsert(data))
         return True
+    except deadlines.DeadlineExceeded:
+        raise
     except Exception as e:
-        print(f"Error saving to dashboard: {e}")
-        traceback.print_exc()
+        logger.exception("Error saving to dashboard: %s", e, extra={"date": date, "time_block": time_block})
         return False
 
 
+def log_features_summary(device_id: str, date: str, time_block: str, features: AudioFeatures,
+                         subject_info: Optional[Dict], **fields):
+    """取得したデータの概要を1件のログとして出力"""
+    logger.info("📊 Data retrieved", extra={
+        "device_id": device_id,
+        "date": date,
+        "time_block": time_block,
+        "transcription_chars": len(features.transcription) if features.transcription else 0,
+        "sed_events": len(features.sed_data) if features.sed_data else 0,
+        "opensmile_seconds": len(features.opensmile_data) if features.opensmile_data else 0,
+        "has_subject_info": bool(subject_info),
+        **fields
+    })
+
+
 # エクスポート用の処理関数
 
 
@@ -593,26 +716,24 @@ async def process_timeblock_v2(supabase_client, device_id: str, date: str, time_
     処理: Whisper + SEDデータ（behavior_yamnetテーブル使用）+ OpenSMILEデータ + 観測対象者情報
     プロンプト生成後、使用されたデータソースのstatusをcompletedに更新
     """
-    # データ取得
-    transcription = await get_whisper_data(supabase_client, device_id, date, time_block)
-    sed_data = await get_sed_data(supabase_client, device_id, date, time_block)
-    opensmile_data = await get_opensmile_data(supabase_client, device_id, date, time_block)
+    # データ取得（audio_featuresは1クエリで3種類まとめて取得）
+    features = await get_audio_features(supabase_client, device_id, date, time_block)
     subject_info = await get_subject_info(supabase_client, device_id)
+    transcription = features.transcription
+    sed_data = features.sed_data
+    opensmile_data = features.opensmile_data
     
     # データ存在フラグを記録
-    has_whisper = transcription is not None
-    has_yamnet = sed_data is not None and len(sed_data) > 0
-    has_opensmile = opensmile_data is not None and len(opensmile_data) > 0
+    has_whisper = features.has_whisper
+    has_yamnet = features.has_sed
+    has_opensmile = features.has_opensmile
     
     # プロンプト生成（OpenSMILEデータも含めて渡す）
-    prompt = generate_timeblock_prompt(transcription, sed_data, time_block, date, subject_info, opensmile_data)
+    with metrics.stage(metrics.PROMPT_BUILD):
+        prompt = generate_timeblock_prompt(transcription, sed_data, time_block, date, subject_info, opensmile_data)
     
     # デバッグ用：取得したデータの情報を出力
-    print(f"📊 Data retrieved for {time_block}:")
-    print(f"  - Transcription: {'Yes' if has_whisper else 'No'} ({len(transcription) if transcription else 0} chars)")
-    print(f"  - SED Events: {'Yes' if has_yamnet else 'No'} ({len(sed_data) if sed_data else 0} events)")
-    print(f"  - OpenSMILE Timeline: {'Yes' if has_opensmile else 'No'} ({len(opensmile_data) if opensmile_data else 0} seconds)")
-    print(f"  - Subject Info: {'Yes' if subject_info else 'No'}")
+    log_features_summary(device_id, date, time_block, features, subject_info)
     
     # プロンプト保存（dashboardテーブルへ）
     dashboard_saved = await save_prompt_to_dashboard(supabase_client, device_id, date, time_block, prompt)
@@ -625,7 +746,6 @@ async def process_timeblock_v2(supabase_client, device_id: str, date: str, time_
     }
     
     if dashboard_saved:
-        print(f"\n📝 Updating status for used data sources...")
         
         # 実際にデータが存在した場合のみstatusを更新
         if has_whisper:
@@ -643,13 +763,19 @@ async def process_timeblock_v2(supabase_client, device_id: str, date: str, time_
                 supabase_client, device_id, date, time_block
             )
         
-        # 更新結果のサマリー
-        print(f"\n✨ Status update summary:")
-        print(f"  - vibe_whisper: {'✅ Updated' if status_updates['whisper_updated'] else '⏭️ Skipped (no data)' if not has_whisper else '⚠️ Update failed'}")
-        print(f"  - behavior_yamnet: {'✅ Updated' if status_updates['yamnet_updated'] else '⏭️ Skipped (no data)' if not has_yamnet else '⚠️ Update failed'}")
-        print(f"  - emotion_opensmile: {'✅ Updated' if status_updates['opensmile_updated'] else '⏭️ Skipped (no data)' if not has_opensmile else '⚠️ Update failed'}")
+        # 更新結果のサマリー（updated / skipped（データなし） / failed）
+        def update_result(updated: bool, has_data: bool) -> str:
+            return "updated" if updated else "skipped" if not has_data else "failed"
+
+        logger.info("✨ Status update summary", extra={
+            "date": date,
+            "time_block": time_block,
+            "vibe_whisper": update_result(status_updates["whisper_updated"], has_whisper),
+            "behavior_yamnet": update_result(status_updates["yamnet_updated"], has_yamnet),
+            "emotion_opensmile": update_result(status_updates["opensmile_updated"], has_opensmile)
+        })
     else:
-        print(f"⚠️ Dashboard save failed, skipping status updates")
+        logger.warning("⚠️ Dashboard save failed, skipping status updates", extra={"date": date, "time_block": time_block})
     
     return {
         "status": "success",
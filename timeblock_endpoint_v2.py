@@ -4,53 +4,37 @@ Time Block Processing Endpoint V2
 改善版：AIの常識的判断を活用し、シンプルで効果的なプロンプト生成
 """
 
-from datetime import datetime
-from typing import Optional, Dict, Any, List
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator
 import json
-import traceback
 
+import calendar_context
+from calendar_context import get_weekday_info
+from opensmile_features import OpenSmileFeatures
+from sed_events import SedSummary
+import deadlines
+import metrics
+import prompt_cache
+import structured_logging
+from projections import AUDIO_FEATURES_PROMPT, AUDIO_FEATURES_KEY_COLUMNS, ORDER_BY_AUDIO_FEATURES_KEY
 
-def get_season(month: int) -> str:
-    """月から季節を判定（日本の季節）"""
-    if month in [3, 4, 5]:
-        return "春"
-    elif month in [6, 7, 8]:
-        return "夏"
-    elif month in [9, 10, 11]:
-        return "秋"
-    else:
-        return "冬"
-
-
-def get_weekday_info(date_str: str) -> Dict[str, Any]:
-    """日付文字列から曜日情報を取得"""
-    try:
-        date_obj = datetime.strptime(date_str, "%Y-%m-%d")
-        
-        # 曜日名（日本語）
-        weekdays_ja = ["月曜日", "火曜日", "水曜日", "木曜日", "金曜日", "土曜日", "日曜日"]
-        weekday_ja = weekdays_ja[date_obj.weekday()]
-        
-        # 週末判定
-        is_weekend = date_obj.weekday() >= 5  # 土曜日(5)または日曜日(6)
-        
-        return {
-            "weekday": weekday_ja,
-            "is_weekend": is_weekend,
-            "day_type": "週末" if is_weekend else "平日"
-        }
-    except (ValueError, TypeError):
-        return {
-            "weekday": "不明",
-            "is_weekend": None,
-            "day_type": "不明"
-        }
 
+logger = structured_logging.get_logger(__name__)
 
 def get_holiday_context(date: str) -> Dict[str, Any]:
     """
-    祝日情報を取得（jpholidayが利用可能な場合）
+    祝日情報を取得（calendar_contextの事前計算インデックスを優先して利用）
     """
+    context = calendar_context.calendar_index.holiday_context(date)
+    if context is not None:
+        return {
+            "is_holiday": context["is_holiday"],
+            "holiday_name": context["holiday_name"],
+            "is_weekend": context["is_weekend"]
+        }
+
+    # インデックス範囲外の日付はその場で判定
     try:
         import jpholiday
         date_obj = datetime.strptime(date, "%Y-%m-%d")
@@ -91,28 +75,19 @@ def generate_timeblock_prompt_v2(transcription: Optional[str], sed_data: Optiona
     weekday_info = get_weekday_info(date) if date else {"weekday": "不明", "day_type": "不明"}
     holiday_info = get_holiday_context(date) if date else {"is_holiday": False, "holiday_name": None}
     
-    # OpenSMILEデータの分析と時系列表示
+    # OpenSMILEデータの分析と時系列表示（列形式に1回だけ変換）
     speech_analysis = ""
-    if opensmile_data and len(opensmile_data) > 0:
+    opensmile = OpenSmileFeatures.from_timeline(opensmile_data)
+    if opensmile is not None:
         # Jitterから発話の有無を判定
-        jitter_values = []
-        loudness_values = []
-        for item in opensmile_data:
-            features = item.get('features', {})
-            jitter_values.append(features.get('jitterLocal_sma3nz', 0))
-            loudness_values.append(features.get('Loudness_sma3', 0))
-        
-        speaking_seconds = sum(1 for j in jitter_values if j > 0)
-        total_seconds = len(jitter_values)
-        speech_ratio = speaking_seconds / total_seconds if total_seconds > 0 else 0
+        speaking_seconds = opensmile.speaking_seconds
+        total_seconds = opensmile.total_seconds
+        speech_ratio = opensmile.speech_ratio
         
         # 時系列の最初の20秒を表示
         timeline = ["時刻|音量|Jitter|状態"]
         timeline.append("---|---|---|---")
-        for i in range(min(20, len(opensmile_data))):
-            features = opensmile_data[i].get('features', {})
-            loudness = features.get('Loudness_sma3', 0)
-            jitter = features.get('jitterLocal_sma3nz', 0)
+        for i, (_, loudness, jitter) in enumerate(opensmile.rows(20)):
             state = "発話" if jitter > 0 else "無音"
             timeline.append(f"{i:02d}秒|{loudness:.3f}|{jitter:.6f}|{state}")
         
@@ -125,13 +100,11 @@ def generate_timeblock_prompt_v2(transcription: Optional[str], sed_data: Optiona
 {chr(10).join(timeline)}
 """
     
-    # 環境音の簡潔な要約
+    # 環境音の簡潔な要約（確率上位5件のうち30%超のもの）
     sound_summary = "環境音データなし"
-    if sed_data and len(sed_data) > 0:
-        top_sounds = []
-        for e in sed_data[:5]:
-            if e.get('prob', 0) > 0.3:
-                top_sounds.append(e.get('label', ''))
+    sed = SedSummary.from_events(sed_data)
+    if sed is not None:
+        top_sounds = [label for label, prob in sed.top(5) if prob > 0.3]
         if top_sounds:
             sound_summary = f"検出音: {', '.join(top_sounds)}"
     
@@ -212,52 +185,52 @@ def generate_timeblock_prompt_v2(transcription: Optional[str], sed_data: Optiona
 
 # 既存の関数をインポート可能にするため
 from timeblock_endpoint import (
-    get_whisper_data,
-    get_sed_data,
-    get_opensmile_data,
+    AudioFeatures,
+    parse_audio_features_row,
+    get_audio_features,
+    get_audio_features_bulk,
     get_subject_info,
+    log_features_summary,
     save_prompt_to_dashboard,
+    save_prompts_to_aggregator_bulk,
     update_whisper_status,
     update_yamnet_status,
     update_opensmile_status
 )
 
 
-async def process_timeblock_v3(supabase_client, device_id: str, date: str, time_block: str) -> Dict[str, Any]:
+def build_timeblock_result(device_id: str, date: str, time_block: str,
+                           features: AudioFeatures, subject_info: Optional[Dict]) -> Dict[str, Any]:
     """
-    改善版処理: V2プロンプトを使用
+    取得済みのaudio_features・観測対象者情報からV2プロンプトを生成し、レスポンス用の辞書を組み立てる
+    （保存結果 aggregator_saved は呼び出し側で追加する）
     """
-    # データ取得
-    transcription = await get_whisper_data(supabase_client, device_id, date, time_block)
-    sed_data = await get_sed_data(supabase_client, device_id, date, time_block)
-    opensmile_data = await get_opensmile_data(supabase_client, device_id, date, time_block)
-    subject_info = await get_subject_info(supabase_client, device_id)
+    transcription = features.transcription
+    sed_data = features.sed_data
+    opensmile_data = features.opensmile_data
     
     # データ存在フラグ
-    has_whisper = transcription is not None
-    has_yamnet = sed_data is not None and len(sed_data) > 0
-    has_opensmile = opensmile_data is not None and len(opensmile_data) > 0
+    has_whisper = features.has_whisper
+    has_yamnet = features.has_sed
+    has_opensmile = features.has_opensmile
     
-    # 改善版プロンプト生成
-    prompt = generate_timeblock_prompt_v2(transcription, sed_data, time_block, date, subject_info, opensmile_data)
+    # 改善版プロンプト生成（入力内容が同じであればキャッシュ済みのプロンプトを使う）
+    cache_key = prompt_cache.prompt_cache_key(
+        device_id, date, time_block, transcription, sed_data, opensmile_data, subject_info
+    )
+    prompt = prompt_cache.get_cached_prompt(cache_key)
+    prompt_cache_hit = prompt is not None
+    if not prompt_cache_hit:
+        with metrics.stage(metrics.PROMPT_BUILD):
+            prompt = generate_timeblock_prompt_v2(transcription, sed_data, time_block, date, subject_info, opensmile_data)
+        prompt_cache.cache_prompt(cache_key, prompt)
     
     # デバッグ出力
-    print(f"📊 Data retrieved for {time_block}:")
-    print(f"  - Transcription: {'Yes' if has_whisper else 'No'} ({len(transcription) if transcription else 0} chars)")
-    print(f"  - SED Events: {'Yes' if has_yamnet else 'No'} ({len(sed_data) if sed_data else 0} events)")
-    print(f"  - OpenSMILE Timeline: {'Yes' if has_opensmile else 'No'} ({len(opensmile_data) if opensmile_data else 0} seconds)")
-    print(f"  - Subject Info: {'Yes' if subject_info else 'No'}")
+    log_features_summary(device_id, date, time_block, features, subject_info, prompt_cache_hit=prompt_cache_hit)
     
-    # プロンプト保存
-    dashboard_saved = await save_prompt_to_dashboard(supabase_client, device_id, date, time_block, prompt)
-
-    # 注意: Features APIが既にステータスを管理しているため、ここでの更新は不要
-    # （以前の実装では vibe_whisper, behavior_yamnet, emotion_opensmile テーブルを更新していたが、
-    #  新アーキテクチャでは audio_features テーブルで各APIが自分でステータスを管理する）
-
     return {
         "status": "success",
-        "version": "v3-improved",
+        "version": prompt_cache.PROMPT_VERSION,
         "device_id": device_id,
         "date": date,
         "time_block": time_block,
@@ -268,5 +241,225 @@ async def process_timeblock_v3(supabase_client, device_id: str, date: str, time_
         "has_opensmile_data": has_opensmile,
         "sed_events_count": len(sed_data) if sed_data else 0,
         "opensmile_seconds": len(opensmile_data) if opensmile_data else 0,
-        "aggregator_saved": dashboard_saved
-    }
\ No newline at end of file
+        "prompt_cache_hit": prompt_cache_hit
+    }
+
+
+async def process_timeblock_v3(supabase_client, device_id: str, date: str, time_block: str) -> Dict[str, Any]:
+    """
+    改善版処理: V2プロンプトを使用
+    """
+    # データ取得（audio_featuresは1クエリで3種類まとめて取得）
+    features = await get_audio_features(supabase_client, device_id, date, time_block)
+    subject_info = await get_subject_info(supabase_client, device_id)
+    
+    result = build_timeblock_result(device_id, date, time_block, features, subject_info)
+    
+    # プロンプト保存（deadline を過ぎた場合は保存せず、partial として返す）
+    dashboard_saved = False
+    if not deadlines.expired():
+        dashboard_saved = await save_prompt_to_dashboard(supabase_client, device_id, date, time_block, result["prompt"])
+
+    # 注意: Features APIが既にステータスを管理しているため、ここでの更新は不要
+    # （以前の実装では vibe_whisper, behavior_yamnet, emotion_opensmile テーブルを更新していたが、
+    #  新アーキテクチャでは audio_features テーブルで各APIが自分でステータスを管理する）
+
+    result["aggregator_saved"] = dashboard_saved
+    return _mark_partial_if_expired([result])[0]
+
+
+async def process_timeblock_batch_v3(supabase_client, items: List[Tuple[str, str, str]]) -> List[Dict[str, Any]]:
+    """
+    複数の (device_id, date, time_block) をまとめて処理するバッチ版
+    1. audio_featuresを1クエリで一括取得
+    2. 観測対象者情報をデバイスごとに1回だけ取得（キャッシュ経由）
+    3. 全アイテムのプロンプトを生成
+    4. audio_aggregatorへ1回のUPSERTで一括保存
+    結果は items と同じ順番で返す（アイテム単位のエラーは status='error' として返す）
+    """
+    features_by_key = await get_audio_features_bulk(supabase_client, items)
+    
+    device_ids = list(dict.fromkeys(device_id for device_id, _, _ in items))
+    subject_infos = await asyncio.gather(
+        *[get_subject_info(supabase_client, device_id) for device_id in device_ids]
+    )
+    subject_by_device = dict(zip(device_ids, subject_infos))
+    
+    results, saved_entries = _build_timeblock_results(items, features_by_key, subject_by_device)
+    
+    aggregator_saved = False
+    if not deadlines.expired():
+        aggregator_saved = await save_prompts_to_aggregator_bulk(supabase_client, saved_entries)
+    for result in results:
+        if result["status"] == "success":
+            result["aggregator_saved"] = aggregator_saved
+    
+    return _mark_partial_if_expired(results)
+
+
+def _mark_partial_if_expired(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    deadline を過ぎていれば、生成できた結果を status='partial' にする
+    （データ取得後に時間切れになり保存を省略した場合。aggregator_saved で保存の有無を確認できる。
+    取得中の時間切れは DeadlineExceeded（504）になる）
+    """
+    if deadlines.expired():
+        for result in results:
+            if result["status"] == "success":
+                result["status"] = "partial"
+                result["deadline_exceeded"] = True
+    return results
+
+
+def _build_timeblock_results(items: List[Tuple[str, str, str]],
+                             features_by_key: Dict[Tuple[str, str, str], AudioFeatures],
+                             subject_by_device: Dict[str, Optional[Dict]]):
+    """
+    取得済みデータから複数アイテムのプロンプトを生成
+    Returns:
+        (results, saved_entries) - saved_entriesはaudio_aggregator保存用の (device_id, date, time_block, prompt)
+    """
+    results = []
+    saved_entries = []
+    for device_id, date, time_block in items:
+        try:
+            result = build_timeblock_result(
+                device_id, date, time_block,
+                features_by_key.get((device_id, date, time_block), AudioFeatures()),
+                subject_by_device.get(device_id)
+            )
+            saved_entries.append((device_id, date, time_block, result["prompt"]))
+        except Exception as e:
+            logger.exception("❌ Batch item failed: %s", e, extra={"device_id": device_id, "date": date, "time_block": time_block})
+            result = {
+                "status": "error",
+                "device_id": device_id,
+                "date": date,
+                "time_block": time_block,
+                "error": str(e)
+            }
+        results.append(result)
+    return results, saved_entries
+
+
+def expand_date_range(start_date: str, end_date: str) -> List[str]:
+    """
+    start_date〜end_date（両端を含む、YYYY-MM-DD）の日付を順に返す（end_date が start_date より前の場合は空）
+    日付（JST）の暦日として数えるため、タイムゾーンや夏時間の影響は受けない
+
+    Raises:
+        ValueError: 日付がYYYY-MM-DD形式でない
+    """
+    start = datetime.strptime(start_date, "%Y-%m-%d").date()
+    end = datetime.strptime(end_date, "%Y-%m-%d").date()
+    return [(start + timedelta(days=offset)).isoformat() for offset in range((end - start).days + 1)]
+
+
+async def process_timeblock_backfill_v3(supabase_client, device_id: str, start_date: str, end_date: str,
+                                        concurrency: int = 4,
+                                        include_prompts: bool = False) -> AsyncIterator[Dict[str, Any]]:
+    """
+    デバイスの日付範囲（両端を含む）を一括で再処理するバックフィル版
+    1. 期間内のaudio_featuresを一括取得（ページング）
+    2. 日ごとに全タイムブロックのプロンプトを生成し、audio_aggregatorへ保存
+       （日単位の処理は最大 concurrency 件まで並行実行）
+    3. 日の処理が終わるたびに進捗イベントをyieldし、最後にサマリーイベントをyieldする
+    """
+    try:
+        with metrics.stage(metrics.AUDIO_FEATURES_FETCH):
+            rows = await supabase_client.execute_paged(
+                lambda c: AUDIO_FEATURES_PROMPT.select(c, *AUDIO_FEATURES_KEY_COLUMNS).eq(
+                    'device_id', device_id
+                ).gte(
+                    'date', start_date
+                ).lte(
+                    'date', end_date
+                ).order(ORDER_BY_AUDIO_FEATURES_KEY)
+            )
+    except Exception as e:
+        logger.error("❌ Backfill load failed: %s", e, extra={"device_id": device_id, "start_date": start_date, "end_date": end_date})
+        yield {"event": "error", "device_id": device_id, "error": str(e)}
+        return
+    
+    # 日付ごとに (device_id, date, time_block) → AudioFeatures を整理
+    features_by_date: Dict[str, Dict[Tuple[str, str, str], AudioFeatures]] = {}
+    for row in rows:
+        key = (device_id, row.get('date'), row.get('time_block'))
+        day_features = features_by_date.setdefault(key[1], {})
+        if key not in day_features:
+            day_features[key] = parse_audio_features_row(row)
+    
+    subject_by_device = {device_id: await get_subject_info(supabase_client, device_id)}
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    
+    logger.info("🔁 Backfill started", extra={
+        "device_id": device_id,
+        "start_date": start_date,
+        "end_date": end_date,
+        "blocks": len(rows),
+        "days": len(features_by_date)
+    })
+    yield {
+        "event": "start",
+        "device_id": device_id,
+        "start_date": start_date,
+        "end_date": end_date,
+        "days": len(features_by_date),
+        "blocks": len(rows)
+    }
+    
+    async def process_day(date: str) -> Dict[str, Any]:
+        async with semaphore:
+            day_features = features_by_date[date]
+            results, saved_entries = _build_timeblock_results(list(day_features), day_features, subject_by_device)
+            aggregator_saved = await save_prompts_to_aggregator_bulk(supabase_client, saved_entries)
+            
+            for result in results:
+                if result["status"] == "success":
+                    result["aggregator_saved"] = aggregator_saved
+                    if not include_prompts:
+                        result.pop("prompt", None)
+            
+            success_count = sum(1 for result in results if result["status"] == "success")
+            return {
+                "event": "day",
+                "device_id": device_id,
+                "date": date,
+                "blocks": len(results),
+                "success_count": success_count,
+                "error_count": len(results) - success_count,
+                "aggregator_saved": aggregator_saved,
+                "results": results
+            }
+    
+    total_blocks = 0
+    total_errors = 0
+    failed_saves = 0
+    tasks = [asyncio.create_task(process_day(date)) for date in sorted(features_by_date)]
+    try:
+        for completed in asyncio.as_completed(tasks):
+            day_event = await completed
+            total_blocks += day_event["blocks"]
+            total_errors += day_event["error_count"]
+            if not day_event["aggregator_saved"]:
+                failed_saves += 1
+            yield day_event
+    finally:
+        # クライアント切断などで中断された場合は残りの処理を止める
+        for task in tasks:
+            task.cancel()
+    
+    logger.info("✅ Backfill finished", extra={
+        "device_id": device_id,
+        "blocks": total_blocks,
+        "errors": total_errors,
+        "failed_saves": failed_saves
+    })
+    yield {
+        "event": "done",
+        "device_id": device_id,
+        "days": len(features_by_date),
+        "blocks": total_blocks,
+        "error_count": total_errors,
+        "failed_saves": failed_saves
+    }
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+TTL + LRU Cache
+===============
+プロセス内で使う有効期限付き・サイズ上限付き（LRU追い出し）のキャッシュ
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+# キャッシュに存在しないことを表す値（Noneもキャッシュできるようにするため）
+MISSING = object()
+
+
+class TTLCache:
+    """有効期限（秒）と最大件数を持つスレッドセーフなLRUキャッシュ"""
+
+    def __init__(self, ttl_seconds: float, max_size: int, clock: Callable[[], float] = time.monotonic):
+        """clock: 有効期限の判定に使う時計（テストで差し替える）"""
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._clock = clock
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any:
+        """値を取得（存在しない・期限切れの場合は MISSING を返す）"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                del self._data[key]
+                self.misses += 1
+                return MISSING
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        """値を保存（上限を超えた場合は最も古く使われたものから削除）"""
+        with self._lock:
+            self._data[key] = (self._clock() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Optional[Hashable] = None) -> int:
+        """指定キー（省略時は全件）を削除し、削除件数を返す"""
+        with self._lock:
+            if key is None:
+                count = len(self._data)
+                self._data.clear()
+                return count
+            return 1 if self._data.pop(key, None) is not None else 0
+
+    def stats(self) -> Dict[str, Any]:
+        """キャッシュの統計情報"""
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses
+            }
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+Write-Behind Buffer
+===================
+audio_aggregator / dashboard へのUPSERTをリクエスト内で待たずに、
+ローカルのSQLiteジャーナルへ記録してからバックグラウンドで一括UPSERTするモジュール
+
+- 書き込みはまずジャーナル（SQLite）に保存されるため、再起動やSupabase障害時も失われない
+  （起動時にジャーナルに残っている書き込みから再送する）
+- 同じ (テーブル, on_conflictのキー値) への書き込みはジャーナル上で最後のものだけを残す
+  （順番に1件ずつUPSERTした場合と同じ最終結果）
+- 件数（WRITE_BEHIND_MAX_BATCH）または時間（WRITE_BEHIND_FLUSH_INTERVAL_SECONDS）で
+  テーブル・on_conflict・カラム構成ごとにまとめて1回のUPSERTで書き込む
+- 送信に失敗したまとまりは行ごとに試行回数を数え、指数バックオフで再送する（他のまとまりの送信は止めない）
+- 再送しても成功しない行（4xx相当のエラー、または WRITE_BEHIND_MAX_ATTEMPTS 回失敗）は
+  ジャーナル内の dead_writes テーブルに移して送信対象から外す
+- WRITE_BEHIND_ENABLED が無効の場合は従来どおりその場でUPSERTする
+
+使い方:
+    await write_behind.upsert(supabase, 'dashboard', record, on_conflict='device_id,date,time_block')
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from postgrest.exceptions import APIError
+
+import structured_logging
+
+
+logger = structured_logging.get_logger(__name__)
+
+
+# コンテナの再作成をまたいで保持するため、docker-compose でボリュームをマウントするディレクトリに置く
+DEFAULT_JOURNAL_PATH = "/app/data/write_behind_journal.sqlite3"
+DEFAULT_MAX_BATCH = 100
+DEFAULT_FLUSH_INTERVAL_SECONDS = 1.0
+DEFAULT_MAX_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 1.0
+MAX_RETRY_BACKOFF_SECONDS = 60.0
+
+# 再送しても成功しないエラー（PostgreSQLのSQLSTATEクラス: 22 データ例外, 23 制約違反, 42 構文・未定義カラム等）
+NON_RETRYABLE_SQLSTATE_CLASSES = ("22", "23", "42")
+
+
+def is_retryable(error: Exception) -> bool:
+    """一時的なエラー（ネットワーク・タイムアウト・5xx・429）のみ再送対象とする"""
+    if not isinstance(error, APIError):
+        return True
+    code = str(error.code or "")
+    if code.isdigit() and len(code) == 3:
+        # JSONでないエラーレスポンスの場合はHTTPステータスがcodeに入る
+        status = int(code)
+        return status >= 500 or status in (408, 429)
+    if code.startswith(("PGRST1", "PGRST2")):
+        # リクエスト・スキーマの誤り（存在しないカラム等）
+        return False
+    return code[:2] not in NON_RETRYABLE_SQLSTATE_CLASSES
+
+
+def _conflict_key(row: Dict[str, Any], conflict_columns: List[str]) -> str:
+    return json.dumps([row.get(column) for column in conflict_columns], ensure_ascii=False, default=str)
+
+
+class SqliteJournal:
+    """未送信の書き込みを保持するSQLiteジャーナル（専用スレッドからのみアクセスする）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pending_writes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT NOT NULL,
+                on_conflict TEXT NOT NULL,
+                conflict_key TEXT NOT NULL,
+                row_json TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                UNIQUE (table_name, on_conflict, conflict_key)
+            )
+            """
+        )
+        # 試行回数のカラムがない古いジャーナルを移行する
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(pending_writes)")}
+        if "attempts" not in columns:
+            self._conn.execute("ALTER TABLE pending_writes ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        if "next_attempt_at" not in columns:
+            self._conn.execute("ALTER TABLE pending_writes ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS dead_writes (
+                id INTEGER PRIMARY KEY,
+                table_name TEXT NOT NULL,
+                on_conflict TEXT NOT NULL,
+                conflict_key TEXT NOT NULL,
+                row_json TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL,
+                error TEXT NOT NULL,
+                failed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def put(self, entries: List[Tuple[str, str, str, str]]) -> int:
+        """(table, on_conflict, conflict_key, row_json) を記録し、未送信件数を返す"""
+        now = time.time()
+        with self._conn:
+            # 同じキーの未送信の書き込みは置き換える（新しいidになるため送信中の古い行と区別できる）
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO pending_writes (table_name, on_conflict, conflict_key, row_json, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [entry + (now,) for entry in entries]
+            )
+        return self.count()
+
+    def read(self, limit: int) -> List[Tuple[int, str, str, str, int]]:
+        """再送待ちでない行を古い順に最大limit件 (id, table, on_conflict, row_json, attempts)"""
+        return self._conn.execute(
+            "SELECT id, table_name, on_conflict, row_json, attempts FROM pending_writes "
+            "WHERE next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (time.time(), limit)
+        ).fetchall()
+
+    def delete(self, ids: List[int]):
+        with self._conn:
+            self._conn.executemany("DELETE FROM pending_writes WHERE id = ?", [(row_id,) for row_id in ids])
+
+    def delete_keys(self, entries: List[Tuple[str, str, str]]):
+        """(table, on_conflict, conflict_key) の未送信の書き込みを取り消す"""
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM pending_writes WHERE table_name = ? AND on_conflict = ? AND conflict_key = ?",
+                entries
+            )
+
+    def retry_later(self, retries: List[Tuple[int, int, float]]):
+        """送信に失敗した (id, 試行回数, 待ち秒数) を記録し、待ち時間が過ぎるまで送信対象から外す"""
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE pending_writes SET attempts = ?, next_attempt_at = ? WHERE id = ?",
+                [(attempts, now + delay, row_id) for row_id, attempts, delay in retries]
+            )
+
+    def dead_letter(self, dead: List[Tuple[int, int]], error: str):
+        """送信できない (id, 試行回数) を dead_writes に移す"""
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO dead_writes "
+                "(id, table_name, on_conflict, conflict_key, row_json, created_at, attempts, error, failed_at) "
+                "SELECT id, table_name, on_conflict, conflict_key, row_json, created_at, ?, ?, ? "
+                "FROM pending_writes WHERE id = ?",
+                [(attempts, error, now, row_id) for row_id, attempts in dead]
+            )
+            self._conn.executemany("DELETE FROM pending_writes WHERE id = ?", [(row_id,) for row_id, _ in dead])
+
+    def count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM pending_writes").fetchone()[0]
+
+    def dead_count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM dead_writes").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+class WriteBehindBuffer:
+    """ジャーナル + バックグラウンドフラッシュによる書き込みバッファ"""
+
+    def __init__(self, supabase_client, journal_path: str = DEFAULT_JOURNAL_PATH,
+                 max_batch: int = DEFAULT_MAX_BATCH, flush_interval: float = DEFAULT_FLUSH_INTERVAL_SECONDS,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.supabase_client = supabase_client
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._journal = SqliteJournal(journal_path)
+        # SQLiteへのアクセスは1スレッドに限定する
+        self._journal_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="write-behind")
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        self.pending = 0
+        self.flushed_rows = 0
+        self.flush_count = 0
+        self.failed_flushes = 0
+        self.dead_letters = 0
+        self.last_error: Optional[str] = None
+
+    async def _journal_call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._journal_executor, fn, *args)
+
+    async def start(self):
+        """バックグラウンドのフラッシュを開始（ジャーナルに残っている書き込みは次のフラッシュで再送）"""
+        self.pending = await self._journal_call(self._journal.count)
+        self.dead_letters = await self._journal_call(self._journal.dead_count)
+        if self.pending > 0:
+            logger.info("📒 Write-behind journal: pending writes will be replayed", extra={"pending": self.pending})
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """残りの書き込みをフラッシュして停止（送信できなかった分はジャーナルに残る）"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+        await self._journal_call(self._journal.close)
+        self._journal_executor.shutdown(wait=True)
+
+    async def enqueue(self, table: str, rows: List[Dict[str, Any]], on_conflict: str):
+        """書き込みをジャーナルに記録する（件数が上限に達したらフラッシュを起こす）"""
+        conflict_columns = on_conflict.split(',')
+        entries = [
+            (
+                table,
+                on_conflict,
+                _conflict_key(row, conflict_columns),
+                json.dumps(row, ensure_ascii=False, default=str)
+            )
+            for row in rows
+        ]
+        self.pending = await self._journal_call(self._journal.put, entries)
+        if self.pending >= self.max_batch:
+            self._wakeup.set()
+
+    async def discard(self, table: str, rows: List[Dict[str, Any]], on_conflict: str):
+        """同じキーの未送信の書き込みを取り消す（直接UPSERTした行が古い書き込みで上書きされないように）"""
+        conflict_columns = on_conflict.split(',')
+        await self._journal_call(
+            self._journal.delete_keys,
+            [(table, on_conflict, _conflict_key(row, conflict_columns)) for row in rows]
+        )
+        self.pending = await self._journal_call(self._journal.count)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping:
+                return
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("❌ Write-behind flush loop error")
+
+    async def flush(self) -> int:
+        """ジャーナルの書き込みをまとめてUPSERTし、送信できた件数を返す（失敗した行は待ち時間をおいて再送）"""
+        flushed = 0
+        async with self._flush_lock:
+            while True:
+                # 送信に失敗した行は待ち時間が過ぎるまで読み出されないため、このループは必ず終わる
+                entries = await self._journal_call(self._journal.read, self.max_batch)
+                if not entries:
+                    break
+
+                # テーブル・on_conflict・カラム構成ごとにまとめる（一括UPSERTは同じカラム構成が前提）
+                groups: Dict[Tuple[str, str, Tuple[str, ...]], Tuple[List[int], List[Dict[str, Any]], List[int]]] = {}
+                for row_id, table, on_conflict, row_json, attempts in entries:
+                    row = json.loads(row_json)
+                    ids, rows, attempt_counts = groups.setdefault((table, on_conflict, tuple(sorted(row))), ([], [], []))
+                    ids.append(row_id)
+                    rows.append(row)
+                    attempt_counts.append(attempts)
+
+                # まとまりごとに送信・削除する（1つのまとまりの失敗で他のまとまりを止めない）
+                for (table, on_conflict, _), (ids, rows, attempt_counts) in groups.items():
+                    flushed += await self._flush_group(table, on_conflict, ids, rows, attempt_counts)
+
+                if len(entries) < self.max_batch:
+                    break
+
+            self.pending = await self._journal_call(self._journal.count)
+
+        if flushed > 0:
+            self.flushed_rows += flushed
+            self.flush_count += 1
+            logger.info("✅ Write-behind flushed", extra={"flushed": flushed, "pending": self.pending})
+        return flushed
+
+    async def _flush_group(self, table: str, on_conflict: str, ids: List[int], rows: List[Dict[str, Any]],
+                           attempt_counts: List[int]) -> int:
+        """1つのまとまりをUPSERTし、送信できた件数を返す"""
+        try:
+            await self.supabase_client.execute(
+                lambda c: c.table(table).upsert(
+                    rows,
+                    on_conflict=on_conflict
+                )
+            )
+        except Exception as e:
+            self.failed_flushes += 1
+            self.last_error = str(e)
+            if not is_retryable(e) and len(ids) > 1:
+                # まとまりのどの行が原因か分からないため、1件ずつ送り直して送信できない行だけを切り分ける
+                flushed = 0
+                for row_id, row, attempts in zip(ids, rows, attempt_counts):
+                    flushed += await self._flush_group(table, on_conflict, [row_id], [row], [attempts])
+                return flushed
+            await self._record_failure(table, ids, attempt_counts, e)
+            return 0
+
+        await self._journal_call(self._journal.delete, ids)
+        return len(ids)
+
+    async def _record_failure(self, table: str, ids: List[int], attempt_counts: List[int], error: Exception):
+        """失敗した行を再送待ちにする（再送しても成功しない行は dead_writes に移す）"""
+        retryable = is_retryable(error)
+        retries: List[Tuple[int, int, float]] = []
+        dead: List[Tuple[int, int]] = []
+        for row_id, attempts in zip(ids, attempt_counts):
+            attempts += 1
+            if not retryable or attempts >= self.max_attempts:
+                dead.append((row_id, attempts))
+            else:
+                retries.append((row_id, attempts, min(RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_RETRY_BACKOFF_SECONDS)))
+
+        if retries:
+            await self._journal_call(self._journal.retry_later, retries)
+            logger.warning("⚠️ Write-behind flush failed, will retry: %s", error, extra={
+                "table": table,
+                "rows": len(retries),
+                "attempts": max(retry[1] for retry in retries)
+            })
+        if dead:
+            await self._journal_call(self._journal.dead_letter, dead, str(error))
+            self.dead_letters += len(dead)
+            logger.error("❌ Write-behind rows moved to dead letters: %s", error, extra={
+                "table": table,
+                "rows": len(dead),
+                "retryable": retryable
+            })
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": self.pending,
+            "flushed_rows": self.flushed_rows,
+            "flush_count": self.flush_count,
+            "failed_flushes": self.failed_flushes,
+            "dead_letters": self.dead_letters,
+            "last_error": self.last_error,
+            "max_batch": self.max_batch,
+            "max_attempts": self.max_attempts,
+            "flush_interval_seconds": self.flush_interval
+        }
+
+
+# アプリケーション全体で共有するバッファ（無効時はNone）
+buffer: Optional[WriteBehindBuffer] = None
+
+
+def is_enabled() -> bool:
+    return os.getenv("WRITE_BEHIND_ENABLED", "false").lower() in ("1", "true", "yes")
+
+
+async def start(supabase_client):
+    """WRITE_BEHIND_ENABLED が有効な場合にバッファを開始"""
+    global buffer
+    if buffer is not None or not is_enabled():
+        return
+    buffer = WriteBehindBuffer(
+        supabase_client,
+        journal_path=os.getenv("WRITE_BEHIND_JOURNAL_PATH", DEFAULT_JOURNAL_PATH),
+        max_batch=int(os.getenv("WRITE_BEHIND_MAX_BATCH", str(DEFAULT_MAX_BATCH))),
+        flush_interval=float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_SECONDS", str(DEFAULT_FLUSH_INTERVAL_SECONDS))),
+        max_attempts=int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", str(DEFAULT_MAX_ATTEMPTS)))
+    )
+    await buffer.start()
+    logger.info("✅ Write-behind enabled", extra={"max_batch": buffer.max_batch, "flush_interval_seconds": buffer.flush_interval})
+
+
+async def stop():
+    global buffer
+    if buffer is not None:
+        await buffer.stop()
+        buffer = None
+
+
+async def upsert(supabase_client, table: str, data: Union[Dict[str, Any], List[Dict[str, Any]]], on_conflict: str,
+                 write_through: bool = False) -> bool:
+    """
+    UPSERTを実行する
+    write-behindが有効な場合はジャーナルに記録して即座に戻り（True）、無効な場合はその場でUPSERTする（False）
+
+    write_through=True の場合は有効時もその場でUPSERTする（直後に別の処理がSupabaseから読む書き込み向け）
+    """
+    rows = data if isinstance(data, list) else [data]
+    if buffer is not None and not write_through:
+        await buffer.enqueue(table, rows, on_conflict)
+        return True
+
+    await supabase_client.execute(
+        lambda c: c.table(table).upsert(
+            data,
+            on_conflict=on_conflict
+        )
+    )
+    if buffer is not None:
+        await buffer.discard(table, rows, on_conflict)
+    return False